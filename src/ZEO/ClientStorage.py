@@ -18,23 +18,31 @@ Public contents of this module:
 ClientStorage -- the main class, implementing the Storage API
 
 """
+import collections
+import concurrent.futures
+import hashlib
+import io
 import logging
 import os
-import re
 import socket
 import stat
 import sys
+import tempfile
 import threading
 import time
 import weakref
 from binascii import hexlify
 
-import BTrees.OOBTree
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows
 
 import zc.lockfile
 import ZODB
 import ZODB.BaseStorage
 import ZODB.ConflictResolution
+import ZODB.event
 import ZODB.interfaces
 import zope.interface
 import six
@@ -49,6 +57,10 @@ from ZODB import utils
 
 import ZEO.asyncio.client
 import ZEO.cache
+import ZEO.delta
+import ZEO.interfaces
+import ZEO.metrics
+from ZEO.blobcache import BlobCacheIndex
 
 logger = logging.getLogger(__name__)
 
@@ -98,6 +110,14 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                  drop_cache_rather_verify=True,
                  credentials=None,
                  server_sync=False,
+                 new_oid_batch_size_max=1000,
+                 transaction_buffer_memory_size=1<<20,
+                 metrics_log_interval=None,
+                 snapshot=None,
+                 vote_and_finish=False,
+                 delta_encoding=False,
+                 serve_stale_reads=False,
+                 shared_thread=False,
                  # The ZODB-define ZConfig support may ball these:
                  username=None, password=None, realm=None,
                  # For tests:
@@ -178,6 +198,73 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         client_label
             A label to include in server log messages for the client.
 
+        new_oid_batch_size_max
+            The maximum number of new object ids to request from the
+            server at once. New object ids are requested in the
+            background when the pool of pre-fetched ids runs low.
+            The number requested is adjusted to the rate at which ids
+            are allocated, up to this limit.  Defaults to 1000.
+
+        transaction_buffer_memory_size
+            The maximum size, in bytes, of data stored in a transaction
+            to be held in memory until the transaction is committed or
+            aborted.  If more data is stored, it is written to a
+            temporary file.  Defaults to 1 megabyte.
+
+        drop_cache_rather_verify
+            A flag indicating whether to drop the cache when the
+            server can't provide invalidations since the cache was
+            last updated.  If false, the cache contents are verified
+            with the server in the background, which requires a
+            server that supports protocol 51.  Defaults to true.
+
+        metrics_log_interval
+            If set, a summary of the client metrics, available from
+            the ``metrics`` attribute, is logged every this many
+            seconds.
+
+        snapshot
+            A transaction id.  If given, the storage is read-only and
+            provides the database as of that transaction, for example
+            for long-running analytics scans.  The server doesn't send
+            invalidations to the client and an in-memory cache is
+            used, because the data it reads can't change.
+
+        vote_and_finish
+            A flag indicating whether to finish transactions when
+            voting, if there are no conflicts to be resolved by the
+            client, saving a round trip to the server and shortening
+            the time the server's commit lock is held.  This is only
+            safe if the storage is the only resource in a transaction,
+            or is the last to vote, because a transaction can't be
+            aborted after it's voted.  Defaults to false.
+
+        delta_encoding
+            A flag indicating whether to send changed object records
+            as deltas against the revisions they replace, and to ask
+            for loads as deltas against non-current revisions in the
+            cache, when the server supports it.  Records are sent in
+            full when there's no base revision or a delta wouldn't be
+            smaller.  The bytes saved are recorded in the client
+            metrics.  Defaults to false.
+
+        serve_stale_reads
+            A flag indicating whether to keep serving reads from the
+            cache while disconnected, rather than waiting for a
+            connection.  Reads see the database as of the last
+            transaction the cache saw.  Reads that miss the cache,
+            commits and other server calls fail right away with
+            ClientDisconnected.  A ``ZEO.interfaces.ServingStaleData``
+            event is sent when the connection is lost.  Defaults to
+            false.
+
+        shared_thread
+            A flag indicating whether to do networking in a thread,
+            and event loop, shared with the other client storages in
+            the process that set it, rather than in a thread of the
+            storage's own.  The storages also share a connection to
+            each server that supports it.  Defaults to false.
+
         Note that the authentication protocol is defined by the server
         and is detected by the ClientStorage upon connecting (see
         testConnection() and doAuth() for details).
@@ -189,6 +276,14 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         if isinstance(addr, int):
             addr = ('127.0.0.1', addr)
 
+        self._snapshot = snapshot
+        if snapshot is not None:
+            read_only = True
+            read_only_fallback = False
+            cache = client = None # Use an ephemeral cache
+            # Loads are made before the transaction after the snapshot:
+            self._snapshot_before = utils.p64(utils.u64(snapshot) + 1)
+
         self.__name__ = name or str(addr) # Standard convention for storages
 
         if isinstance(addr, six.string_types):
@@ -229,6 +324,32 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         self._db = None
 
         self._oids = [] # List of pre-fetched oids from server
+        self._oids_lock = threading.RLock()
+        self._oids_future = None # Pending new_oids request
+        self._oids_batch_size = self._oids_batch_size_min
+        self._oids_batch_size_max = max(new_oid_batch_size_max,
+                                        self._oids_batch_size_min)
+        self._oids_requested = None # Time of the last new_oids request
+        self._oids_allocated = 0 # oids allocated since then
+
+        self._transaction_buffer_memory_size = transaction_buffer_memory_size
+
+        # Waits for other threads and processes downloading blobs:
+        self._blob_download_waits_lock = threading.Lock()
+        self._blob_download_waits = dict(count=0, seconds=0.0, max=0.0)
+        self._storea_many = False # Whether the server takes batched stores
+        self._blob_ranges = False # Whether the server sends blob ranges
+        self._blob_hashes = False # Whether the server finds blobs by hash
+        self._iterator_batches = False # Whether the server batches iteration
+        self._record_iternext_many = False # Whether it batches record_iternext
+        self._record_iternext_read = {} # {next -> result} read ahead
+        self._restore_transactions = False # Whether it takes bulk restores
+        self._vote_and_finish = vote_and_finish
+        self._server_vote_and_finish = False # Whether the server supports it
+        # Whether the server allows more than one transaction at a time:
+        self._concurrent_transactions = False
+        self._delta_encoding = delta_encoding
+        self._server_delta_encoding = False # Whether the server supports it
 
         cache = self._cache = open_cache(
             cache, var, client, storage, cache_size)
@@ -249,10 +370,17 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                 self.fshelper = ZODB.blob.FilesystemHelper(
                     blob_dir, layout_name='zeocache')
                 self.fshelper.create()
+                self._blob_cache_index = BlobCacheIndex(blob_dir)
             self.fshelper.checkSecure()
         else:
             self.fshelper = None
 
+        # Index updates are queued, so they can be written outside the
+        # networking thread:
+        self._blob_index_lock = threading.Lock()
+        self._blob_accesses = {} # {name -> time} not yet in the index
+        self._blob_additions = [] # [(name, size, time)] not yet in the index
+
         self._blob_cache_size = blob_cache_size
         self._blob_data_bytes_loaded = 0
         if blob_cache_size is not None:
@@ -262,6 +390,9 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             self._check_blob_size()
 
         self.server_sync = server_sync
+        self._serve_stale_reads = serve_stale_reads
+
+        self.metrics = ZEO.metrics.ClientMetrics(metrics_log_interval)
 
         self._server = _client_factory(
             addr, self, cache, storage,
@@ -269,6 +400,11 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             wait_timeout or 30,
             ssl = ssl, ssl_server_hostname=ssl_server_hostname,
             credentials=credentials,
+            drop_cache_rather_verify=drop_cache_rather_verify,
+            metrics=self.metrics,
+            invalidations=snapshot is None,
+            wait_for_connection=not serve_stale_reads,
+            shared_thread=shared_thread,
             )
         self._call = self._server.call
         self._async = self._server.async_
@@ -308,6 +444,53 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         if self._check_blob_size_thread is not None:
             self._check_blob_size_thread.join()
 
+        if self._blob_cache_index is not None:
+            self._save_blob_index_updates()
+            self._blob_cache_index.close()
+
+    _blob_cache_index = None
+
+    def _blob_added(self, filename):
+        # Note a file added to the blob cache.  This may be called in
+        # the networking thread, so rather than writing to the index,
+        # which may have to wait for other processes, we queue the
+        # addition to be saved by an application or size-check thread.
+        if self._blob_cache_index is not None:
+            try:
+                added = (self._blob_cache_index.name(filename),
+                         os.stat(filename).st_size, time.time())
+            except Exception:
+                logger.exception("Updating the blob cache index")
+            else:
+                with self._blob_index_lock:
+                    self._blob_additions.append(added)
+
+    def _blob_accessed(self, filename):
+        # Note that a file in the blob cache was used.  We save
+        # access times in the index in batches, and additions as
+        # soon as the application uses the cache.
+        if self._blob_cache_index is not None:
+            with self._blob_index_lock:
+                accesses = self._blob_accesses
+                accesses[self._blob_cache_index.name(filename)] = time.time()
+                save = self._blob_additions or len(accesses) >= 1000
+            if save:
+                self._save_blob_index_updates()
+        return filename
+
+    def _save_blob_index_updates(self):
+        with self._blob_index_lock:
+            accesses, self._blob_accesses = self._blob_accesses, {}
+            additions, self._blob_additions = self._blob_additions, []
+        if accesses or additions:
+            try:
+                for added in additions:
+                    self._blob_cache_index.added(*added)
+                if accesses:
+                    self._blob_cache_index.accessed(accesses)
+            except Exception:
+                logger.exception("Updating the blob cache index")
+
     _check_blob_size_thread = None
     def _check_blob_size(self, bytes=None):
         if self._blob_cache_size is None:
@@ -322,9 +505,16 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
         target = max(self._blob_cache_size - self._blob_cache_size_check, 0)
 
+        def check():
+            # This may be called in the networking thread, so index
+            # updates are saved in the check thread.
+            if self._blob_cache_index is not None:
+                self._save_blob_index_updates()
+                self._blob_cache_index.close() # this thread's connection
+            _check_blob_cache_size(self.blob_dir, target)
+
         check_blob_size_thread = threading.Thread(
-            target=_check_blob_cache_size,
-            args=(self.blob_dir, target),
+            target=check,
             name="%s zeo client check blob size thread" % self.__name__,
             )
         check_blob_size_thread.setDaemon(True)
@@ -345,6 +535,33 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         """Return whether the storage is currently connected to a server."""
         return self._server.is_connected()
 
+    def bytes_saved(self):
+        """Return the numbers of bytes saved by compressing messages
+
+        A dictionary is returned with the numbers of bytes saved
+        sending and receiving messages.
+        """
+        return self._server.bytes_saved()
+
+    def blob_download_waits(self):
+        """Return statistics on waits for blob downloads
+
+        When a blob is being downloaded to the blob cache by another
+        thread or process, loading it waits for the download to
+        finish.  A dictionary is returned with the number of waits,
+        the total number of seconds spent waiting and the longest
+        wait.
+        """
+        with self._blob_download_waits_lock:
+            return self._blob_download_waits.copy()
+
+    def _blob_download_waited(self, seconds):
+        with self._blob_download_waits_lock:
+            waits = self._blob_download_waits
+            waits['count'] += 1
+            waits['seconds'] += seconds
+            waits['max'] = max(waits['max'], seconds)
+
     def sync(self):
         # The separate async thread should keep us up to date
         pass
@@ -373,6 +590,22 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                 'set_client_label', self._client_label)
 
         self._info.update(info)
+        self._storea_many = info.get('supports_storea_many', False)
+        self._blob_ranges = info.get('supports_blob_ranges', False)
+        self._blob_hashes = info.get('supports_blob_hashes', False)
+        self._iterator_batches = info.get('supports_iterator_batches', False)
+        self._record_iternext_many = info.get(
+            'supports_record_iternext_many', False)
+        self._restore_transactions = info.get(
+            'supports_restore_transactions', False)
+        self._server_vote_and_finish = info.get(
+            'supports_vote_and_finish', False)
+        self._concurrent_transactions = info.get(
+            'supports_concurrent_transactions', False)
+        self._server_delta_encoding = info.get(
+            'supports_delta_encoding', False)
+        conn.delta_encoding = (
+            self._delta_encoding and self._server_delta_encoding)
 
         for iface in (
             ZODB.interfaces.IStorageRestoreable,
@@ -392,7 +625,18 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             self.ping = lambda : self._call('lastTransaction')
 
         if self.server_sync:
-            self.sync = self.ping
+            if self._serve_stale_reads:
+                self.sync = self._stale_sync
+            else:
+                self.sync = self._server.sync
+
+    def _stale_sync(self):
+        # While disconnected, keep reading as of the last transaction
+        # we saw, rather than failing.
+        try:
+            self._server.sync()
+        except ClientDisconnected:
+            pass
 
     def set_server_addr(self, addr):
         # Normalize server address and convert to string
@@ -436,6 +680,14 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         self._iterator_gc(True)
         self._connection_generation += 1
         self._is_read_only = self._server.is_read_only()
+        if self._serve_stale_reads:
+            logger.warning("%s Serving reads from the cache as of %s",
+                           self.__name__,
+                           utils.tid_repr(self._cache.getLastTid()))
+            try:
+                ZODB.event.notify(ZEO.interfaces.ServingStaleData(self))
+            except Exception:
+                logger.exception("sending ServingStaleData event")
 
     def __len__(self):
         """Return the size of the storage."""
@@ -501,7 +753,22 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
         This is part of the conversion-support API.
         """
-        return self._call('record_iternext', next)
+        if not self._record_iternext_many:
+            return self._call('record_iternext', next)
+
+        # Records are read ahead in batches.
+        result = self._record_iternext_read.pop(next, None)
+        if result is None:
+            read = self._record_iternext_read = {}
+            key = next
+            for result in self._call('record_iternext_many', next,
+                                     self._record_iternext_batch_size):
+                read[key] = result
+                key = result[3]
+            result = read.pop(next)
+        return result
+
+    _record_iternext_batch_size = 100
 
     def getTid(self, oid):
         # XXX deprecated: but ZODB tests use this. They shouldn't
@@ -509,6 +776,25 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
     def loadSerial(self, oid, serial):
         """Storage API: load a historical revision of an object."""
+        data = self._cache.loadSerial(oid, serial)
+        if data is not None:
+            return data
+
+        # Load the revision with loadBefore, which also tells us when
+        # it ended.  Non-current revisions don't change (until they're
+        # packed away), so they can be cached.
+        try:
+            result = self._call(
+                'loadBefore', oid, utils.p64(utils.u64(serial) + 1))
+        except POSException.POSKeyError:
+            result = None
+        if result is not None:
+            data, start, end = result
+            if start == serial:
+                if end is not None:
+                    self._cache.store(oid, start, end, data)
+                return data
+
         return self._call('loadSerial', oid, serial)
 
     def load(self, oid, version=''):
@@ -518,12 +804,30 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         return result[:2]
 
     def loadBefore(self, oid, tid):
+        if self._snapshot is not None and tid > self._snapshot_before:
+            tid = self._snapshot_before
         result = self._cache.loadBefore(oid, tid)
         if result:
+            self.metrics.cache_accessed(True)
             return result
 
+        # The networking thread checks the cache again and records the
+        # miss, or a hit, if another thread loaded the object meanwhile.
         return self._server.load_before(oid, tid)
 
+    def loadBefore_many(self, oids, tid):
+        """Load the revisions of several objects current before tid
+
+        A list of loadBefore results, in the order of the given oids,
+        is returned, with None for objects that don't exist.  Objects
+        that aren't in the cache are requested from the server a few
+        hundred at a time, so big scans don't keep the server from
+        serving other clients.
+        """
+        if self._snapshot is not None and tid > self._snapshot_before:
+            tid = self._snapshot_before
+        return self._server.load_before_many(list(oids), tid)
+
     def prefetch(self, oids, tid):
         self._server.prefetch(oids, tid)
 
@@ -534,12 +838,57 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             raise POSException.ReadOnlyError()
 
         while 1:
-            try:
-                return self._oids.pop()
-            except IndexError:
-                pass # We ran out. We need to get some more.
-
-            self._oids[:0] = reversed(self._call('new_oids'))
+            with self._oids_lock:
+                if self._oids:
+                    self._oids_allocated += 1
+                    oid = self._oids.pop()
+                    if (len(self._oids) < self._oids_batch_size // 2 and
+                        self._oids_future is None):
+                        self._request_new_oids()
+                    return oid
+
+                # We ran out. We need to wait for more.
+                future = self._oids_future
+                if future is None:
+                    future = self._request_new_oids()
+
+            self._server.wait_for_result(future, self._server.timeout)
+            self._new_oids_received(future)
+
+    _oids_batch_size_min = 100
+    _oids_target_interval = 1.0 # Desired seconds between requests
+
+    def _request_new_oids(self):
+        # Request more oids in the background.  Called with
+        # _oids_lock held.
+        now = time.time()
+        if self._oids_requested is not None:
+            # Ask for enough oids to last about _oids_target_interval
+            # seconds at the rate they've been allocated recently.
+            elapsed = max(now - self._oids_requested, 1e-6)
+            rate = self._oids_allocated / elapsed
+            self._oids_batch_size = max(
+                self._oids_batch_size_min,
+                min(self._oids_batch_size_max,
+                    int(rate * self._oids_target_interval)))
+        self._oids_requested = now
+        self._oids_allocated = 0
+
+        future = self._oids_future = self._server.call_future(
+            'new_oids', self._oids_batch_size)
+        future.add_done_callback(self._new_oids_received)
+        return future
+
+    def _new_oids_received(self, future):
+        # Called both from the client thread, when a request completes,
+        # and from a thread that waited on the request, so we only
+        # handle a given result once.
+        with self._oids_lock:
+            if future is not self._oids_future:
+                return
+            self._oids_future = None
+            if future.exception() is None:
+                self._oids[:0] = reversed(future.result())
 
     def pack(self, t=None, referencesf=None, wait=1, days=0):
         """Storage API: pack the storage.
@@ -560,20 +909,68 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         if t is None:
             t = time.time()
         t = t - (days * 86400)
-        return self._call('pack', t, wait)
+        result = self._call('pack', t, wait)
+        # Don't serve revisions the pack removed from the cache:
+        self._cache.clearNoncurrent()
+        return result
+
+    # Approximate maximum size of batched store messages:
+    _store_batch_size = 1 << 20
+
+    def _store_async(self, tbuf, txn, method, *args):
+        """Send a store message, possibly batched with others
+
+        If the server supports it, messages are collected and sent
+        with storea_many when the batch is large enough or when some
+        other transaction message has to be sent.
+        """
+        if self._storea_many:
+            tbuf.messages.append((method, args))
+            data = args[2] if method in ('storea', 'storea_delta') else None
+            tbuf.messages_size += (len(data) if data else 0) + 40
+            if tbuf.messages_size >= self._store_batch_size:
+                self._send_stores(tbuf, txn)
+        else:
+            self._async(method, *(args + (id(txn), )))
+
+    def _send_stores(self, tbuf, txn):
+        """Send batched store messages, to preserve message order"""
+        if tbuf.messages:
+            messages = tbuf.messages
+            tbuf.messages = []
+            tbuf.messages_size = 0
+            self._async('storea_many', messages, id(txn))
 
     def store(self, oid, serial, data, version, txn):
         """Storage API: store data for an object."""
         assert not version
 
         tbuf = self._check_trans(txn, 'store')
-        self._async('storea', oid, serial, data, id(txn))
+        delta = None
+        if (self._delta_encoding and self._server_delta_encoding and
+            data is not None and serial != utils.z64):
+            base = self._delta_base(oid, serial)
+            if base is not None:
+                delta = ZEO.delta.encode(base, data)
+        if delta is None:
+            self._store_async(tbuf, txn, 'storea', oid, serial, data)
+        else:
+            self._store_async(tbuf, txn, 'storea_delta', oid, serial, delta)
+            self.metrics.delta_sent(len(data) - len(delta))
         tbuf.store(oid, data)
 
+    def _delta_base(self, oid, serial):
+        # Return the cached revision of an object written by serial
+        result = self._cache.load(oid)
+        if result is not None and result[1] == serial:
+            return result[0]
+        return self._cache.loadSerial(oid, serial)
+
     def checkCurrentSerialInTransaction(self, oid, serial, transaction):
-        self._check_trans(transaction, 'checkCurrentSerialInTransaction')
-        self._async(
-            'checkCurrentSerialInTransaction', oid, serial, id(transaction))
+        tbuf = self._check_trans(
+            transaction, 'checkCurrentSerialInTransaction')
+        self._store_async(tbuf, transaction,
+                          'checkCurrentSerialInTransaction', oid, serial)
 
     def storeBlob(self, oid, serial, data, blobfilename, version, txn):
         """Storage API: store a blob object."""
@@ -595,10 +992,19 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         os.remove(target[:-1])
 
         serials = self.store(oid, serial, data, '', txn)
+        self._send_stores(tbuf, txn)
         if self.shared_blob_dir:
             self._async(
                 'storeBlobShared',
                 oid, serial, data, os.path.basename(target), id(txn))
+        elif (self._blob_hashes and
+              os.path.getsize(target) >= self._blob_hash_min_size and
+              self._call('storeBlobHash', oid, serial, data,
+                         _blob_digest(target), id(txn))
+              ):
+            # The server already had the data, so we didn't need to
+            # send it.
+            tbuf.storeBlob(oid, target)
         else:
 
             # Store a blob to the server.  We don't want to real all of
@@ -612,6 +1018,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                     chunk = f.read(59000)
                     if not chunk:
                         break
+                    self.metrics.blob_sent(len(chunk))
                     yield ('storeBlobChunk', (chunk, ))
                 f.close()
                 yield ('storeBlobEnd', (oid, serial, data, id(txn)))
@@ -621,6 +1028,10 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
         return serials
 
+    # Smaller blobs are sent without asking the server if it has
+    # them, as sending them costs less than an extra round trip.
+    _blob_hash_min_size = 1 << 16
+
     def receiveBlobStart(self, oid, serial):
         blob_filename = self.fshelper.getBlobFilename(oid, serial)
         assert not os.path.exists(blob_filename)
@@ -638,6 +1049,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         f.seek(0, 2)
         f.write(chunk)
         f.close()
+        self.metrics.blob_received(len(chunk))
         self._blob_data_bytes_loaded += len(chunk)
         self._check_blob_size(self._blob_data_bytes_loaded)
 
@@ -645,10 +1057,11 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         blob_filename = self.fshelper.getBlobFilename(oid, serial)
         os.rename(blob_filename+'.dl', blob_filename)
         os.chmod(blob_filename, stat.S_IREAD)
+        self._blob_added(blob_filename)
 
     def deleteObject(self, oid, serial, txn):
         tbuf = self._check_trans(txn, 'deleteObject')
-        self._async('deleteObject', oid, serial, id(txn))
+        self._store_async(tbuf, txn, 'deleteObject', oid, serial)
         tbuf.store(oid, None)
 
     def loadBlob(self, oid, serial):
@@ -671,7 +1084,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                         "No blob file at %s" % blob_filename, oid, serial)
 
         if os.path.exists(blob_filename):
-            return _accessed(blob_filename)
+            return self._blob_accessed(blob_filename)
 
         # First, we'll create the directory for this oid, if it doesn't exist.
         self.fshelper.createPathForOID(oid)
@@ -681,14 +1094,14 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         # getting it multiple times even accross separate client
         # processes on the same machine. We'll use file locking.
 
-        lock = _lock_blob(blob_filename)
+        lock = _lock_blob(blob_filename, self._blob_download_waited)
         try:
             # We got the lock, so it's our job to download it.  First,
             # we'll double check that someone didn't download it while we
             # were getting the lock:
 
             if os.path.exists(blob_filename):
-                return _accessed(blob_filename)
+                return self._blob_accessed(blob_filename)
 
             # Ask the server to send it to us.  When this function
             # returns, it will have been sent. (The recieving will
@@ -697,13 +1110,119 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             self._call('sendBlob', oid, serial)
 
             if os.path.exists(blob_filename):
-                return _accessed(blob_filename)
+                return self._blob_accessed(blob_filename)
 
             raise POSException.POSKeyError("No blob file", oid, serial)
 
         finally:
             lock.close()
 
+    def openBlobStream(self, oid, serial):
+        """Open a committed blob for reading, fetching data as needed
+
+        If the blob is in the blob cache, or the server can't send
+        parts of blobs, this is the same as openCommittedBlobFile.
+        Otherwise, a file is returned that fetches ranges of the blob
+        from the server as they're read, so callers don't have to
+        wait for the whole blob to be downloaded.  The blob is added
+        to the blob cache once all of its data have been fetched.
+
+        Note that loading a ZODB Blob object loads its data, so to
+        avoid that, pass the oid and serial of a blob that hasn't
+        been loaded.  (The serial can be gotten with ``load``.)
+        """
+        if (self.fshelper is None or self.shared_blob_dir or
+            not self._blob_ranges or
+            os.path.exists(self.fshelper.getBlobFilename(oid, serial))
+            ):
+            return self.openCommittedBlobFile(oid, serial)
+
+        return BlobStream(self, oid, serial)
+
+    def _load_blob_range(self, oid, serial, offset, size):
+        blob_size, data = self._call(
+            'loadBlobRange', oid, serial, offset, size)
+        self.metrics.blob_received(len(data))
+        self._blob_data_bytes_loaded += len(data)
+        self._check_blob_size(self._blob_data_bytes_loaded)
+        return blob_size, data
+
+    def prefetch_blobs(self, oid_serial_pairs, max_downloads=4,
+                       max_bytes=None):
+        """Download blobs to the blob cache in the background
+
+        Blobs given by (oid, serial) pairs that aren't in the blob
+        cache are requested from the server, with at most
+        max_downloads downloads in progress at once.  New downloads
+        aren't started once max_bytes bytes have been downloaded.
+        max_bytes defaults to the blob cache size.  Blobs being
+        downloaded by other threads or processes are skipped.
+        Loading a blob that's being prefetched waits for its download
+        to finish.
+
+        A future is returned whose result is the number of blobs
+        downloaded.
+        """
+        result = concurrent.futures.Future()
+        if self.fshelper is None or self.shared_blob_dir:
+            result.set_result(0)
+            return result
+
+        if max_bytes is None:
+            max_bytes = self._blob_cache_size
+        pending = list(oid_serial_pairs)
+        pending.reverse()
+        state = dict(downloading=0, downloaded=0, bytes=0)
+        state_lock = threading.RLock()
+
+        def start():
+            while (state['downloading'] < max_downloads and pending and
+                   (max_bytes is None or state['bytes'] < max_bytes)):
+                oid, serial = pending.pop()
+                blob_filename = self.fshelper.getBlobFilename(oid, serial)
+                if os.path.exists(blob_filename):
+                    continue
+                self.fshelper.createPathForOID(oid)
+                try:
+                    lock = zc.lockfile.LockFile(
+                        os.path.join(os.path.dirname(blob_filename), '.lock'))
+                except zc.lockfile.LockError:
+                    continue # Someone else is downloading it
+                if os.path.exists(blob_filename):
+                    lock.close()
+                    continue
+                state['downloading'] += 1
+                future = self._server.call_future('sendBlob', oid, serial)
+                future.add_done_callback(
+                    lambda f, lock=lock, blob_filename=blob_filename:
+                    downloaded(f, lock, blob_filename))
+
+            if not state['downloading'] and not result.done():
+                result.set_result(state['downloaded'])
+
+        def downloaded(future, lock, blob_filename):
+            try:
+                with state_lock:
+                    state['downloading'] -= 1
+                    if future.exception() is None:
+                        if os.path.exists(blob_filename):
+                            state['downloaded'] += 1
+                            state['bytes'] += os.path.getsize(blob_filename)
+                    else:
+                        logger.debug("Couldn't prefetch %s: %r",
+                                     blob_filename, future.exception())
+                    lock.close()
+                    start()
+            except Exception as exc:
+                logger.exception("Prefetching blobs")
+                if not result.done():
+                    result.set_exception(exc)
+
+        with state_lock:
+            start()
+
+        return result
+
     def openCommittedBlobFile(self, oid, serial, blob=None):
         blob_filename = self.loadBlob(oid, serial)
         try:
@@ -716,7 +1235,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
             # Fall through and try again with the protection of the lock.
             pass
 
-        lock = _lock_blob(blob_filename)
+        lock = _lock_blob(blob_filename, self._blob_download_waited)
         try:
             blob_filename = self.fshelper.getBlobFilename(oid, serial)
             if not os.path.exists(blob_filename):
@@ -728,7 +1247,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                 if not os.path.exists(blob_filename):
                     raise POSException.POSKeyError("No blob file", oid, serial)
 
-            _accessed(blob_filename)
+            self._blob_accessed(blob_filename)
             if blob is None:
                 return open(blob_filename, 'rb')
             else:
@@ -745,12 +1264,20 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         """
         tbuf = self._check_trans(txn, 'tpc_vote')
         try:
+            self._send_stores(tbuf, txn)
 
+            vote_and_finish = (self._vote_and_finish and
+                               self._server_vote_and_finish)
             conflicts = True
             vote_attempts = 0
             while conflicts and vote_attempts < 9: # 9? Mainly avoid inf. loop
                 conflicts = False
-                for oid in self._call('vote', id(txn)) or ():
+                if vote_and_finish:
+                    tbuf.tid, serials = (
+                        self._server.vote_and_finish(id(txn)) or (None, ()))
+                else:
+                    serials = self._call('vote', id(txn))
+                for oid in serials or ():
                     if isinstance(oid, dict):
                         # Conflict, let's try to resolve it
                         conflicts = True
@@ -816,12 +1343,17 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                 raise POSException.StorageTransactionError(
                     "Duplicate tpc_begin calls for same transaction")
 
-        txn.set_data(self, TransactionBuffer(self._connection_generation))
+        tbuf = TransactionBuffer(
+            self._connection_generation, self._transaction_buffer_memory_size)
+        txn.set_data(self, tbuf)
 
-        # XXX we'd like to allow multiple transactions at a time at some point,
-        # but for now, due to server limitations, TCBOO.
-        self._commit_lock.acquire()
-        self._tbuf = txn.data(self)
+        if not self._concurrent_transactions:
+            # Older servers only allow one transaction at a time per
+            # client.  Newer ones keep transactions apart by id and
+            # only serialize them when they vote.
+            self._commit_lock.acquire()
+            tbuf.commit_lock = self._commit_lock
+            self._tbuf = tbuf
 
         try:
             self._async(
@@ -836,9 +1368,12 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         if tbuf is not None:
             tbuf.close()
             txn.set_data(self, None)
-            self._commit_lock.release()
+            if tbuf.commit_lock is not None:
+                tbuf.commit_lock.release()
 
     def lastTransaction(self):
+        if self._snapshot is not None:
+            return self._snapshot
         return self._cache.getLastTid()
 
     def tpc_abort(self, txn, timeout=None):
@@ -852,6 +1387,22 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         except KeyError:
             return
 
+        if tbuf is not None and tbuf.tid is not None:
+            # We finished when voting, so it's too late to abort.
+            logger.critical(
+                "%s transaction %s was committed when voting"
+                " and can't be aborted",
+                self.__name__, utils.tid_repr(tbuf.tid))
+            try:
+                self._server.tpc_finished(
+                    tbuf.tid, tbuf,
+                    lambda tid: self.invalidateTransaction(
+                        tid, [oid for (oid, _, _) in tbuf]))
+                self._update_blob_cache(tbuf, tbuf.tid)
+            finally:
+                self.tpc_end(txn)
+            return
+
         try:
             # Caution:  Are there any exceptions that should prevent an
             # abort from occurring?  It seems wrong to swallow them
@@ -877,7 +1428,11 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         tbuf = self._check_trans(txn, 'tpc_finish')
 
         try:
-            tid = self._server.tpc_finish(id(txn), tbuf, f)
+            if tbuf.tid is not None:
+                # We finished when voting.
+                tid = self._server.tpc_finished(tbuf.tid, tbuf, f)
+            else:
+                tid = self._server.tpc_finish(id(txn), tbuf, f)
         finally:
             self.tpc_end(txn)
             self._iterator_gc()
@@ -908,6 +1463,7 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
                         blobfilename,
                         target_blob_file_name,
                         )
+                    self._blob_added(target_blob_file_name)
                 finally:
                     lock.close()
                 had_blobs = True
@@ -925,7 +1481,8 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         a storage.
 
         """
-        self._check_trans(txn, 'undo')
+        tbuf = self._check_trans(txn, 'undo')
+        self._send_stores(tbuf, txn)
         self._async('undoa', trans_id, id(txn))
 
     def undoInfo(self, first=0, last=-20, specification=None):
@@ -952,13 +1509,89 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
 
         This is typically used for converting data from one storage to
         another.  `other` must have an .iterator() method.
+
+        If the server supports it, transactions are sent in batches,
+        with their blobs, and committed by the server back to back.
+        Further batches are sent while the server commits earlier
+        ones.
         """
-        ZODB.BaseStorage.copy(other, self, verbose)
+        if not self._restore_transactions:
+            return ZODB.BaseStorage.copy(other, self, verbose)
+
+        if self._is_read_only:
+            raise POSException.ReadOnlyError()
+
+        copy_blobs = (self.fshelper is not None and
+                      ZODB.interfaces.IBlobStorage.providedBy(other))
+        sent = collections.deque() # futures for batches sent
+        batch = []
+        size = 0
+        for transaction in other.iterator():
+            if verbose:
+                print(TimeStamp(transaction.tid))
+            records = []
+            for r in transaction:
+                if copy_blobs and r.data and ZODB.blob.is_blob_record(r.data):
+                    try:
+                        blobfilename = other.loadBlob(r.oid, r.tid)
+                    except POSException.POSKeyError:
+                        pass
+                    else:
+                        self._async_iter(self._restore_blob_messages(
+                            r.oid, r.tid, blobfilename))
+                records.append((r.oid, r.tid, r.data, r.data_txn))
+                size += len(r.data or b'')
+            batch.append((transaction.tid, transaction.status,
+                          transaction.user, transaction.description,
+                          transaction.extension, records))
+            if size >= self._restore_batch_size:
+                self._send_restores(batch, sent)
+                batch = []
+                size = 0
+
+        if batch:
+            self._send_restores(batch, sent)
+        while sent:
+            self._wait_for_result(sent.popleft())
+
+    # Bytes of record data to send to the server at once when copying
+    # transactions, and how many such batches may be waiting to be
+    # committed:
+    _restore_batch_size = 1 << 20
+    _restore_batches_sent_max = 2
+
+    def _send_restores(self, batch, sent):
+        sent.append(self._server.call_future('restore_transactions', batch))
+        if len(sent) > self._restore_batches_sent_max:
+            self._wait_for_result(sent.popleft())
+
+    def _wait_for_result(self, future):
+        # Wait for the result of a call made with call_future.  Like
+        # synchronous calls, we wait as long as it takes while
+        # connected, but only up to the timeout for a connection.
+        server = self._server
+        while 1:
+            try:
+                return server.wait_for_result(future, server.timeout)
+            except concurrent.futures.TimeoutError:
+                pass # Still connected, so keep waiting
+
+    def _restore_blob_messages(self, oid, serial, blobfilename):
+        yield ('storeBlobStart', ())
+        with open(blobfilename, 'rb') as f:
+            while 1:
+                chunk = f.read(59000)
+                if not chunk:
+                    break
+                self.metrics.blob_sent(len(chunk))
+                yield ('storeBlobChunk', (chunk, ))
+        yield ('restoreBlobEnd', (oid, serial))
 
     def restore(self, oid, serial, data, version, prev_txn, transaction):
         """Write data already committed in a separate database."""
         assert not version
-        self._check_trans(transaction, 'restore')
+        tbuf = self._check_trans(transaction, 'restore')
+        self._send_stores(tbuf, transaction)
         self._async('restorea', oid, serial, data, prev_txn, id(transaction))
 
     # Below are methods invoked by the StorageServer
@@ -990,6 +1623,9 @@ class ClientStorage(ZODB.ConflictResolution.ConflictResolvingStorage):
         iid = self._call('iterator_start', start, stop)
         return self._setup_iterator(TransactionIterator, iid)
 
+    # Bytes of data records to request at once when iterating:
+    _iterator_batch_size = 1 << 20
+
     def _setup_iterator(self, factory, iid, *args):
         self._iterators[iid] = iterator = factory(self, iid, *args)
         self._iterator_ids.add(iid)
@@ -1044,10 +1680,42 @@ class TransactionIterator(object):
         self._storage = storage
         self._iid = iid
         self._ended = False
+        # If the server supports it, transactions are fetched, with
+        # their records, in batches, and the next batch is requested
+        # while the current one is being consumed.
+        self._batched = storage._iterator_batches
+        self._transactions = collections.deque()
+        self._next_batch = None # future
 
     def __iter__(self):
         return self
 
+    def _request_batch(self):
+        storage = self._storage
+        self._next_batch = storage._server.call_future(
+            'iterator_next_many', self._iid, storage._iterator_batch_size)
+
+    def _next_batched(self):
+        if not self._transactions:
+            if self._next_batch is None:
+                self._request_batch()
+            batch = self._storage._wait_for_result(self._next_batch)
+            self._next_batch = None
+            if batch and batch[-1] is not None:
+                self._request_batch()
+            self._transactions.extend(batch)
+
+        tx_data = self._transactions.popleft()
+        if tx_data is None:
+            # The iterator is exhausted, and the server has already
+            # disposed it.
+            self._ended = True
+            self._storage._forget_iterator(self._iid)
+            raise StopIteration()
+
+        return ClientStorageTransactionInformation(
+            self._storage, self, *tx_data)
+
     def __next__(self):
         if self._ended:
             raise StopIteration()
@@ -1055,6 +1723,9 @@ class TransactionIterator(object):
         if self._iid < 0:
             raise ClientDisconnected("Disconnected iterator")
 
+        if self._batched:
+            return self._next_batched()
+
         tx_data = self._storage._call('iterator_next', self._iid)
         if tx_data is None:
             # The iterator is exhausted, and the server has already
@@ -1072,11 +1743,12 @@ class TransactionIterator(object):
 class ClientStorageTransactionInformation(ZODB.BaseStorage.TransactionRecord):
 
     def __init__(self, storage, txiter, tid, status, user, description,
-                 extension):
+                 extension, records=None):
         self._storage = storage
         self._txiter = txiter
         self._completed = False
         self._riid = None
+        self._records = records # Sent with the transaction, if batched
 
         self.tid = tid
         self.status = status
@@ -1085,6 +1757,9 @@ class ClientStorageTransactionInformation(ZODB.BaseStorage.TransactionRecord):
         self.extension = extension
 
     def __iter__(self):
+        if self._records is not None:
+            return (ZODB.BaseStorage.DataRecord(*record)
+                    for record in self._records)
         riid = self._storage._call('iterator_record_start',
                                    self._txiter._iid, self.tid)
         return self._storage._setup_iterator(RecordIterator, riid)
@@ -1131,14 +1806,120 @@ class BlobCacheLayout(object):
                          ZODB.blob.BLOB_SUFFIX)
             )
 
-def _accessed(filename):
-    try:
-        os.utime(filename, (time.time(), os.stat(filename).st_mtime))
-    except OSError:
-        pass # We tried. :)
-    return filename
+class BlobStream(io.RawIOBase):
+    """Read-only file for a blob that isn't in the blob cache
+
+    Data are fetched from the server in blocks of ``block_size``
+    bytes as they're read, and saved in a (sparse) temporary file, so
+    they're only fetched once.  When all of the data have been
+    fetched, the file is moved into the blob cache.
+    """
+
+    block_size = 1 << 20
+
+    def __init__(self, storage, oid, serial):
+        self.storage = storage
+        self.oid = oid
+        self.serial = serial
+        self.name = storage.fshelper.getBlobFilename(oid, serial)
+        fd, self._path = tempfile.mkstemp(
+            suffix='.dl', dir=storage.temporaryDirectory())
+        self._file = os.fdopen(fd, 'w+b')
+        self._fetched = set() # indexes of blocks we have
+        self._pos = 0
+        try:
+            # Fetch the first block to learn the size, and so that
+            # the beginning of the blob can be read right away.
+            self._fetch(0)
+        except:
+            self._file.close()
+            os.remove(self._path)
+            raise
+
+    def _fetch(self, block):
+        block_size = self.block_size
+        self.size, data = self.storage._load_blob_range(
+            self.oid, self.serial, block * block_size, block_size)
+        self._file.seek(block * block_size)
+        self._file.write(data)
+        self._fetched.add(block)
+        if len(self._fetched) >= max((self.size-1) // block_size + 1, 1):
+            self._fetched_all()
+
+    def _fetched_all(self):
+        self._file.flush()
+        self.storage.fshelper.createPathForOID(self.oid)
+        lock = _lock_blob(self.name)
+        try:
+            if not os.path.exists(self.name):
+                try:
+                    os.rename(self._path, self.name)
+                except OSError:
+                    return # Probably windows, which can't rename open files
+                os.chmod(self.name, stat.S_IREAD)
+                self._path = None
+                self.storage._blob_added(self.name)
+        finally:
+            lock.close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.size
+        if pos < 0:
+            raise ValueError("negative seek position", pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        pos = self._pos
+        if pos >= self.size:
+            return 0
+        block = pos // self.block_size
+        if block not in self._fetched:
+            self._fetch(block)
+        n = min(len(b), (block + 1) * self.block_size - pos, self.size - pos)
+        self._file.seek(pos)
+        data = self._file.read(n)
+        n = len(data)
+        b[:n] = data
+        self._pos = pos + n
+        return n
+
+    def read(self, size=-1):
+        # Unlike raw files, don't return less than asked for unless
+        # we're at the end.
+        if size is None or size < 0:
+            return self.readall()
+        chunks = []
+        while size > 0:
+            chunk = super(BlobStream, self).read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+            if self._path is not None:
+                try:
+                    os.remove(self._path)
+                except OSError:
+                    pass
+        super(BlobStream, self).close()
 
-cache_file_name = re.compile(r'\d+$').match
 def _check_blob_cache_size(blob_dir, target):
 
     logger = logging.getLogger(__name__+'.check_blob_cache')
@@ -1169,31 +1950,14 @@ def _check_blob_cache_size(blob_dir, target):
     logger.debug("%s Checking blob cache size. (target: %s)",
                  get_ident(), target)
 
+    index = BlobCacheIndex(blob_dir)
     try:
-        while 1:
-            size = 0
-            blob_suffix = ZODB.blob.BLOB_SUFFIX
-            files_by_atime = BTrees.OOBTree.BTree()
-
-            for dirname in os.listdir(blob_dir):
-                if not cache_file_name(dirname):
-                    continue
-                base = os.path.join(blob_dir, dirname)
-                if not os.path.isdir(base):
-                    continue
-                for file_name in os.listdir(base):
-                    if not file_name.endswith(blob_suffix):
-                        continue
-                    file_path = os.path.join(base, file_name)
-                    if not os.path.isfile(file_path):
-                        continue
-                    stat = os.stat(file_path)
-                    size += stat.st_size
-                    t = stat.st_atime
-                    if t not in files_by_atime:
-                        files_by_atime[t] = []
-                    files_by_atime[t].append(os.path.join(dirname, file_name))
+        if not index.complete():
+            logger.info("%s Indexing blob cache %s", get_ident(), blob_dir)
+            index.rebuild()
 
+        while 1:
+            size = index.size()
             logger.debug("%s   blob cache size: %s", get_ident(), size)
 
             if size <= target:
@@ -1206,9 +1970,15 @@ def _check_blob_cache_size(blob_dir, target):
                 logger.debug("%s   -->", get_ident())
                 break
 
-            while size > target and files_by_atime:
-                for file_name in files_by_atime.pop(files_by_atime.minKey()):
-                    file_name = os.path.join(blob_dir, file_name)
+            # Remove least-recently used files, skipping ones we can't
+            # remove now.
+            skipped = 0
+            while size > target:
+                oldest = index.oldest(100, skipped)
+                if not oldest:
+                    break
+                for name, fsize in oldest:
+                    file_name = os.path.join(blob_dir, name)
                     lockfilename = os.path.join(os.path.dirname(file_name),
                                                 '.lock')
                     try:
@@ -1217,16 +1987,18 @@ def _check_blob_cache_size(blob_dir, target):
                         logger.debug("%s Skipping locked %s",
                                      get_ident(),
                                      os.path.basename(file_name))
+                        skipped += 1
                         continue  # In use, skip
 
                     try:
-                        fsize = os.stat(file_name).st_size
                         try:
                             ZODB.blob.remove_committed(file_name)
-                        except OSError as v:
-                            pass # probably open on windows
-                        else:
-                            size -= fsize
+                        except OSError:
+                            if os.path.exists(file_name):
+                                skipped += 1 # probably open on windows
+                                continue
+                        index.removed(name)
+                        size -= fsize
                     finally:
                         lock.close()
 
@@ -1237,6 +2009,7 @@ def _check_blob_cache_size(blob_dir, target):
                          get_ident(), size)
 
     finally:
+        index.close()
         check_lock.close()
 
 def check_blob_size_script(args=None):
@@ -1245,19 +2018,101 @@ def check_blob_size_script(args=None):
     blob_dir, target = args
     _check_blob_cache_size(blob_dir, int(target))
 
-def _lock_blob(path):
-    lockfilename = os.path.join(os.path.dirname(path), '.lock')
-    n = 0
-    while 1:
+# How long to wait for another process or thread to release a blob
+# lock, in seconds:
+_blob_lock_timeout = 600
+
+class _WaitingLockFile(object):
+    """Lock a lock file, waiting until it's available
+
+    zc.lockfile uses non-blocking flock locks on Unix, so we can
+    block on the same file, rather than polling, and be woken by the
+    operating system when the lock is released.  We block in a helper
+    thread, so we can give up with a LockError after timeout seconds,
+    and a hung download doesn't block readers forever.  If we give up,
+    the helper releases the lock as soon as it gets it.
+    """
+
+    def __init__(self, path, timeout=None):
+        if timeout is None:
+            timeout = _blob_lock_timeout
+        fp = open(path, 'a+')
+        self._guard = threading.Lock()
+        self._locked = self._abandoned = False
+        self._error = None
+        thread = threading.Thread(target=self._lock, args=(fp, ),
+                                  name="blob lock waiter %s" % path)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(timeout)
+        with self._guard:
+            if self._locked:
+                self._fp = fp
+                return
+            self._abandoned = True
+            error = self._error
+        self._fp = None
+        if error is not None:
+            raise error
+        raise zc.lockfile.LockError("Couldn't lock %r" % path)
+
+    def _lock(self, fp):
+        # Run in the helper thread
         try:
-            return zc.lockfile.LockFile(lockfilename)
-        except zc.lockfile.LockError:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        except Exception as exc:
+            with self._guard:
+                self._error = exc
+            fp.close()
+            return
+        with self._guard:
+            if not self._abandoned:
+                self._locked = True
+                return
+        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+        fp.close()
+
+    def close(self):
+        if self._fp is not None:
+            fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+            self._fp.close()
+            self._fp = None
+
+def _blob_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while 1:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+def _lock_blob(path, waited=None):
+    lockfilename = os.path.join(os.path.dirname(path), '.lock')
+    try:
+        return zc.lockfile.LockFile(lockfilename)
+    except zc.lockfile.LockError:
+        pass
+
+    # Someone else, usually downloading the blob, has the lock.
+    start = time.time()
+    try:
+        if fcntl is not None:
+            return _WaitingLockFile(lockfilename)
+
+        n = 0
+        while 1:
             time.sleep(0.01)
-            n += 1
-            if n > 60000:
-                raise
-        else:
-            break
+            try:
+                return zc.lockfile.LockFile(lockfilename)
+            except zc.lockfile.LockError:
+                n += 1
+                if n > _blob_lock_timeout * 100:
+                    raise
+    finally:
+        if waited is not None:
+            waited(time.time() - start)
 
 def open_cache(cache, var, client, storage, cache_size):
     if isinstance(cache, (None.__class__, str)):
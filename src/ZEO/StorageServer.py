@@ -20,9 +20,14 @@ TODO:  Need some basic access control-- a declaration of the methods
 exported for invocation by the server.
 """
 import codecs
+import collections
+import copy
+import functools
+import hashlib
 import itertools
 import logging
 import os
+import shutil
 import socket
 import sys
 import tempfile
@@ -30,6 +35,7 @@ import threading
 import time
 import warnings
 import ZEO.asyncio.server
+import ZEO.delta
 import ZODB.blob
 import ZODB.event
 import ZODB.serialize
@@ -37,7 +43,8 @@ import ZODB.TimeStamp
 import zope.interface
 import six
 
-from ZEO._compat import Pickler, Unpickler, PY3, BytesIO
+from ZEO._compat import Pickler, Unpickler, PY3, BytesIO, WIN
+from ZEO.bloom import BloomFilter
 from ZEO.Exceptions import AuthError
 from ZEO.monitor import StorageStats
 from ZEO.asyncio.server import Delay, MTDelay, Result
@@ -45,6 +52,7 @@ from ZODB.Connection import TransactionMetaData
 from ZODB.loglevels import BLATHER
 from ZODB.POSException import StorageError, StorageTransactionError
 from ZODB.POSException import TransactionError, ReadOnlyError, ConflictError
+from ZODB.POSException import POSKeyError
 from ZODB.serialize import referencesf
 from ZODB.utils import oid_repr, p64, u64, z64, Lock, RLock
 
@@ -73,16 +81,35 @@ registered_methods = set(( 'get_info', 'lastTransaction',
     'history', 'record_iternext', 'sendBlob', 'getTid', 'loadSerial',
     'new_oid', 'undoa', 'undoLog', 'undoInfo', 'iterator_start',
     'iterator_next', 'iterator_record_start', 'iterator_record_next',
-    'iterator_gc', 'server_status', 'set_client_label', 'ping'))
+    'iterator_gc', 'server_status', 'set_client_label', 'ping',
+    'storea_many', 'getStaleOids', 'loadBlobRange', 'storeBlobHash',
+    'skip_invalidations', 'loadBefore_many', 'iterator_next_many',
+    'restore_transactions', 'restoreBlobEnd', 'record_iternext_many',
+    'vote_and_finish', 'storea_delta', 'loadBefore_delta'))
+
+def in_transaction(func):
+    """Decorate a method whose last argument is a transaction id
+
+    Calls for transactions begun while another was in progress on the
+    same connection are made on the ZEOStorage for the transaction.
+    """
+    @functools.wraps(func)
+    def call(self, *args):
+        return func(self.transactions.get(args[-1], self), *args)
+    return call
 
 class ZEOStorage(object):
     """Proxy to underlying storage for a single remote client."""
 
     connected = connection = stats = storage = storage_id = transaction = None
-    blob_tempfile = None
+    blob_tempfile = blob_digest = None
     log_label = 'unconnected'
     locked = False             # Don't have storage lock
     verifying = 0
+    wants_invalidations = True
+    restores_waiting = None # [(transactions, delay)] waiting for the lock
+    owner = None # For a concurrent transaction, the connection's ZEOStorage
+    iterator_timeout = 3600 # Seconds after which idle iterators are discarded
 
     def __init__(self, server, read_only=0):
         self.server = server
@@ -91,6 +118,11 @@ class ZEOStorage(object):
         self.read_only = read_only
         self._iterators = {}
         self._iterator_ids = itertools.count()
+        self._iterators_used = {} # {iid -> time last used}
+        self._restore_blobs = {} # {(oid, serial) -> file name}
+        # ZEOStorages for transactions begun while another was in
+        # progress, shared with them:
+        self.transactions = {} # {id -> ZEOStorage}
         # Stores the last item that was handed out for a
         # transaction iterator.
         self._txn_iterators_last = {}
@@ -117,6 +149,16 @@ class ZEOStorage(object):
         else:
             self.log("disconnected")
 
+        for zs in list(self.transactions.values()):
+            zs.connected = False
+            zs.log("disconnected during %s concurrent transaction"
+                   % (zs.locked and 'locked' or 'unlocked'))
+            zs.tpc_abort(zs.transaction.id)
+
+        for blobfilename in self._restore_blobs.values():
+            ZODB.blob.remove_committed(blobfilename)
+        self._restore_blobs.clear()
+
         self.connected = False
         self.server.close_conn(self)
 
@@ -241,6 +283,16 @@ class ZEOStorage(object):
                 'name': storage.getName(),
                 'supportsUndo': supportsUndo,
                 'supports_record_iternext': hasattr(self, 'record_iternext'),
+                'supports_record_iternext_many':
+                hasattr(self, 'record_iternext'),
+                'supports_restore_transactions': True,
+                'supports_storea_many': True,
+                'supports_blob_ranges': True,
+                'supports_blob_hashes': True,
+                'supports_iterator_batches': True,
+                'supports_vote_and_finish': True,
+                'supports_concurrent_transactions': True,
+                'supports_delta_encoding': True,
                 'interfaces': tuple(interfaces),
                 }
 
@@ -253,14 +305,102 @@ class ZEOStorage(object):
         self.stats.loads += 1
         return self.storage.loadBefore(oid, tid)
 
-    def getInvalidations(self, tid):
+    def loadBefore_delta(self, oid, tid, base_tid):
+        """Load a revision, as a delta if the client has a base for it
+
+        The revision is loaded as for loadBefore.  If the revision
+        written by base_tid can be loaded and a delta against it is
+        smaller than the data, the data record and a delta are
+        returned as None and the delta, otherwise as the data and
+        None.  The start and end tids follow.
+        """
+        result = self.loadBefore(oid, tid)
+        if result is None:
+            return None
+        data, start, end = result
+        delta = None
+        if data is not None:
+            try:
+                base = self.storage.loadSerial(oid, base_tid)
+            except POSKeyError:
+                pass # Packed away.  Send the full record.
+            else:
+                delta = ZEO.delta.encode(base, data)
+                if delta is not None:
+                    data = None
+        return data, delta, start, end
+
+    def record_iternext_many(self, next, count):
+        """Return the results of up to count record_iternext calls
+
+        The first call is passed next, and subsequent calls are passed
+        the next value returned by the previous one.  Fewer results
+        are returned if the last record is reached.
+        """
+        record_iternext = self.record_iternext
+        results = []
+        while len(results) < count:
+            result = record_iternext(next)
+            results.append(result)
+            next = result[3]
+            if next is None:
+                break
+        return results
+
+    def loadBefore_many(self, oids, tid):
+        """Load the revisions of several objects current before tid
+
+        A list of loadBefore results is returned, with None for
+        objects that don't exist.
+        """
+        self.stats.loads += len(oids)
+        loadBefore = self.storage.loadBefore
+        results = []
+        for oid in oids:
+            try:
+                results.append(loadBefore(oid, tid))
+            except POSKeyError:
+                results.append(None)
+        return results
+
+    def skip_invalidations(self):
+        """Stop sending invalidations to the client
+
+        This is used by clients that read a fixed snapshot.
+        """
+        self.wants_invalidations = False
+
+    def getInvalidations(self, tid, cached=None):
         invtid, invlist = self.server.get_invalidations(self.storage_id, tid)
         if invtid is None:
             return None
+        if cached is not None:
+            # The client sent a Bloom filter of the objects it has
+            # cached. It doesn't care about changes to anything else.
+            cached = BloomFilter.from_state(cached)
+            invlist = [oid for oid in invlist if oid in cached]
         self.log("Return %d invalidations up to tid %s"
                  % (len(invlist), u64(invtid)))
         return invtid, invlist
 
+    def getStaleOids(self, pairs):
+        """Return the oids of (oid, tid) pairs whose tids aren't current
+
+        Clients call this to verify their caches when they're too far
+        behind to get invalidations.
+        """
+        getTid = self.storage.getTid
+        stale = []
+        for oid, tid in pairs:
+            try:
+                current = getTid(oid)
+            except KeyError:
+                stale.append(oid)
+            else:
+                if current != tid:
+                    stale.append(oid)
+        return stale
+
     def pack(self, time, wait=1):
         # Yes, you can pack a read-only server or storage!
         if wait:
@@ -282,7 +422,7 @@ class ZEOStorage(object):
 
     def new_oids(self, n=100):
         """Return a sequence of n new oids, where n defaults to 100"""
-        n = min(n, 100)
+        n = min(n, 10000)
         if self.read_only:
             raise ReadOnlyError()
         if n <= 0:
@@ -300,13 +440,18 @@ class ZEOStorage(object):
     def tpc_begin(self, id, user, description, ext, tid=None, status=" "):
         if self.read_only:
             raise ReadOnlyError()
+        if ((self.transaction is not None and self.transaction.id == id)
+            or id in self.transactions):
+            self.log("duplicate tpc_begin(%s)" % repr(id))
+            return
         if self.transaction is not None:
-            if self.transaction.id == id:
-                self.log("duplicate tpc_begin(%s)" % repr(id))
-                return
-            else:
-                raise StorageTransactionError("Multiple simultaneous tpc_begin"
-                                              " requests from one client.")
+            # Another transaction is in progress.  This one gets its
+            # own ZEOStorage.  They're serialized by the storage lock
+            # when they vote.
+            zs = self._transaction_storage()
+            zs.tpc_begin(id, user, description, ext, tid, status)
+            self.transactions[id] = zs
+            return
 
         t = TransactionMetaData(user, description, ext)
         t.id = id
@@ -316,6 +461,7 @@ class ZEOStorage(object):
         self.invalidated = []
         self.txnlog = CommitLog()
         self.blob_log = []
+        self.blob_digests = [] # [(digest, oid)] of blobs sent to us
         self.tid = tid
         self.status = status
         self.stats.active_txns += 1
@@ -330,23 +476,38 @@ class ZEOStorage(object):
         # (Also see https://bugs.launchpad.net/zodb/+bug/374737.)
         self.transaction = t
 
+    def _transaction_storage(self):
+        zs = copy.copy(self)
+        zs.owner = self
+        zs.transaction = None
+        zs.locked = False
+        zs.blob_tempfile = zs.blob_digest = None
+        return zs
+
+    @in_transaction
     def tpc_finish(self, id):
         if not self._check_tid(id):
             return
         assert self.locked, "finished called wo lock"
+        return self._finish()
 
+    def _finish(self):
         self.stats.commits += 1
         self.storage.tpc_finish(self.transaction, self._invalidate)
         self.async_('info', self.get_size_info())
         # Note that the tid is still current because we still hold the
         # commit lock. We'll relinquish it in _clear_transaction.
         tid = self.storage.lastTransaction()
+        for digest, oid in self.blob_digests:
+            self.server.blob_stored(self.storage_id, digest, oid, tid)
         # Return the tid, for cache invalidation optimization
         return Result(tid, self._clear_transaction)
 
     def _invalidate(self, tid):
-        self.server.invalidate(self, self.storage_id, tid, self.invalidated)
+        self.server.invalidate(
+            self.owner or self, self.storage_id, tid, self.invalidated)
 
+    @in_transaction
     def tpc_abort(self, tid):
         if not self._check_tid(tid):
             return
@@ -357,6 +518,7 @@ class ZEOStorage(object):
     def _clear_transaction(self):
         # Common code at end of tpc_finish() and tpc_abort()
         self.lock_manager.release(self)
+        self.transactions.pop(self.transaction.id, None)
         self.transaction = None
         self.stats.active_txns -= 1
         if self.txnlog is not None:
@@ -366,10 +528,32 @@ class ZEOStorage(object):
                 ZODB.blob.remove_committed(blobfilename)
             del self.blob_log
 
+    @in_transaction
     def vote(self, tid):
         self._check_tid(tid, exc=StorageTransactionError)
         return self.lock_manager.lock(self, self._vote)
 
+    @in_transaction
+    def vote_and_finish(self, tid):
+        """Vote on a transaction and finish it if there are no conflicts
+
+        Return a transaction id and the serials returned by vote.  If
+        there were conflicts to be resolved by the client, the
+        transaction id is None, the transaction isn't finished and the
+        serials include the conflicts, as for vote.
+        """
+        self._check_tid(tid, exc=StorageTransactionError)
+        return self.lock_manager.lock(self, self._vote_and_finish)
+
+    def _vote_and_finish(self):
+        serials = self._vote()
+        if not self.locked:
+            return None if serials is None else (None, serials)
+
+        result = self._finish()
+        tid, callback = result.args
+        return Result((tid, serials), callback)
+
     def _vote(self, delay=None):
         # Called from client thread
 
@@ -437,20 +621,57 @@ class ZEOStorage(object):
     # Most of the real implementations are in methods beginning with
     # an _.
 
+    @in_transaction
     def deleteObject(self, oid, serial, id):
         self._check_tid(id, exc=StorageTransactionError)
         self.stats.stores += 1
         self.txnlog.delete(oid, serial)
 
+    @in_transaction
     def storea(self, oid, serial, data, id):
         self._check_tid(id, exc=StorageTransactionError)
         self.stats.stores += 1
         self.txnlog.store(oid, serial, data)
 
+    @in_transaction
+    def storea_delta(self, oid, serial, delta, id):
+        """Store data given as a delta against the revision being replaced
+        """
+        self._check_tid(id, exc=StorageTransactionError)
+        self.stats.stores += 1
+        self.txnlog.store_delta(oid, serial, delta)
+
+    @in_transaction
     def checkCurrentSerialInTransaction(self, oid, serial, id):
         self._check_tid(id, exc=StorageTransactionError)
         self.txnlog.checkread(oid, serial)
 
+    @in_transaction
+    def storea_many(self, messages, id):
+        """Handle a batch of storea, storea_delta, deleteObject and
+        checkCurrentSerialInTransaction messages
+
+        Each message is a method name and arguments, without the
+        transaction id.
+        """
+        self._check_tid(id, exc=StorageTransactionError)
+        txnlog = self.txnlog
+        for name, args in messages:
+            if name == 'storea':
+                self.stats.stores += 1
+                txnlog.store(*args)
+            elif name == 'storea_delta':
+                self.stats.stores += 1
+                txnlog.store_delta(*args)
+            elif name == 'deleteObject':
+                self.stats.stores += 1
+                txnlog.delete(*args)
+            elif name == 'checkCurrentSerialInTransaction':
+                txnlog.checkread(*args)
+            else:
+                raise ValueError("Invalid batched method", name)
+
+    @in_transaction
     def restorea(self, oid, serial, data, prev_txn, id):
         self._check_tid(id, exc=StorageTransactionError)
         self.stats.stores += 1
@@ -460,18 +681,164 @@ class ZEOStorage(object):
         assert self.blob_tempfile is None
         self.blob_tempfile = tempfile.mkstemp(
             dir=self.storage.temporaryDirectory())
+        self.blob_digest = hashlib.sha256()
 
     def storeBlobChunk(self, chunk):
         os.write(self.blob_tempfile[0], chunk)
+        self.blob_digest.update(chunk)
 
+    @in_transaction
     def storeBlobEnd(self, oid, serial, data, id):
         self._check_tid(id, exc=StorageTransactionError)
         assert self.txnlog is not None # effectively not allowed after undo
+        owner = self.owner or self # Blob data go to the connection's
+        fd, tempname = owner.blob_tempfile
+        owner.blob_tempfile = None
+        os.close(fd)
+        self.blob_log.append((oid, serial, data, tempname))
+        self.blob_digests.append((owner.blob_digest.digest(), oid))
+        owner.blob_digest = None
+
+    @in_transaction
+    def storeBlobHash(self, oid, serial, data, digest, id):
+        """Store a blob using data the server already has
+
+        The digest is the SHA-256 hash of the blob data.  If a
+        committed blob with the same hash is known, its data are
+        used and True is returned.  Otherwise, False is returned and
+        the client must send the data.
+        """
+        self._check_tid(id, exc=StorageTransactionError)
+        assert self.txnlog is not None # effectively not allowed after undo
+        blobfilename = self.server.find_blob(self.storage_id, digest)
+        if blobfilename is None:
+            return False
+
+        fd, tempname = tempfile.mkstemp(dir=self.storage.temporaryDirectory())
+        os.close(fd)
+        try:
+            if WIN:
+                shutil.copyfile(blobfilename, tempname)
+            else:
+                os.remove(tempname)
+                try:
+                    os.link(blobfilename, tempname)
+                except OSError:
+                    shutil.copyfile(blobfilename, tempname)
+        except (IOError, OSError):
+            # The blob was probably removed by a pack.
+            logger.debug("Couldn't copy %s", blobfilename, exc_info=True)
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            return False
+
+        self.blob_log.append((oid, serial, data, tempname))
+        return True
+
+    def restoreBlobEnd(self, oid, serial):
+        """Finish receiving the data of a blob to be restored
+
+        The blob is restored with its record by restore_transactions.
+        """
+        if self.read_only:
+            raise ReadOnlyError()
         fd, tempname = self.blob_tempfile
         self.blob_tempfile = None
+        self.blob_digest = None
         os.close(fd)
-        self.blob_log.append((oid, serial, data, tempname))
+        self._restore_blobs[(oid, serial)] = tempname
+
+    def restore_transactions(self, transactions):
+        """Commit transactions copied from another storage
+
+        This is a faster alternative, used by copyTransactionsFrom, to
+        committing transactions one at a time with restore.  Each
+        transaction is given as transaction id, status, user,
+        description, extension and a list of records, each a tuple of
+        oid, serial, data and prev_txn.  Blob data for records must be
+        sent beforehand with storeBlobStart, storeBlobChunk and
+        restoreBlobEnd.
+
+        The transactions are committed back to back while holding the
+        commit lock.  The id of the last transaction committed is
+        returned.  Clients may send more transactions while earlier
+        ones are waiting for the lock.
+        """
+        if self.read_only:
+            raise ReadOnlyError()
+        if self.transaction is not None:
+            raise StorageTransactionError(
+                "Can't restore transactions while committing")
+
+        if self.restores_waiting is not None:
+            # We're already waiting for the lock.
+            delay = Delay()
+            self.restores_waiting.append((transactions, delay))
+            return delay
+
+        self.restores_waiting = []
+        try:
+            return self.lock_manager.lock(
+                self, lambda : self._restore_transactions(transactions))
+        except Exception:
+            self.restores_waiting = None
+            raise
+
+    def _restore_transactions(self, transactions):
+        # Called with the commit lock.  Also commit transactions
+        # received while waiting for it.
+        waiting = self.restores_waiting
+        self.restores_waiting = None
+        if not self.connected:
+            return # We're disconnected
+
+        try:
+            result = self._restore_transactions_now(transactions)
+        except Exception:
+            for transactions, delay in waiting:
+                delay.error(sys.exc_info())
+            raise
+
+        for i, (transactions, delay) in enumerate(waiting):
+            try:
+                delay.reply(self._restore_transactions_now(transactions))
+            except Exception:
+                for transactions, delay in waiting[i:]:
+                    delay.error(sys.exc_info())
+                break
+
+        self.async_('info', self.get_size_info())
+        return result
+
+    def _restore_transactions_now(self, transactions):
+        storage = self.storage
+        for tid, status, user, description, ext, records in transactions:
+            transaction = TransactionMetaData(user, description, ext)
+            storage.tpc_begin(transaction, tid, status)
+            try:
+                oids = []
+                for oid, serial, data, prev_txn in records:
+                    blobfilename = self._restore_blobs.pop((oid, serial), None)
+                    if blobfilename is None:
+                        storage.restore(oid, serial, data, '', prev_txn,
+                                        transaction)
+                    else:
+                        storage.restoreBlob(oid, serial, data, blobfilename,
+                                            prev_txn, transaction)
+                    oids.append(oid)
+                storage.tpc_vote(transaction)
+                storage.tpc_finish(
+                    transaction,
+                    lambda tid: self.server.invalidate(
+                        None, self.storage_id, tid, oids))
+            except Exception:
+                storage.tpc_abort(transaction)
+                raise
+            self.stats.stores += len(records)
+            self.stats.commits += 1
+        return storage.lastTransaction()
 
+    @in_transaction
     def storeBlobShared(self, oid, serial, data, filename, id):
         self._check_tid(id, exc=StorageTransactionError)
         assert self.txnlog is not None # effectively not allowed after undo
@@ -506,9 +873,22 @@ class ZEOStorage(object):
 
         self.connection.call_async_iter(store())
 
+    def loadBlobRange(self, oid, serial, offset, size):
+        """Return the size of a blob and up to size bytes of its data
+
+        The data are read starting at offset.
+        """
+        blobfilename = self.storage.loadBlob(oid, serial)
+        with open(blobfilename, 'rb') as f:
+            f.seek(0, 2)
+            blob_size = f.tell()
+            f.seek(offset)
+            return blob_size, f.read(size)
+
     def undo(*a, **k):
         raise NotImplementedError
 
+    @in_transaction
     def undoa(self, trans_id, tid):
         self._check_tid(tid, exc=StorageTransactionError)
         self.txnlog.undo(trans_id)
@@ -540,6 +920,17 @@ class ZEOStorage(object):
             if serial != b"\0\0\0\0\0\0\0\0":
                 self.invalidated.append(oid)
 
+    def _store_delta(self, oid, serial, delta):
+        try:
+            base = self.storage.loadSerial(oid, serial)
+        except POSKeyError:
+            # Current revisions aren't packed away, so the store
+            # would have conflicted, and the conflict couldn't be
+            # resolved without the old revision.
+            raise ConflictError("Delta base revision is no longer available",
+                                oid=oid)
+        self._store(oid, serial, ZEO.delta.decode(base, delta))
+
     def _restore(self, oid, serial, data, prev_txn):
         self.storage.restore(oid, serial, data, '', prev_txn,
                              self.transaction)
@@ -551,20 +942,40 @@ class ZEOStorage(object):
 
     # IStorageIteration support
 
+    def _expire_iterators(self):
+        # Discard iterators clients seem to have forgotten about.
+        now = time.time()
+        for iid, used in list(self._iterators_used.items()):
+            if now - used > self.iterator_timeout:
+                self._forget_iterator(iid)
+
+    def _forget_iterator(self, iid):
+        iterator = self._iterators.pop(iid, None)
+        close = getattr(iterator, 'close', None)
+        if close is not None:
+            close() # e.g. FileStorage iterators have open files
+        self._iterators_used.pop(iid, None)
+        self._txn_iterators_last.pop(iid, None)
+
+    def _get_iterator(self, iid):
+        iterator = self._iterators[iid]
+        self._iterators_used[iid] = time.time()
+        return iterator
+
     def iterator_start(self, start, stop):
+        self._expire_iterators()
         iid = next(self._iterator_ids)
         self._iterators[iid] = iter(self.storage.iterator(start, stop))
+        self._iterators_used[iid] = time.time()
         return iid
 
     def iterator_next(self, iid):
-        iterator = self._iterators[iid]
+        iterator = self._get_iterator(iid)
         try:
             info = next(iterator)
         except StopIteration:
-            del self._iterators[iid]
+            self._forget_iterator(iid)
             item = None
-            if iid in self._txn_iterators_last:
-                del self._txn_iterators_last[iid]
         else:
             item = (info.tid,
                     info.status,
@@ -576,7 +987,42 @@ class ZEOStorage(object):
             self._txn_iterators_last[iid] = info
         return item
 
+    def iterator_next_many(self, iid, size):
+        """Return transactions, with their data records, from an iterator
+
+        Transactions are returned as tuples of transaction id, status,
+        user, description, extension and a list of data records, each
+        a tuple of oid, tid, data and data_txn.  Whole transactions
+        are returned until their data total at least size bytes.  When
+        the iterator is exhausted, the list ends with None and the
+        iterator is discarded.
+        """
+        iterator = self._get_iterator(iid)
+        transactions = []
+        nbytes = 0
+        for info in iterator:
+            records = []
+            for record in info:
+                records.append((record.oid,
+                                record.tid,
+                                record.data,
+                                record.data_txn))
+                nbytes += len(record.data or b'')
+            transactions.append((info.tid,
+                                 info.status,
+                                 info.user,
+                                 info.description,
+                                 info.extension,
+                                 records))
+            if nbytes >= size:
+                break
+        else:
+            self._forget_iterator(iid)
+            transactions.append(None)
+        return transactions
+
     def iterator_record_start(self, txn_iid, tid):
+        self._expire_iterators()
         record_iid = next(self._iterator_ids)
         txn_info = self._txn_iterators_last[txn_iid]
         if txn_info.tid != tid:
@@ -584,14 +1030,15 @@ class ZEOStorage(object):
                 'Out-of-order request for record iterator for transaction %r'
                 % tid)
         self._iterators[record_iid] = iter(txn_info)
+        self._iterators_used[record_iid] = time.time()
         return record_iid
 
     def iterator_record_next(self, iid):
-        iterator = self._iterators[iid]
+        iterator = self._get_iterator(iid)
         try:
             info = next(iterator)
         except StopIteration:
-            del self._iterators[iid]
+            self._forget_iterator(iid)
             item = None
         else:
             item = (info.oid,
@@ -602,7 +1049,7 @@ class ZEOStorage(object):
 
     def iterator_gc(self, iids):
         for iid in iids:
-            self._iterators.pop(iid, None)
+            self._forget_iterator(iid)
 
     def server_status(self):
         return self.server.server_status(self.storage_id)
@@ -731,6 +1178,9 @@ class StorageServer(object):
 
         self.zeo_storages_by_storage_id = {} # {storage_id -> [ZEOStorage]}
         self.lock_managers = {} # {storage_id -> LockManager}
+        # {storage_id -> {digest -> (oid, tid)}} of recently stored blobs:
+        self.blob_hashes = {}
+        self._blob_hashes_lock = Lock()
         self.stats = {} # {storage_id -> StorageStats}
         for name, storage in storages.items():
             self._setup_invq(name, storage)
@@ -740,6 +1190,7 @@ class StorageServer(object):
                 # configuration for this.
                 storage.tryToResolveConflict = never_resolve_conflict
             self.zeo_storages_by_storage_id[name] = []
+            self.blob_hashes[name] = collections.OrderedDict()
             self.stats[name] = stats = StorageStats(
                 self.zeo_storages_by_storage_id[name])
             if transaction_timeout is None:
@@ -795,6 +1246,36 @@ class StorageServer(object):
         self.zeo_storages_by_storage_id[storage_id].append(zeo_storage)
         return self.stats[storage_id]
 
+    blob_hashes_size = 100000
+
+    def blob_stored(self, storage_id, digest, oid, tid):
+        """Internal: remember the hash of a committed blob
+
+        At most blob_hashes_size hashes are kept for each storage.
+        """
+        with self._blob_hashes_lock:
+            hashes = self.blob_hashes[storage_id]
+            hashes.pop(digest, None)
+            hashes[digest] = oid, tid
+            while len(hashes) > self.blob_hashes_size:
+                hashes.popitem(False)
+
+    def find_blob(self, storage_id, digest):
+        """Internal: find the file of a committed blob given its hash
+
+        None is returned if the blob isn't known or no longer exists.
+        """
+        with self._blob_hashes_lock:
+            found = self.blob_hashes[storage_id].get(digest)
+        if found is None:
+            return None
+        try:
+            return self.storages[storage_id].loadBlob(*found)
+        except POSKeyError:
+            with self._blob_hashes_lock:
+                self.blob_hashes[storage_id].pop(digest, None)
+            return None
+
     def _invalidateCache(self, storage_id):
         """We need to invalidate any caches we have.
 
@@ -833,7 +1314,7 @@ class StorageServer(object):
         invq.insert(0, (tid, invalidated))
 
         for zs in self.zeo_storages_by_storage_id[storage_id]:
-            if zs is not zeo_storage:
+            if zs is not zeo_storage and zs.wants_invalidations:
                 zs.async_threadsafe('invalidateTransaction', tid, invalidated)
 
     def broadcast_info(self, storage_id, info):
@@ -1090,6 +1571,10 @@ class CommitLog(object):
         self.pickler.dump(('_store', (oid, serial, data)))
         self.stores += 1
 
+    def store_delta(self, oid, serial, delta):
+        self.pickler.dump(('_store_delta', (oid, serial, delta)))
+        self.stores += 1
+
     def restore(self, oid, serial, data, prev_txn):
         self.pickler.dump(('_restore', (oid, serial, data, prev_txn)))
         self.stores += 1
@@ -1192,7 +1677,13 @@ class LockManager(object):
                 delay.error(sys.exc_info())
                 self.release(zs)
             else:
-                delay.reply(result)
+                if isinstance(result, Result):
+                    # Reply before calling back, as the protocol would.
+                    result, callback = result.args
+                    delay.reply(result)
+                    callback()
+                else:
+                    delay.reply(result)
                 if not zs.locked:
                     self.release(zs)
 
@@ -15,48 +15,83 @@
 
 A transaction may generate enough data that it is not practical to
 always hold pending updates in memory.  Instead, a TransactionBuffer
-is used to store the data until a commit or abort.
+is used to store the data until a commit or abort.  Small transactions
+are held in memory. Once the data exceeds a size limit, it is written
+to a temporary file.
 """
 
-# A faster implementation might store trans data in memory until it
-# reaches a certain size.
-
-import os
+import struct
 import tempfile
-import ZODB.blob
 
-from ZEO._compat import Pickler, Unpickler
+record_header = struct.Struct(">HI")
+none_size = 0xffffffff # Data size used for None (deleted) records
 
 class TransactionBuffer(object):
 
     # The TransactionBuffer is used by client storage to hold update
     # data until the tpc_finish().  It is only used by a single
-    # thread, because only one thread can be in the two-phase commit
-    # at one time.
+    # thread, the one committing the transaction.
 
-    def __init__(self, connection_generation):
+    def __init__(self, connection_generation, memory_size=1<<20):
         self.connection_generation = connection_generation
-        self.file = tempfile.TemporaryFile(suffix=".tbuf")
+        self.memory_size = memory_size
+        self.records = [] # [(oid, data)] until we spill to file
+        self.file = None
         self.count = 0
         self.size = 0
         self.blobs = []
-        # It's safe to use a fast pickler because the only objects
-        # stored are builtin types -- strings or None.
-        self.pickler = Pickler(self.file, 1)
-        self.pickler.fast = 1
+        self.messages = [] # Store messages waiting to be sent in a batch
+        self.messages_size = 0
         self.server_resolved = set() # {oid}
         self.client_resolved = {} # {oid -> buffer_record_number}
         self.exception = None
+        self.tid = None # Set if the transaction was finished when voting
+        self.commit_lock = None # Held by the transaction if set
 
     def close(self):
-        self.file.close()
+        self.records = None
+        if self.file is not None:
+            self.file.close()
 
     def store(self, oid, data):
         """Store oid, version, data for later retrieval"""
-        self.pickler.dump((oid, data))
+        if self.file is None:
+            self.records.append((oid, data))
+        else:
+            self._write(oid, data)
         self.count += 1
         # Estimate per-record cache size
         self.size = self.size + (data and len(data) or 0) + 31
+        if self.file is None and self.size > self.memory_size:
+            self._spill()
+
+    def _spill(self):
+        self.file = tempfile.TemporaryFile(suffix=".tbuf")
+        for oid, data in self.records:
+            self._write(oid, data)
+        self.records = None
+
+    def _write(self, oid, data):
+        # Records are written without pickling, as a header giving
+        # the oid and data sizes, followed by the oid and data.
+        if data is None:
+            self.file.write(record_header.pack(len(oid), none_size) + oid)
+        else:
+            self.file.write(record_header.pack(len(oid), len(data)) + oid)
+            self.file.write(data)
+
+    def _read(self):
+        file = self.file
+        file.seek(0)
+        header_size = record_header.size
+        for i in range(self.count):
+            oid_size, data_size = record_header.unpack(file.read(header_size))
+            oid = file.read(oid_size)
+            if data_size == none_size:
+                data = None
+            else:
+                data = file.read(data_size)
+            yield oid, data
 
     def resolve(self, oid, data):
         """Record client-resolved data
@@ -71,8 +106,7 @@ class TransactionBuffer(object):
         self.blobs.append((oid, blobfilename))
 
     def __iter__(self):
-        self.file.seek(0)
-        unpickler = Unpickler(self.file)
+        records = self.records if self.file is None else self._read()
         server_resolved = self.server_resolved
         client_resolved = self.client_resolved
 
@@ -82,8 +116,7 @@ class TransactionBuffer(object):
         # it may be a feature later.
 
         seen = set()
-        for i in range(self.count):
-            oid, data = unpickler.load()
+        for i, (oid, data) in enumerate(records):
             if client_resolved.get(oid, i) == i:
                 seen.add(oid)
                 yield oid, data, oid in server_resolved
@@ -9,11 +9,15 @@ import logging
 import socket
 from struct import unpack
 import sys
+import zlib
 
 logger = logging.getLogger(__name__)
 
 INET_FAMILIES = socket.AF_INET, socket.AF_INET6
 
+# Set in message size headers for compressed messages:
+COMPRESSED = 0x80000000
+
 class Protocol(asyncio.Protocol):
     """asyncio low-level ZEO base interface
     """
@@ -27,12 +31,23 @@ class Protocol(asyncio.Protocol):
 
     transport = protocol_version = None
 
+    # Messages smaller than this aren't compressed:
+    compress_threshold = 1000
+
+    # Compression is done in the networking thread, which may be
+    # shared by many clients, so favor speed over size:
+    compress_level = 1
+
+    # Bytes not sent or received because of compression:
+    bytes_saved_sending = bytes_saved_receiving = 0
+
     def __init__(self, loop, addr):
         self.loop = loop
         self.addr = addr
         self.input  = [] # Input buffer when assembling messages
         self.output = [] # Output buffer when paused
         self.paused = [] # Paused indicator, mutable to avoid attr lookup
+        self.compressing = [] # Set when compression has been negotiated
 
         # Handle the first message, the protocol handshake, differently
         self.message_received = self.first_message_received
@@ -64,11 +79,27 @@ class Protocol(asyncio.Protocol):
         writelines = transport.writelines
         from struct import pack
 
+        compressing = self.compressing
+        compress = zlib.compress
+        compress_level = self.compress_level
+
+        def frame(message):
+            # Return the size header and message data to be written
+            if compressing and len(message) >= self.compress_threshold:
+                compressed = compress(message, compress_level)
+                saved = len(message) - len(compressed)
+                if saved > 0:
+                    self.bytes_saved_sending += saved
+                    return pack(">I", len(compressed) | COMPRESSED), compressed
+            return pack(">I", len(message)), message
+
+        self._frame = frame
+
         def write(message):
             if paused:
                 append(message)
             else:
-                writelines((pack(">I", len(message)), message))
+                writelines(frame(message))
 
         self._write = write
 
@@ -78,16 +109,27 @@ class Protocol(asyncio.Protocol):
             # messages will be big to begin with.
             data = iter(data)
             for message in data:
-                writelines((pack(">I", len(message)), message))
+                writelines(frame(message))
                 if paused:
                     append(data)
                     break
 
         self._writeit = writeit
 
+    def start_compressing(self):
+        """Compress large messages from now on
+
+        This is called once both sides have agreed on a protocol that
+        supports compression. Compressed messages are flagged in their
+        size headers, so they can be received at any time.
+        """
+        if not self.compressing:
+            self.compressing.append(1)
+
     got = 0
     want = 4
     getting_size = True
+    compressed = False
     def data_received(self, data):
 
         # Low-level input handler collects data into sized messages.
@@ -120,11 +162,20 @@ class Protocol(asyncio.Protocol):
                 if self.getting_size:
                     # we were recieving the message size
                     assert self.want == 4
-                    self.want = unpack(">I", collected)[0]
+                    want = unpack(">I", collected)[0]
+                    if want & COMPRESSED:
+                        want &= ~COMPRESSED
+                        self.compressed = True
+                    self.want = want
                     self.getting_size = False
                 else:
                     self.want = 4
                     self.getting_size = True
+                    if self.compressed:
+                        self.compressed = False
+                        size = len(collected)
+                        collected = zlib.decompress(collected)
+                        self.bytes_saved_receiving += len(collected) - size
                     self.message_received(collected)
             except Exception:
                 logger.exception("data_received %s %s %s",
@@ -150,15 +201,15 @@ class Protocol(asyncio.Protocol):
         del paused[:]
         output = self.output
         writelines = self.transport.writelines
-        from struct import pack
+        frame = self._frame
         while output and not paused:
             message = output.pop(0)
             if isinstance(message, bytes):
-                writelines((pack(">I", len(message)), message))
+                writelines(frame(message))
             else:
                 data = message
                 for message in data:
-                    writelines((pack(">I", len(message)), message))
+                    writelines(frame(message))
                     if paused: # paused again. Put iter back.
                         output.insert(0, data)
                         break
@@ -1,16 +1,24 @@
 from ZEO.Exceptions import ClientDisconnected, ServerException
+import collections
 import concurrent.futures
 import functools
+import itertools
 import logging
 import random
+from struct import pack, unpack
 import threading
+import time
 
 import ZODB.event
 import ZODB.POSException
 
 import ZEO.Exceptions
+import ZEO.delta
 import ZEO.interfaces
 
+from ZEO.bloom import BloomFilter
+from ZEO.metrics import ClientMetrics
+
 from . import base
 from .compat import asyncio, new_event_loop
 from .marshal import encoder, decoder
@@ -19,6 +27,21 @@ logger = logging.getLogger(__name__)
 
 Fallback = object()
 
+class ConnectionLost(ClientDisconnected):
+    """The connection was lost before a request was answered
+
+    The server may or may not have handled the request.
+    """
+
+# Server methods that only read data, so requests lost with a
+# connection can be sent again when we reconnect:
+idempotent_methods = frozenset((
+    'loadBefore', 'loadBefore_many', 'loadBefore_delta', 'loadSerial',
+    'history', 'getTid', 'lastTransaction', 'ping', 'record_iternext',
+    'record_iternext_many', 'undoInfo', 'undoLog', 'loadBlobRange',
+    'server_status',
+    ))
+
 local_random = random.Random() # use separate generator to facilitate tests
 
 def future_generator(func):
@@ -63,7 +86,7 @@ class Protocol(base.Protocol):
     # One place where special care was required was in cache setup on
     # connect. See finish connect below.
 
-    protocols = b'309', b'310', b'3101', b'4', b'5'
+    protocols = b'309', b'310', b'3101', b'4', b'5', b'51'
 
     def __init__(self, loop,
                  addr, client, storage_key, read_only, connect_poll=1,
@@ -83,9 +106,12 @@ class Protocol(base.Protocol):
         self.name = "%s(%r, %r, %r)" % (
             self.__class__.__name__, addr, storage_key, read_only)
         self.client = client
+        self.metrics = client.metrics
         self.connect_poll = connect_poll
         self.heartbeat_interval = heartbeat_interval
         self.futures = {} # { message_id -> future }
+        self.started = {} # { message_id -> (method, start time, count) }
+        self.syncs = [] # [(requests sent, future)] waiting for a reply
         self.ssl = ssl
         self.ssl_server_hostname = ssl_server_hostname
         self.credentials = credentials
@@ -106,7 +132,10 @@ class Protocol(base.Protocol):
         # will finalize them in some way and callbacks may modify
         # self.futures.
         futures = list(self.futures.values())
+        futures.extend(future for (_, future) in self.syncs)
         self.futures.clear()
+        self.started.clear()
+        del self.syncs[:]
         return futures
 
     def protocol_factory(self):
@@ -140,19 +169,25 @@ class Protocol(base.Protocol):
         super(Protocol, self).connection_made(transport)
         self.heartbeat(write=False)
 
+    heartbeat_handle = None
+
     def connection_lost(self, exc):
         logger.debug('connection_lost %r', exc)
-        self.heartbeat_handle.cancel()
+        if self.heartbeat_handle is not None:
+            self.heartbeat_handle.cancel()
         if self.closed:
             for f in self.pop_futures():
                 f.cancel()
         else:
             # We have to be careful processing the futures, because
-            # exception callbacks might modufy them.
-            for f in self.pop_futures():
-                f.set_exception(ClientDisconnected(exc or 'connection lost'))
+            # exception callbacks might modufy them.  They're failed
+            # after the client knows we're disconnected, so requests
+            # sent again wait for a new connection.
+            futures = self.pop_futures()
             self.closed = True
             self.client.disconnected(self)
+            for f in futures:
+                f.set_exception(ConnectionLost(exc or 'connection lost'))
 
     @future_generator
     def finish_connect(self, protocol_version):
@@ -165,19 +200,9 @@ class Protocol(base.Protocol):
         # lastTid before processing (and possibly missing) subsequent
         # invalidations.
 
-        version = min(protocol_version[1:], self.protocols[-1])
-        if version not in self.protocols:
-            self.client.register_failed(
-                self, ZEO.Exceptions.ProtocolError(protocol_version))
+        if not self.handshake(protocol_version):
             return
 
-        self.protocol_version = protocol_version[:1] + version
-        self.encode = encoder(protocol_version)
-        self.decode = decoder(protocol_version)
-        self.heartbeat_bytes = self.encode(-1, 0, '.reply', None)
-
-        self._write(self.protocol_version)
-
         credentials = (self.credentials,) if self.credentials else ()
 
         try:
@@ -201,11 +226,36 @@ class Protocol(base.Protocol):
         else:
             self.client.registered(self, server_tid)
 
+    def handshake(self, protocol_version):
+        # Agree on a protocol version with the server.  Return
+        # whether we could.
+        version = min(protocol_version[1:], self.protocols[-1])
+        if version not in self.protocols:
+            self.client.register_failed(
+                self, ZEO.Exceptions.ProtocolError(protocol_version))
+            return False
+
+        self.protocol_version = protocol_version[:1] + version
+        self.encode = encoder(protocol_version)
+        self.decode = decoder(protocol_version)
+        self.heartbeat_bytes = self.encode(-1, 0, '.reply', None)
+
+        self._write(self.protocol_version)
+        if version >= b'51':
+            self.start_compressing()
+        return True
+
     exception_type_type = type(Exception)
     def message_received(self, data):
         msgid, async_, name, args = self.decode(data)
         if name == '.reply':
             future = self.futures.pop(msgid)
+            started = self.started.pop(msgid, None)
+            if started is not None:
+                method, start, count = started
+                self.metrics.called(method, time.time() - start)
+                if self.syncs:
+                    self.synced(count)
             if async_: # ZEO 5 exception
                 class_, args = args
                 factory = exc_factories.get(class_)
@@ -238,26 +288,70 @@ class Protocol(base.Protocol):
                 raise AttributeError(name)
 
     message_id = 0
+    requests_sent = 0
     def call(self, future, method, args):
         self.message_id += 1
+        self.requests_sent += 1
         self.futures[self.message_id] = future
+        self.started[self.message_id] = (
+            method, time.time(), self.requests_sent)
         self._write(self.encode(self.message_id, False, method, args))
         return future
 
     def fut(self, method, *args):
         return self.call(Fut(), method, args)
 
-    def load_before(self, oid, tid):
+    def load_before(self, oid, tid, base_tid=None):
         # Special-case loadBefore, so we collapse outstanding requests
-        message_id = (oid, tid)
+        # If base_tid is given, the revision may be sent as a delta
+        # against the revision it wrote, as for loadBefore_delta.
+        if base_tid is None:
+            method = 'loadBefore'
+            message_id = (oid, tid)
+        else:
+            method = 'loadBefore_delta'
+            message_id = (oid, tid, base_tid)
         future = self.futures.get(message_id)
         if future is None:
             future = asyncio.Future(loop=self.loop)
             self.futures[message_id] = future
-            self._write(
-                self.encode(message_id, False, 'loadBefore', (oid, tid)))
+            self.requests_sent += 1
+            self.started[message_id] = (
+                method, time.time(), self.requests_sent)
+            self._write(self.encode(message_id, False, method, message_id))
         return future
 
+    def sync(self, future):
+        """Set the future's result when we've caught up with the server
+
+        That's when we get a reply to a request sent after this is
+        called, because the server sends invalidations for the
+        transactions committed before it handles a request before its
+        reply.  The reply to any request will do.  If none is sent
+        right away, we ping the server, so syncs made at about the same
+        time share a request.
+        """
+        self.syncs.append((self.requests_sent, future))
+        if not self.sync_ping_scheduled:
+            self.sync_ping_scheduled = True
+            self.loop.call_soon(self._sync_ping)
+
+    sync_ping_scheduled = False
+    def _sync_ping(self):
+        self.sync_ping_scheduled = False
+        if self.syncs and self.syncs[-1][0] == self.requests_sent:
+            # No request was sent since the last sync.  (We don't
+            # care about the result, just that we got one.)
+            self.fut('ping' if self.protocol_version[1:] >= b'5'
+                     else 'lastTransaction',
+                     ).add_done_callback(lambda future: None)
+
+    def synced(self, count):
+        # We got a reply to the count-th request sent.
+        syncs = self.syncs
+        while syncs and syncs[0][0] < count:
+            syncs.pop(0)[1].set_result(None)
+
     # Methods called by the server.
     # WARNING WARNING we can't call methods that call back to us
     # syncronously, as that would lead to DEADLOCK!
@@ -275,6 +369,227 @@ class Protocol(base.Protocol):
         self.heartbeat_handle = self.loop.call_later(
             self.heartbeat_interval, self.heartbeat)
 
+class ChannelProtocol(Protocol):
+    """A client storage's connection to a server, multiplexed
+
+    The storage's messages are sent over a connection to the server
+    shared with other client storages in the same event loop, as a
+    channel of a MultiplexedConnection.
+    """
+
+    mux = channel_id = None
+
+    def __init__(self, *args, **kw):
+        self.multiplexer = kw.pop('multiplexer')
+        super(ChannelProtocol, self).__init__(*args, **kw)
+
+    def connect(self):
+        self.multiplexer.attach(self)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            if self.mux is not None:
+                self.mux.detach(self)
+            for future in self.pop_futures():
+                future.set_exception(ClientDisconnected("Closed"))
+
+    def channel_made(self, mux, channel_id):
+        # Called by the shared connection when the channel is opened.
+        self.mux = mux
+        self.channel_id = channel_id
+        self.transport = mux.transport
+        prefix = pack(">I", channel_id)
+        write = mux._write
+        writeit = mux._writeit
+        self._write = lambda message: write(prefix + message)
+        self._writeit = lambda data: writeit(
+            prefix + message for message in data)
+        del self.message_received # The handshake was done
+        logger.info("Connected %s", self)
+        self.finish_connect(mux.protocol_version)
+
+    def handshake(self, protocol_version):
+        # The shared connection did the handshake.
+        mux = self.mux
+        self.protocol_version = mux.protocol_version
+        self.encode = mux.encode
+        self.decode = mux.decode
+        return True
+
+    def heartbeat(self, write=True):
+        pass # The shared connection sends heartbeats
+
+class MultiplexedConnection(base.Protocol):
+    """A connection to a server shared by several client storages
+
+    Each storage's messages are sent and received on a channel,
+    identified by a number prefixed to them.  See
+    ZEO.asyncio.server.ServerProtocol.
+    """
+
+    protocols = b'52',
+
+    def __init__(self, multiplexer, key, loop, connect_poll=1,
+                 heartbeat_interval=60):
+        addr, self.ssl, self.ssl_server_hostname = key
+        super(MultiplexedConnection, self).__init__(loop, addr)
+        self.multiplexer = multiplexer
+        self.key = key
+        self.name = "%s(%r)" % (self.__class__.__name__, addr)
+        self.connect_poll = connect_poll
+        self.heartbeat_interval = heartbeat_interval
+        self.channels = {} # {channel id -> ChannelProtocol}
+        self.waiting = [] # channels waiting to be opened
+        self.channel_ids = itertools.count(1)
+        self.connect()
+
+    ready = False
+    heartbeat_handle = None
+
+    def connect(self):
+        if isinstance(self.addr, tuple):
+            host, port = self.addr
+            cr = self.loop.create_connection(
+                lambda: self, host or '127.0.0.1', port,
+                ssl=self.ssl, server_hostname=self.ssl_server_hostname)
+        else:
+            cr = self.loop.create_unix_connection(
+                lambda: self, self.addr, ssl=self.ssl)
+
+        self._connecting = cr = asyncio.ensure_future(cr, loop=self.loop)
+
+        @cr.add_done_callback
+        def done_connecting(future):
+            if future.exception() is not None:
+                logger.info("Connection to %r failed, retrying, %s",
+                            self.addr, future.exception())
+                if not self.closed:
+                    self.loop.call_later(
+                        self.connect_poll + local_random.random(),
+                        self.connect,
+                        )
+
+    def connection_made(self, transport):
+        super(MultiplexedConnection, self).connection_made(transport)
+        self.heartbeat(write=False)
+
+    def finish_connect(self, protocol_version):
+        version = protocol_version[1:]
+        if version < self.protocols[0]:
+            # The storages need connections of their own.
+            logger.info("%s can't multiplex, connecting storages separately",
+                        self)
+            self.multiplexer.unsupported.add(self.key)
+            self.close()
+            return
+
+        version = min(version, self.protocols[-1])
+        self.protocol_version = protocol_version[:1] + version
+        self.encode = encoder(protocol_version)
+        self.decode = decoder(protocol_version)
+        self.heartbeat_bytes = pack(">I", 0) + self.encode(
+            -1, 0, '.reply', None)
+        self._write(self.protocol_version)
+        self.start_compressing()
+        self.ready = True
+        self.open_waiting()
+
+    def attach(self, channel):
+        channel.mux = self
+        self.waiting.append(channel)
+        if self.ready:
+            self.loop.call_soon(self.open_waiting)
+
+    def open_waiting(self):
+        waiting, self.waiting = self.waiting, []
+        for channel in waiting:
+            if not channel.closed:
+                channel_id = next(self.channel_ids)
+                self.channels[channel_id] = channel
+                channel.channel_made(self, channel_id)
+
+    def detach(self, channel):
+        if channel in self.waiting:
+            self.waiting.remove(channel)
+        if self.channels.get(channel.channel_id) is channel:
+            del self.channels[channel.channel_id]
+            if self.ready and not self.closed:
+                self._write(pack(">I", channel.channel_id)) # close it
+        if not (self.channels or self.waiting):
+            self.close()
+
+    def message_received(self, message):
+        channel_id, = unpack(">I", message[:4])
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            return # We closed it
+        if len(message) == 4:
+            # The server closed the channel.
+            del self.channels[channel_id]
+            channel.connection_lost(None)
+        else:
+            channel.message_received(message[4:])
+
+    def heartbeat(self, write=True):
+        if write:
+            self._write(self.heartbeat_bytes)
+        self.heartbeat_handle = self.loop.call_later(
+            self.heartbeat_interval, self.heartbeat)
+
+    def _forget(self):
+        if self.multiplexer.connections.get(self.key) is self:
+            del self.multiplexer.connections[self.key]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._forget()
+            self._connecting.cancel()
+            if self.heartbeat_handle is not None:
+                self.heartbeat_handle.cancel()
+            if self.transport is not None:
+                self.transport.close()
+            else:
+                self.channels_lost(None)
+
+    def connection_lost(self, exc):
+        logger.debug('connection_lost %r %r', self, exc)
+        self.closed = True
+        self._forget()
+        if self.heartbeat_handle is not None:
+            self.heartbeat_handle.cancel()
+        self.channels_lost(exc)
+
+    def channels_lost(self, exc):
+        channels = list(self.channels.values()) + self.waiting
+        self.channels.clear()
+        del self.waiting[:]
+        for channel in channels:
+            channel.connection_lost(exc)
+
+class Multiplexer(object):
+    """Connections to servers shared by the clients in an event loop
+
+    There's one connection for each server address, SSL context and
+    host name.
+    """
+
+    def __init__(self):
+        self.connections = {} # {key -> MultiplexedConnection}
+        self.unsupported = set() # keys of servers that can't multiplex
+
+    def supports(self, addr, ssl, ssl_server_hostname):
+        return (addr, ssl, ssl_server_hostname) not in self.unsupported
+
+    def attach(self, channel):
+        key = channel.addr, channel.ssl, channel.ssl_server_hostname
+        connection = self.connections.get(key)
+        if connection is None:
+            connection = self.connections[key] = MultiplexedConnection(
+                self, key, channel.loop, channel.connect_poll)
+        connection.attach(channel)
+
 def create_Exception(class_, args):
     return exc_classes[class_](*args)
 
@@ -339,11 +654,16 @@ class Client(object):
     protocol = None
     ready = None # Tri-value: None=Never connected, True=connected,
                  # False=Disconnected
+    # Whether to ask for loads as deltas against non-current cached
+    # revisions.  Set by the client storage when it's connected.
+    delta_encoding = False
 
     def __init__(self, loop,
                  addrs, client, cache, storage_key, read_only, connect_poll,
                  register_failed_poll=9,
-                 ssl=None, ssl_server_hostname=None, credentials=None):
+                 ssl=None, ssl_server_hostname=None, credentials=None,
+                 drop_cache_rather_verify=True, metrics=None,
+                 invalidations=True, multiplexer=None):
         """Create a client interface
 
         addr is either a host,port tuple or a string file name.
@@ -351,6 +671,23 @@ class Client(object):
         client is a ClientStorage. It must be thread safe.
 
         cache is a ZEO.interfaces.IClientCache.
+
+        If drop_cache_rather_verify is false, and the server can't
+        send invalidations since the cache was last updated, the
+        cache contents are verified in the background, rather than
+        dropped.
+
+        metrics is a ZEO.metrics.ClientMetrics used to record call
+        times and other statistics.  One is created if not given.
+
+        If invalidations is false, the server is asked not to send
+        invalidations, any it sends are ignored and the cache isn't
+        verified when connecting.  This is for clients that only
+        read data as of a fixed transaction, which can't become stale.
+
+        If a multiplexer is given, it's a Multiplexer used to share
+        connections to servers with other clients in the same event
+        loop, for servers that support it.
         """
         self.loop = loop
         self.addrs = addrs
@@ -362,6 +699,15 @@ class Client(object):
         self.ssl = ssl
         self.ssl_server_hostname = ssl_server_hostname
         self.credentials = credentials
+        self.drop_cache_rather_verify = drop_cache_rather_verify
+        self.invalidations = invalidations
+        self.multiplexer = multiplexer
+        if metrics is None:
+            metrics = ClientMetrics()
+        self.metrics = metrics
+        metrics.requests_in_flight = self.requests_in_flight
+        if metrics.log_interval:
+            loop.call_later(metrics.log_interval, self.log_metrics)
         for name in Protocol.client_delegated:
             setattr(self, name, getattr(client, name))
         self.cache = cache
@@ -398,6 +744,15 @@ class Client(object):
             self.cache.close()
             self._clear_protocols()
 
+    def requests_in_flight(self):
+        protocol = self.protocol
+        return len(protocol.futures) if protocol is not None else 0
+
+    def log_metrics(self):
+        if not self.closed:
+            self.metrics.log(getattr(self.client, '__name__', ''))
+            self.loop.call_later(self.metrics.log_interval, self.log_metrics)
+
     def _clear_protocols(self, protocol=None):
         for p in self.protocols:
             if p is not protocol:
@@ -409,6 +764,8 @@ class Client(object):
         if protocol is None or protocol is self.protocol:
             if protocol is self.protocol and protocol is not None:
                 self.client.notify_disconnected()
+                self.count_bytes_saved(protocol)
+                self.metrics.disconnected()
             if self.ready:
                 self.ready = False
             self.connected = concurrent.futures.Future()
@@ -422,21 +779,51 @@ class Client(object):
         self.ready = False
         self.connected = concurrent.futures.Future()
         self.protocol.close()
+        self.count_bytes_saved(self.protocol)
         self.protocol = protocol
         self._clear_protocols(protocol)
 
+    # Bytes saved by compression on previous connections:
+    bytes_saved_sending = bytes_saved_receiving = 0
+
+    def count_bytes_saved(self, protocol):
+        self.bytes_saved_sending += protocol.bytes_saved_sending
+        self.bytes_saved_receiving += protocol.bytes_saved_receiving
+
+    def bytes_saved(self):
+        """Return the numbers of bytes saved by compression
+
+        A dictionary with the numbers of bytes saved sending and
+        receiving messages is returned.
+        """
+        sending = self.bytes_saved_sending
+        receiving = self.bytes_saved_receiving
+        protocol = self.protocol
+        if protocol is not None:
+            sending += protocol.bytes_saved_sending
+            receiving += protocol.bytes_saved_receiving
+        return dict(sending=sending, receiving=receiving)
+
     def try_connecting(self):
         logger.debug('try_connecting')
         if not self.closed:
-            self.protocols = [
-                Protocol(self.loop, addr, self,
-                         self.storage_key, self.read_only, self.connect_poll,
-                         ssl=self.ssl,
-                         ssl_server_hostname=self.ssl_server_hostname,
-                         credentials=self.credentials,
-                         )
-                for addr in self.addrs
-                ]
+            self.protocols = [self.protocol_for(addr) for addr in self.addrs]
+
+    def protocol_for(self, addr):
+        kw = dict(ssl=self.ssl,
+                  ssl_server_hostname=self.ssl_server_hostname,
+                  credentials=self.credentials,
+                  )
+        multiplexer = self.multiplexer
+        if multiplexer is not None and multiplexer.supports(
+            addr, self.ssl, self.ssl_server_hostname):
+            factory = ChannelProtocol
+            kw['multiplexer'] = multiplexer
+        else:
+            factory = Protocol
+        return factory(self.loop, addr, self,
+                       self.storage_key, self.read_only, self.connect_poll,
+                       **kw)
 
     def registered(self, protocol, server_tid):
         if self.protocol is None:
@@ -471,6 +858,7 @@ class Client(object):
     @future_generator
     def verify(self, server_tid):
         self.verify_invalidation_queue = [] # See comment in init :(
+        start = time.time()
 
         protocol = self.protocol
         if server_tid is None:
@@ -478,7 +866,11 @@ class Client(object):
 
         try:
             cache = self.cache
-            if cache:
+            if not self.invalidations:
+                self.verify_result = "not verified, reading a snapshot"
+                if protocol.protocol_version[1:] >= b'51':
+                    yield protocol.fut('skip_invalidations')
+            elif cache:
                 cache_tid = cache.getLastTid()
                 if not cache_tid:
                     self.verify_result = "Non-empty cache w/o tid"
@@ -494,13 +886,55 @@ class Client(object):
                 elif cache_tid == server_tid:
                     self.verify_result = "Cache up to date"
                 else:
-                    vdata = yield protocol.fut('getInvalidations', cache_tid)
+                    current_oids = getattr(cache, 'current_oids', None)
+                    filtered = (current_oids is not None and
+                                protocol.protocol_version[1:] >= b'51')
+                    if filtered:
+                        # Only ask about objects we have.  Building
+                        # the filter scans the cache, so do it in
+                        # another thread, rather than blocking the
+                        # event loop, which other clients may share.
+                        cached = yield self.loop.run_in_executor(
+                            None,
+                            lambda: BloomFilter.from_oids(
+                                current_oids()).state())
+                        if protocol is not self.protocol:
+                            return # We disconnected meanwhile
+                        vdata = yield protocol.fut(
+                            'getInvalidations', cache_tid, cached)
+                    else:
+                        vdata = yield protocol.fut(
+                            'getInvalidations', cache_tid)
                     if vdata:
                         self.verify_result = "quick verification"
                         server_tid, oids = vdata
                         for oid in oids:
                             cache.invalidate(oid, None)
-                        self.client.invalidateTransaction(server_tid, oids)
+                        if filtered:
+                            # The server left out changes to objects
+                            # we haven't cached, but ZODB connections
+                            # may still have them, so they have to
+                            # drop everything.
+                            self.client.invalidateCache()
+                        else:
+                            self.client.invalidateTransaction(
+                                server_tid, oids)
+                    elif (not self.drop_cache_rather_verify and
+                          getattr(cache, 'start_verification', None)
+                          is not None and
+                          protocol.protocol_version[1:] >= b'51'):
+                        # cache is too old, but we can check its
+                        # contents with the server in the background.
+                        self.verify_result = "full verification"
+                        count = yield self.loop.run_in_executor(
+                            None, cache.start_verification)
+                        if protocol is not self.protocol:
+                            return # We disconnected meanwhile
+                        logger.info(
+                            "%s verifying %s cached objects",
+                            getattr(self.client, '__name__', ''),
+                            count,
+                            )
                     else:
                         # cache is too old
                         self.verify_result = "cache too old, clearing"
@@ -527,6 +961,7 @@ class Client(object):
             # We've been ignoring them up to this point.
             self.cache.setLastTid(server_tid)
             self.ready = True
+            self.metrics.verified(self.verify_result, time.time() - start)
 
             # Gaaaa, ZEO 4 work around. See comment in __init__. :(
             for tid, oids in self.verify_invalidation_queue:
@@ -546,7 +981,39 @@ class Client(object):
 
             else:
                 self.client.notify_connected(self, info)
+                self.metrics.connected()
                 self.connected.set_result(None)
+                if getattr(self.cache, 'unverified', None):
+                    self.verify_contents(protocol)
+
+    verify_batch_size = 1000
+
+    @future_generator
+    def verify_contents(self, protocol):
+        # Check unverified cache records with the server, in batches.
+        # If we're disconnected, we'll pick up where we left off when
+        # we reconnect.
+        cache = self.cache
+        try:
+            while protocol is self.protocol:
+                pairs = cache.unverified_batch(self.verify_batch_size)
+                if not pairs:
+                    break
+                if protocol.protocol_version[1:] < b'51':
+                    # The server can't help us, so drop them.
+                    stale = [oid for (oid, tid) in pairs]
+                else:
+                    stale = yield protocol.fut('getStaleOids', pairs)
+                more = yield self.loop.run_in_executor(
+                    None, cache.verified, pairs, stale)
+                if not more:
+                    logger.info("%s finished verifying cache",
+                                getattr(self.client, '__name__', ''))
+                    break
+        except ClientDisconnected:
+            pass
+        except Exception:
+            logger.exception("verifying cache")
 
     def get_peername(self):
         return self.protocol.get_peername()
@@ -599,11 +1066,24 @@ class Client(object):
     @future_generator
     def load_before_threadsafe(self, future, wait_ready, oid, tid):
         data = self.cache.loadBefore(oid, tid)
+        self.metrics.cache_accessed(data is not None)
         if data is not None:
             future.set_result(data)
         elif self.ready:
+            base = self.delta_encoding and self.cache.loadNoncurrent(oid)
             try:
-                data = yield self.protocol.load_before(oid, tid)
+                if base:
+                    base, base_tid = base
+                    data = yield self.protocol.load_before(oid, tid, base_tid)
+                    if data:
+                        data, delta, start, end = data
+                        if delta is not None:
+                            data = ZEO.delta.decode(base, delta)
+                            self.metrics.delta_received(
+                                len(data) - len(delta))
+                        data = data, start, end
+                else:
+                    data = yield self.protocol.load_before(oid, tid)
             except Exception as exc:
                 future.set_exception(exc)
             else:
@@ -617,6 +1097,57 @@ class Client(object):
         else:
             future.set_exception(ClientDisconnected())
 
+    # The most objects to ask the server to load in one request:
+    load_before_many_chunk_size = 300
+
+    @future_generator
+    def load_before_many_threadsafe(self, future, wait_ready, oids, tid):
+        cache = self.cache
+        results = [cache.loadBefore(oid, tid) for oid in oids]
+        missing = [i for (i, data) in enumerate(results) if data is None]
+        for data in results:
+            self.metrics.cache_accessed(data is not None)
+        if not missing:
+            future.set_result(results)
+        elif self.ready:
+            protocol = self.protocol
+            try:
+                if protocol.protocol_version[1:] >= b'51':
+                    # Ask for a chunk at a time, so the server can
+                    # serve other clients between chunks of a big scan.
+                    loaded = []
+                    size = self.load_before_many_chunk_size
+                    for n in range(0, len(missing), size):
+                        loaded.extend((yield protocol.fut(
+                            'loadBefore_many',
+                            [oids[i] for i in missing[n:n+size]],
+                            tid)))
+                else:
+                    # Send the requests at once, then collect results.
+                    futures = [protocol.load_before(oids[i], tid)
+                               for i in missing]
+                    loaded = []
+                    for f in futures:
+                        try:
+                            loaded.append((yield f))
+                        except ZODB.POSException.POSKeyError:
+                            loaded.append(None)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                for i, data in zip(missing, loaded):
+                    results[i] = data
+                    if data:
+                        data, start, end = data
+                        cache.store(oids[i], start, end, data)
+                future.set_result(results)
+        elif wait_ready:
+            self._when_ready(
+                self.load_before_many_threadsafe, future, wait_ready,
+                oids, tid)
+        else:
+            future.set_exception(ClientDisconnected())
+
     @future_generator
     def _prefetch(self, oid, tid):
         try:
@@ -637,17 +1168,26 @@ class Client(object):
         else:
             future.set_exception(ClientDisconnected())
 
+    def _update_cache(self, tid, updates):
+        cache = self.cache
+        for oid, data, resolved in updates:
+            cache.invalidate(oid, tid)
+            if data and not resolved:
+                cache.store(oid, tid, None, data)
+        cache.setLastTid(tid)
+
     @future_generator
     def tpc_finish_threadsafe(self, future, wait_ready, tid, updates, f):
         if self.ready:
             try:
                 tid = yield self.protocol.fut('tpc_finish', tid)
-                cache = self.cache
-                for oid, data, resolved in updates:
-                    cache.invalidate(oid, tid)
-                    if data and not resolved:
-                        cache.store(oid, tid, None, data)
-                cache.setLastTid(tid)
+                if self.finishing is not None:
+                    # Finish in order with transactions finished
+                    # when voting.
+                    self.finishing.append(Finish(tid, (updates, f, future)))
+                    self._finish_queued()
+                    return
+                self._update_cache(tid, updates)
             except Exception as exc:
                 future.set_exception(exc)
 
@@ -662,19 +1202,93 @@ class Client(object):
         else:
             future.set_exception(ClientDisconnected())
 
+    # While transactions finished when voting wait for the client to
+    # finish them, a list of them and of later invalidations and
+    # finishes, which are processed in order, or None:
+    finishing = None
+
+    @future_generator
+    def vote_and_finish_threadsafe(self, future, wait_ready, txn_id):
+        if self.ready:
+            try:
+                result = yield self.protocol.fut('vote_and_finish', txn_id)
+            except Exception as exc:
+                future.set_exception(exc)
+            else:
+                if result and result[0] is not None:
+                    # The transaction was committed.  Invalidations
+                    # for later transactions have to wait until the
+                    # client has finished it and told its database.
+                    if self.finishing is None:
+                        self.finishing = []
+                    self.finishing.append(Finish(result[0]))
+                future.set_result(result)
+        else:
+            future.set_exception(ClientDisconnected())
+
+    def tpc_finished_threadsafe(self, future, wait_ready, tid, updates, f):
+        # Finish a transaction that was finished when voting.
+        for item in self.finishing or ():
+            if isinstance(item, Finish) and item.tid == tid:
+                item.args = updates, f, future
+                break
+        self._finish_queued()
+
+    def _finish_queued(self):
+        finishing = self.finishing
+        while finishing:
+            item = finishing[0]
+            if isinstance(item, Finish):
+                if item.args is None:
+                    return # The client hasn't finished it yet
+                del finishing[0]
+                updates, f, future = item.args
+                try:
+                    if item.tid > self.cache.getLastTid():
+                        # (Otherwise, we reconnected and verified the
+                        # cache after the transaction was committed.)
+                        self._update_cache(item.tid, updates)
+                    f(item.tid)
+                except Exception as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(item.tid)
+            else:
+                del finishing[0]
+                tid, oids = item
+                if tid > self.cache.getLastTid():
+                    self._invalidate_transaction(tid, oids)
+        self.finishing = None
+
+    def sync_threadsafe(self, future, wait_ready):
+        if self.ready:
+            self.protocol.sync(future)
+        elif wait_ready:
+            self._when_ready(self.sync_threadsafe, future, wait_ready)
+        else:
+            future.set_exception(ClientDisconnected())
+
     def close_threadsafe(self, future, _):
         self.close()
         future.set_result(None)
 
     def invalidateTransaction(self, tid, oids):
+        if not self.invalidations:
+            return # Older servers send them anyway.
         if self.ready:
-            for oid in oids:
-                self.cache.invalidate(oid, tid)
-            self.client.invalidateTransaction(tid, oids)
-            self.cache.setLastTid(tid)
+            if self.finishing is not None:
+                self.finishing.append((tid, oids))
+            else:
+                self._invalidate_transaction(tid, oids)
         else:
             self.verify_invalidation_queue.append((tid, oids))
 
+    def _invalidate_transaction(self, tid, oids):
+        for oid in oids:
+            self.cache.invalidate(oid, tid)
+        self.client.invalidateTransaction(tid, oids)
+        self.cache.setLastTid(tid)
+
     def serialnos(self, serials):
         # Method called by ZEO4 storage servers.
 
@@ -708,27 +1322,86 @@ class Client(object):
             else:
                 return protocol.read_only
 
+class Finish(object):
+    """A transaction waiting to be finished by the client
+
+    args is None until the client finishes the transaction, and then
+    the updates, callback and future to finish it with.
+    """
+
+    def __init__(self, tid, args=None):
+        self.tid = tid
+        self.args = args
+
+class CallQueue(object):
+    """Queue of calls to be made in an event loop from other threads
+
+    Waking up the event loop is relatively expensive, as it involves
+    writing to a pipe.  When many threads make calls at the same time,
+    calls submitted while a wakeup is pending are queued and run by
+    the same wakeup.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+        self.scheduled = False
+
+    def submit(self, meth, *args):
+        with self.lock:
+            self.calls.append((meth, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+
+        self.loop.call_soon_threadsafe(self.run)
+
+    def run(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = collections.deque()
+            self.scheduled = False
+
+        for meth, args in calls:
+            try:
+                meth(*args)
+            except Exception:
+                logger.exception("Calling %r", meth)
+
 class ClientRunner(object):
 
     def set_options(self, addrs, wrapper, cache, storage_key, read_only,
-                    timeout=30, disconnect_poll=1,
+                    timeout=30, disconnect_poll=1, wait_for_connection=True,
                     **kwargs):
         self.__args = (addrs, wrapper, cache, storage_key, read_only,
                        disconnect_poll)
         self.__kwargs = kwargs
         self.timeout = timeout
+        # Whether calls made while disconnected wait for a connection,
+        # rather than failing right away:
+        self.wait_for_connection = wait_for_connection
 
-    def setup_delegation(self, loop):
+    def setup_delegation(self, loop, **kw):
         self.loop = loop
-        self.client = Client(loop, *self.__args, **self.__kwargs)
+        kw.update(self.__kwargs)
+        self.client = Client(loop, *self.__args, **kw)
         self.call_threadsafe = self.client.call_threadsafe
         self.call_async_threadsafe = self.client.call_async_threadsafe
+        self.__call = self.make_call(loop)
 
+    def make_call(self, loop):
+        """Return a function used to make calls into the client
+
+        The function takes a client method that accepts a future and a
+        wait flag, followed by positional arguments.
+        """
         from concurrent.futures import Future
-        call_soon_threadsafe = loop.call_soon_threadsafe
+        call_soon_threadsafe = CallQueue(loop).submit
 
         def call(meth, *args, **kw):
             timeout = kw.pop('timeout', None)
+            idempotent = kw.pop('idempotent', False)
             assert not kw
 
             # Some explanation of the code below.
@@ -737,19 +1410,38 @@ class ClientRunner(object):
             # wait flag.  If false, and we're disconnected, we fail
             # immediately. If that happens, then we try again with the
             # wait flag set to True and wait with the default timeout.
+            # If the connection is lost while waiting for a result,
+            # the request is only sent again if it's idempotent,
+            # until the timeout runs out.  Nothing is sent again if
+            # we don't wait for connections.
+            start = time.time()
             result = Future()
             call_soon_threadsafe(meth, result, timeout is not None, *args)
             try:
                 return self.wait_for_result(result, timeout)
-            except ClientDisconnected:
+            except ClientDisconnected as exc:
+                if not self.wait_for_connection:
+                    raise
+                if isinstance(exc, ConnectionLost) and not idempotent:
+                    raise
                 if timeout is None:
-                    result = Future()
-                    call_soon_threadsafe(meth, result, True, *args)
-                    return self.wait_for_result(result, self.timeout)
+                    deadline = time.time() + self.timeout
+                elif idempotent and time.time() < start + timeout:
+                    deadline = start + timeout
                 else:
                     raise
 
-        self.__call = call
+            while True:
+                result = Future()
+                call_soon_threadsafe(meth, result, True, *args)
+                try:
+                    return self.wait_for_result(
+                        result, max(deadline - time.time(), 0))
+                except ConnectionLost:
+                    if not idempotent or time.time() >= deadline:
+                        raise
+
+        return call
 
     def wait_for_result(self, future, timeout):
         try:
@@ -761,7 +1453,8 @@ class ClientRunner(object):
                 raise
 
     def call(self, method, *args, **kw):
-        return self.__call(self.call_threadsafe, method, args, **kw)
+        return self.__call(self.call_threadsafe, method, args,
+                           idempotent=method in idempotent_methods, **kw)
 
     def call_future(self, method, *args):
         # for tests
@@ -780,14 +1473,32 @@ class ClientRunner(object):
         return self.__call(self.client.prefetch, oids, tid)
 
     def load_before(self, oid, tid):
-        return self.__call(self.client.load_before_threadsafe, oid, tid)
+        return self.__call(self.client.load_before_threadsafe, oid, tid,
+                           idempotent=True)
+
+    def load_before_many(self, oids, tid):
+        return self.__call(self.client.load_before_many_threadsafe, oids, tid,
+                           idempotent=True)
 
     def tpc_finish(self, tid, updates, f):
         return self.__call(self.client.tpc_finish_threadsafe, tid, updates, f)
 
+    def sync(self):
+        return self.__call(self.client.sync_threadsafe, idempotent=True)
+
+    def vote_and_finish(self, txn_id):
+        return self.__call(self.client.vote_and_finish_threadsafe, txn_id)
+
+    def tpc_finished(self, tid, updates, f):
+        return self.__call(
+            self.client.tpc_finished_threadsafe, tid, updates, f)
+
     def is_connected(self):
         return self.client.ready
 
+    def bytes_saved(self):
+        return self.client.bytes_saved()
+
     def is_read_only(self):
         try:
             protocol = self.client.protocol
@@ -824,10 +1535,63 @@ class ClientRunner(object):
             timeout = self.timeout
         self.wait_for_result(self.client.connected, timeout)
 
+class SharedThread(object):
+    """A networking thread shared by the ClientThreads in a process
+
+    One event loop, run in one thread, serves all of the client
+    threads that use it.  The thread is started when the first client
+    is added and stopped when the last one is removed.
+
+    The clients share a connection to each server, if the server
+    supports multiplexing them, using a Multiplexer.
+    """
+
+    thread = loop = multiplexer = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runners = set()
+
+    def add(self, runner):
+        with self.lock:
+            if self.thread is None:
+                self.loop = new_event_loop()
+                self.multiplexer = Multiplexer()
+                self.thread = threading.Thread(
+                    target=self.run, args=(self.loop,),
+                    name="zeo client shared networking thread",
+                    )
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.runners.add(runner)
+            self.loop.call_soon_threadsafe(
+                runner.setup_shared, self.loop, self.multiplexer)
+
+    def remove(self, runner):
+        with self.lock:
+            self.runners.discard(runner)
+            if not self.runners and self.thread is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join(9)
+                self.thread = self.loop = self.multiplexer = None
+
+    def run(self, loop):
+        try:
+            loop.run_forever()
+        finally:
+            for runner in list(self.runners):
+                runner.loop_stopped()
+            loop.close()
+            logger.debug('Stopping shared client thread')
+
+default_shared_thread = SharedThread()
+
 class ClientThread(ClientRunner):
     """Thread wrapper for client interface
 
-    A ClientProtocol is run in a dedicated thread.
+    A ClientProtocol is run in a dedicated thread, or, if
+    shared_thread is true, in a thread shared with other client
+    threads in the process.
 
     Calls to it are made in a thread-safe fashion.
     """
@@ -835,23 +1599,34 @@ class ClientThread(ClientRunner):
     def __init__(self, addrs, client, cache,
                  storage_key='1', read_only=False, timeout=30,
                  disconnect_poll=1, ssl=None, ssl_server_hostname=None,
-                 credentials=None):
+                 credentials=None, drop_cache_rather_verify=True,
+                 metrics=None, invalidations=True, wait_for_connection=True,
+                 shared_thread=False):
         self.set_options(addrs, client, cache, storage_key, read_only,
                          timeout, disconnect_poll,
+                         wait_for_connection=wait_for_connection,
                          ssl=ssl, ssl_server_hostname=ssl_server_hostname,
-                         credentials=credentials)
-        self.thread = threading.Thread(
-            target=self.run,
-            name="%s zeo client networking thread" % client.__name__,
-            )
-        self.thread.setDaemon(True)
+                         credentials=credentials,
+                         drop_cache_rather_verify=drop_cache_rather_verify,
+                         metrics=metrics, invalidations=invalidations)
         self.started = threading.Event()
-        self.thread.start()
+        if shared_thread:
+            self.shared_thread = default_shared_thread
+            self.shared_thread.add(self)
+        else:
+            self.thread = threading.Thread(
+                target=self.run,
+                name="%s zeo client networking thread" % client.__name__,
+                )
+            self.thread.setDaemon(True)
+            self.thread.start()
         self.started.wait()
         if self.exception:
+            if self.shared_thread is not None:
+                self.shared_thread.remove(self)
             raise self.exception
 
-    exception = None
+    exception = shared_thread = None
     def run(self):
         loop = None
         try:
@@ -864,29 +1639,168 @@ class ClientThread(ClientRunner):
             logger.exception("Client thread")
             self.exception = exc
         finally:
-            if not self.closed:
-                self.closed = True
-                try:
-                    if self.client.ready:
-                        self.client.ready = False
-                        self.client.client.notify_disconnected()
-                except AttributeError:
-                    pass
-                logger.critical("Client loop stopped unexpectedly")
+            self.loop_stopped()
             if loop is not None:
                 loop.close()
             logger.debug('Stopping client thread')
 
+    def setup_shared(self, loop, multiplexer):
+        # Called in the shared thread
+        try:
+            self.setup_delegation(loop, multiplexer=multiplexer)
+        except Exception as exc:
+            logger.exception("Client setup")
+            self.exception = exc
+        finally:
+            self.started.set()
+
+    def loop_stopped(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                if self.client.ready:
+                    self.client.ready = False
+                    self.client.client.notify_disconnected()
+            except AttributeError:
+                pass
+            logger.critical("Client loop stopped unexpectedly")
+
     closed = False
     def close(self):
         if not self.closed:
             self.closed = True
             super(ClientThread, self).close()
-            self.loop.call_soon_threadsafe(self.loop.stop)
-            self.thread.join(9)
+            if self.shared_thread is not None:
+                self.shared_thread.remove(self)
+            else:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join(9)
             if self.exception:
                 raise self.exception
 
+class AsyncClientRunner(ClientRunner):
+    """Client interface for code running in the client's event loop
+
+    Rather than blocking, calls return asyncio futures that can be
+    awaited (or yielded from) in coroutines running in the same
+    event loop as the client.  There's no thread hand-off.  The cache
+    and cache verification are the same as for ClientThread, because
+    both delegate to the same Client.
+    """
+
+    def make_call(self, loop):
+
+        def call(meth, *args, **kw):
+            timeout = kw.pop('timeout', None)
+            idempotent = kw.pop('idempotent', False)
+            assert not kw
+            if timeout is None:
+                timeout = self.timeout
+            result = asyncio.Future(loop=loop)
+            if idempotent:
+                # Send the request again if the connection is lost,
+                # until the timeout runs out.
+                deadline = time.time() + timeout
+
+                def send():
+                    attempt = asyncio.Future(loop=loop)
+
+                    @attempt.add_done_callback
+                    def done(attempt):
+                        if result.done():
+                            pass
+                        elif attempt.cancelled():
+                            result.cancel()
+                        elif (isinstance(attempt.exception(), ConnectionLost)
+                              and time.time() < deadline):
+                            send()
+                        elif attempt.exception() is not None:
+                            result.set_exception(attempt.exception())
+                        else:
+                            result.set_result(attempt.result())
+
+                    meth(attempt, True, *args)
+
+                send()
+            else:
+                meth(result, True, *args)
+            return self.wait_for_result(result, timeout)
+
+        return call
+
+    def wait_for_result(self, future, timeout):
+        if future.done():
+            return future
+
+        loop = self.loop
+        result = asyncio.Future(loop=loop)
+
+        def timed_out():
+            if not result.done():
+                if self.client.ready:
+                    result.set_exception(asyncio.TimeoutError())
+                else:
+                    result.set_exception(
+                        ClientDisconnected("timed out waiting for connection"))
+
+        handle = loop.call_later(timeout, timed_out)
+
+        @future.add_done_callback
+        def done(future):
+            handle.cancel()
+            if future.cancelled():
+                if not result.done():
+                    result.cancel()
+            elif future.exception() is not None:
+                if not result.done():
+                    result.set_exception(future.exception())
+            elif not result.done():
+                result.set_result(future.result())
+
+        return result
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+
+        # The connected future is a concurrent future that's
+        # resolved in our thread, so its callbacks run in our thread.
+        connected = asyncio.Future(loop=self.loop)
+
+        @self.client.connected.add_done_callback
+        def done(future):
+            if future.exception() is not None:
+                connected.set_exception(future.exception())
+            else:
+                connected.set_result(None)
+
+        return self.wait_for_result(connected, timeout)
+
+class AsyncClient(AsyncClientRunner):
+    """Awaitable client interface
+
+    This must be created in, and used from, the thread running the
+    given event loop.  Connection is started when the client is
+    created. Use the ``wait`` method to get a future that's resolved
+    when the client is connected.
+
+    client is a ClientStorage-like object that gets notified of
+    connection events and server callbacks.
+    """
+
+    def __init__(self, loop, addrs, client, cache,
+                 storage_key='1', read_only=False, timeout=30,
+                 disconnect_poll=1, ssl=None, ssl_server_hostname=None,
+                 credentials=None, drop_cache_rather_verify=True,
+                 metrics=None, invalidations=True):
+        self.set_options(addrs, client, cache, storage_key, read_only,
+                         timeout, disconnect_poll,
+                         ssl=ssl, ssl_server_hostname=ssl_server_hostname,
+                         credentials=credentials,
+                         drop_cache_rather_verify=drop_cache_rather_verify,
+                         metrics=metrics, invalidations=invalidations)
+        self.setup_delegation(loop)
+
 class Fut(object):
     """Lightweight future that calls it's callback immediately rather than soon
     """
@@ -2,6 +2,7 @@ import json
 import logging
 import os
 import random
+from struct import pack, unpack
 import threading
 import ZODB.POSException
 
@@ -17,7 +18,13 @@ class ServerProtocol(base.Protocol):
     """asyncio low-level ZEO server interface
     """
 
-    protocols = (b'5', )
+    protocols = (b'5', b'51', b'52')
+
+    # Protocol 52 multiplexes several clients' storage connections,
+    # "channels", over one connection.  Each message starts with a
+    # 4-byte channel id.  A message with only a channel id closes
+    # the channel.  Channel 0 is used for connection heartbeats.
+    multiplexed_protocol = b'52'
 
     name = 'server protocol'
     methods = set(('register', ))
@@ -50,11 +57,17 @@ class ServerProtocol(base.Protocol):
         super(ServerProtocol, self).connection_made(transport)
         self._write(self.announce_protocol)
 
+    channels = None # {channel id -> ServerChannel} when multiplexing
+
     def connection_lost(self, exc):
         self.connected = False
         if exc:
             logger.error("Disconnected %s:%s", exc.__class__.__name__, exc)
-        self.zeo_storage.notify_disconnected()
+        if self.channels is not None:
+            for channel in list(self.channels.values()):
+                channel.connection_lost(exc)
+        else:
+            self.zeo_storage.notify_disconnected()
         self.stop()
 
     def stop(self):
@@ -72,7 +85,14 @@ class ServerProtocol(base.Protocol):
                 self.protocol_version = protocol_version
                 self.encode = encoder(protocol_version, True)
                 self.decode = server_decoder(protocol_version)
-                self.zeo_storage.notify_connected(self)
+                if version >= b'51':
+                    self.start_compressing()
+                if version >= self.multiplexed_protocol:
+                    # Storages are connected as their channels are opened.
+                    self.channels = {}
+                    self.message_received = self.channel_message_received
+                else:
+                    self.zeo_storage.notify_connected(self)
             else:
                 logger.error("bad handshake %s" % short_repr(protocol_version))
                 self.close()
@@ -84,6 +104,22 @@ class ServerProtocol(base.Protocol):
             if self.connected:
                 logger.exception("call_soon_threadsafe failed while connected")
 
+    def channel_message_received(self, message):
+        channel_id, = unpack(">I", message[:4])
+        if not channel_id:
+            return # keep-alive
+        channel = self.channels.get(channel_id)
+        if len(message) == 4:
+            # The client closed the channel.
+            if channel is not None:
+                channel.connection_lost(None)
+        else:
+            if channel is None:
+                channel = self.channels[channel_id] = ServerChannel(
+                    self, channel_id,
+                    self.zeo_storage.server.create_client_handler())
+            channel.message_received(message[4:])
+
     def message_received(self, message):
         try:
             message_id, async_, name, args = self.decode(message)
@@ -144,6 +180,51 @@ class ServerProtocol(base.Protocol):
     def async_threadsafe(self, method, *args):
         self.call_soon_threadsafe(self.call_async, method, args)
 
+class ServerChannel(ServerProtocol):
+    """A client storage connection multiplexed over a ServerProtocol
+    """
+
+    name = 'server channel'
+
+    def __init__(self, connection, channel_id, zeo_storage):
+        base.Protocol.__init__(self, connection.loop, connection.addr)
+        del self.message_received # There's no handshake
+        self.zeo_storage = zeo_storage
+        self.connection = connection
+        self.channel_id = channel_id
+        self.prefix = pack(">I", channel_id)
+        self.transport = connection.transport
+        self.protocol_version = connection.protocol_version
+        self.encode = connection.encode
+        self.decode = connection.decode
+        self.connected = True
+        zeo_storage.notify_connected(self)
+
+    def __repr__(self):
+        return "%s %s" % (self.name, self.channel_id)
+
+    def _write(self, message):
+        self.connection._write(self.prefix + message)
+
+    def _writeit(self, data):
+        prefix = self.prefix
+        self.connection._writeit(prefix + message for message in data)
+
+    def close(self):
+        logger.debug("Closing server channel")
+        if not self.closed:
+            if not self.connection.closed:
+                self._write(b'') # Tell the client
+            self.connection_lost(None)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        channels = self.connection.channels
+        if channels.get(self.channel_id) is self:
+            del channels[self.channel_id]
+        self.connected = False
+        self.zeo_storage.notify_disconnected()
+
 best_protocol_version = os.environ.get(
     'ZEO_SERVER_PROTOCOL',
     ServerProtocol.protocols[-1].decode('utf-8')).encode('utf-8')
@@ -76,6 +76,11 @@ class Loop(object):
         self.later.append((delay, func, args, handle))
         return handle
 
+    def run_in_executor(self, executor, func, *args):
+        future = asyncio.Future(loop=self)
+        future.set_result(func(*args))
+        return future
+
     def call_exception_handler(self, context):
         self.exceptions.append(context)
 
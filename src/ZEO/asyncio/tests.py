@@ -13,13 +13,18 @@ from ZODB.utils import maxtid
 
 import collections
 import logging
+import os
 import struct
 import unittest
+import zlib
 
+from ..bloom import BloomFilter
 from ..Exceptions import ClientDisconnected, ProtocolError
 
+from .base import COMPRESSED
 from .testing import Loop
-from .client import ClientRunner, Fallback
+from .client import AsyncClientRunner, CallQueue, Client, ClientRunner
+from .client import Fallback, Multiplexer
 from .server import new_connection, best_protocol_version
 from .marshal import encoder, decoder
 
@@ -141,7 +146,7 @@ class ClientTests(Base, setupstack.TestCase, ClientRunner):
 
         # The client sends back a handshake, and registers the
         # storage, and requests the last transaction.
-        self.assertEqual(self.pop(2, False), self.enc + b'5')
+        self.assertEqual(self.pop(2, False), self.enc + b'51')
         self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
 
         # The client isn't connected until it initializes it's cache:
@@ -363,6 +368,87 @@ class ClientTests(Base, setupstack.TestCase, ClientRunner):
         # invalidate the database cache:
         self.assertFalse(wrapper.invalidateCache.called)
 
+    def test_cache_behind_sends_cached_oids(self):
+        # With protocol 51 and later, we send a summary of the
+        # objects we have cached, so the server can leave out
+        # invalidations we don't care about.
+        wrapper, cache, loop, client, protocol, transport = self.start()
+
+        cache.setLastTid(b'a'*8)
+        cache.store(b'4'*8, b'a'*8, None, '4 data')
+        cache.store(b'2'*8, b'a'*8, None, '2 data')
+        cache.store(b'3'*8, b'a'*8, b'b'*8, '3 data') # not current
+
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.unsized(transport.pop(2)), self.enc + b'51')
+        self.respond(1, None)
+        self.respond(2, b'e'*8)
+        self.pop(4)
+
+        msgid, async_, name, (tid, cached) = self.pop()
+        self.assertEqual((msgid, async_, name, tid),
+                         (3, False, 'getInvalidations', b'a'*8))
+        cached = BloomFilter.from_state(cached)
+        self.assertTrue(b'4'*8 in cached)
+        self.assertTrue(b'2'*8 in cached)
+        self.respond(3, (b'e'*8, [b'4'*8]))
+
+        self.assertEqual(self.pop(), (4, False, 'get_info', ()))
+        self.respond(4, dict(length=42))
+        self.assertTrue(client.connected.done() and not transport.data)
+        self.assertEqual(cache.getLastTid(), b'e'*8)
+        self.assertEqual(cache.load(b'2'*8), ('2 data', b'a'*8))
+        self.assertEqual(cache.load(b'4'*8), None)
+
+        # The invalidations we got don't include objects we don't
+        # have cached, so ZODB caches are invalidated as a whole:
+        wrapper.invalidateCache.assert_called_once_with()
+        self.assertFalse(wrapper.invalidateTransaction.called)
+
+    def test_cache_way_behind_full_verification(self):
+        # With protocol 51 and later, if the server can't send
+        # invalidations, we can check our cache contents with the
+        # server in the background, rather than dropping the cache.
+        wrapper, cache, loop, client, protocol, transport = self.start()
+        client.drop_cache_rather_verify = False
+        client.verify_batch_size = 1
+
+        cache.setLastTid(b'a'*8)
+        cache.store(b'4'*8, b'a'*8, None, '4 data')
+        cache.store(b'2'*8, b'a'*8, None, '2 data')
+
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.unsized(transport.pop(2)), self.enc + b'51')
+        self.respond(1, None)
+        self.respond(2, b'e'*8)
+        self.pop(4)
+
+        self.assertEqual(self.pop()[2], 'getInvalidations')
+        self.respond(3, None)
+        self.assertEqual(self.pop(), (4, False, 'get_info', ()))
+        self.respond(4, dict(length=42))
+
+        # We're connected, and haven't dropped the cache:
+        self.assertTrue(client.connected.done())
+        self.assertEqual(client.verify_result, "full verification")
+        self.assertEqual(cache.getLastTid(), b'e'*8)
+        self.assertEqual(len(cache.unverified), 2)
+        self.assertFalse(wrapper.invalidateCache.called)
+
+        # We verify a batch at a time. The server tells us which
+        # records are stale:
+        for message_id in (5, 6):
+            msgid, async_, name, (pairs, ) = self.pop()
+            self.assertEqual((msgid, name), (message_id, 'getStaleOids'))
+            [(oid, tid)] = pairs
+            self.assertEqual(tid, b'a'*8)
+            self.respond(message_id, [oid] if oid == b'4'*8 else [])
+
+        self.assertFalse(transport.data)
+        self.assertEqual(cache.unverified, {})
+        self.assertEqual(cache.load(b'2'*8), ('2 data', b'a'*8))
+        self.assertEqual(cache.load(b'4'*8), None)
+
     def test_cache_way_behind(self):
         wrapper, cache, loop, client, protocol, transport = self.start()
 
@@ -689,10 +775,554 @@ class ClientTests(Base, setupstack.TestCase, ClientRunner):
         protocol.connection_lost(None)
         self.assertTrue(handle.cancelled)
 
+    def test_compression(self):
+        # Large messages are compressed when the server supports
+        # protocol 51 or later.
+        wrapper, cache, loop, client, protocol, transport = self.start()
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.pop(2, False), self.enc + b'51')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+        self.respond(1, None)
+        self.assertEqual(self.pop(), (2, False, 'lastTransaction', ()))
+        self.respond(2, 'a'*8)
+        self.assertEqual(self.pop(), (3, False, 'get_info', ()))
+        self.respond(3, dict(length=42))
+
+        # Compressed messages are flagged in their size headers:
+        f = self.call('foo', b'x' * 10000)
+        size, data = transport.pop()
+        size = struct.unpack(">I", size)[0]
+        self.assertTrue(size & COMPRESSED)
+        self.assertEqual(size & ~COMPRESSED, len(data))
+        message = zlib.decompress(data)
+        self.assertEqual(self.decode(message)[:3], (4, False, 'foo'))
+        sent_saved = len(message) - len(data)
+
+        # Small messages and messages that don't compress well are
+        # sent as is:
+        self.call('bar', b'x')
+        self.assertEqual(self.pop()[2], 'bar')
+        incompressible = os.urandom(2000)
+        message = self.encode(6, False, 'baz', (incompressible, ))
+        self.call('baz', incompressible)
+        self.assertEqual(self.pop(parse=False), message)
+
+        # Compressed messages are decompressed when received:
+        message = self.encode(4, False, '.reply', b'y' * 10000)
+        data = zlib.compress(message)
+        protocol.data_received(
+            struct.pack(">I", len(data) | COMPRESSED) + data)
+        self.assertEqual(f.result(), b'y' * 10000)
+
+        self.assertEqual(client.bytes_saved(),
+                         dict(sending=sent_saved,
+                              receiving=len(message) - len(data)))
+
+        # Totals are kept across connections:
+        protocol.connection_lost(None)
+        self.assertEqual(client.bytes_saved(),
+                         dict(sending=sent_saved,
+                              receiving=len(message) - len(data)))
+
+    def test_no_compression_with_older_servers(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        self.call('foo', b'x' * 10000)
+        self.assertEqual(self.pop(), (4, False, 'foo', (b'x' * 10000, )))
+        self.assertEqual(client.bytes_saved(), dict(sending=0, receiving=0))
+
+    def test_multiplexing(self):
+        # Clients given a multiplexer share a connection to each
+        # server, if the server supports protocol 52.
+        multiplexer = Multiplexer()
+        addrs = ('127.0.0.1', 8200),
+        self.set_options(addrs, mock.Mock(), MemoryCache(), 'TEST', False,
+                         timeout=1)
+        loop = Loop(addrs)
+        self.setup_delegation(loop, multiplexer=multiplexer)
+        client = self.client
+        connection = loop.protocol
+        client2 = Client(loop, addrs, mock.Mock(), MemoryCache(), 'TEST2',
+                         False, 1, multiplexer=multiplexer)
+        self.assertTrue(loop.protocol is connection)
+        self.assertEqual(list(multiplexer.connections.values()),
+                         [connection])
+
+        def pop():
+            result = []
+            data = loop.transport.pop()
+            for message in data[1::2]:
+                channel_id = struct.unpack(">I", message[:4])[0]
+                result.append((channel_id, self.decode(message[4:])
+                               if message[4:] else None))
+            return result
+
+        def respond(channel_id, message_id, result):
+            connection.data_received(
+                sized(struct.pack(">I", channel_id) +
+                      self.encode(message_id, False, '.reply', result)))
+
+        # The connection does the handshake, and then the clients
+        # register on their own channels:
+        connection.data_received(sized(self.enc + b'52'))
+        self.assertEqual(self.unsized(loop.transport.pop(2)),
+                         self.enc + b'52')
+        self.assertEqual(pop(),
+                         [(1, (1, False, 'register', ('TEST', False))),
+                          (2, (1, False, 'register', ('TEST2', False)))])
+        for channel_id, current in ((1, client), (2, client2)):
+            respond(channel_id, 1, None)
+            self.assertEqual(pop(),
+                             [(channel_id, (2, False, 'lastTransaction', ()))])
+            respond(channel_id, 2, b'a'*8)
+            self.assertEqual(pop(), [(channel_id, (3, False, 'get_info', ()))])
+            respond(channel_id, 3, dict(length=42))
+            self.assertTrue(current.connected.done())
+        self.assertTrue(client.protocol is not client2.protocol)
+        self.assertTrue(client.protocol.transport is loop.transport)
+
+        # Calls are made on the client's channel:
+        f = self.call('foo', 1)
+        self.assertEqual(pop(), [(1, (4, False, 'foo', (1, )))])
+        respond(1, 4, 42)
+        self.assertEqual(f.result(), 42)
+
+        # Heartbeats are sent for the connection, on channel 0:
+        connection.heartbeat()
+        self.assertEqual(pop(), [(0, (-1, 0, '.reply', None))])
+
+        # If the server closes a channel, its client reconnects on a
+        # new one:
+        connection.data_received(sized(struct.pack(">I", 2)))
+        self.assertFalse(client2.ready)
+        self.assertTrue(client.ready)
+        self.assertEqual(pop(),
+                         [(3, (1, False, 'register', ('TEST2', False)))])
+
+        # Clients close their channels when they close, and the
+        # connection is closed with the last one:
+        client.close()
+        self.assertEqual(pop(), [(1, None)])
+        self.assertFalse(loop.transport.closed)
+        client2.close()
+        self.assertEqual(pop(), [(3, None)])
+        self.assertTrue(loop.transport.closed)
+        self.assertEqual(multiplexer.connections, {})
+
+    def test_multiplexing_with_older_servers(self):
+        # If a server doesn't support multiplexing, clients connect
+        # to it separately.
+        multiplexer = Multiplexer()
+        addrs = ('127.0.0.1', 8200),
+        self.set_options(addrs, mock.Mock(), MemoryCache(), 'TEST', False,
+                         timeout=1)
+        loop = Loop(addrs)
+        self.setup_delegation(loop, multiplexer=multiplexer)
+        connection = loop.protocol
+        connection.data_received(sized(self.enc + b'51'))
+        self.assertTrue(loop.transport.closed)
+        self.assertFalse(multiplexer.supports(addrs[0], None, None))
+        connection.connection_lost(None)
+
+        # The client reconnected with a connection of its own:
+        protocol = loop.protocol
+        self.assertFalse(protocol is connection)
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.pop(2, False), self.enc + b'51')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+
+    def test_metrics(self):
+        # Call times, cache accesses, connections and verifications
+        # are recorded.
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+        metrics = client.metrics
+        self.call('foo', 1)
+        self.assertEqual(metrics.snapshot()['requests_in_flight'], 1)
+        self.pop()
+        self.respond(4, 42)
+
+        self.load_before(b'1'*8, maxtid)
+        self.pop()
+        self.respond((b'1'*8, maxtid), (b'data', b'a'*8, None))
+        self.load_before(b'1'*8, maxtid)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(
+            sorted(snapshot['calls']),
+            ['foo', 'get_info', 'lastTransaction', 'loadBefore', 'register'])
+        foo = snapshot['calls']['foo']
+        self.assertEqual(foo['count'], 1)
+        self.assertEqual(sum(count for (bound, count) in foo['buckets']), 1)
+        self.assertEqual(snapshot['requests_in_flight'], 0)
+        self.assertEqual(snapshot['cache'],
+                         dict(hits=1, misses=1, hit_rate=.5))
+        self.assertEqual(snapshot['connections'], 1)
+        self.assertEqual(snapshot['verifications']['count'], 1)
+        self.assertEqual(snapshot['verifications']['results'],
+                         {'empty cache': 1})
+
+        protocol.connection_lost(None)
+        self.assertEqual(metrics.snapshot()['disconnections'], 1)
+
+    def test_snapshot_clients_skip_invalidations(self):
+        wrapper, cache, loop, client, protocol, transport = self.start()
+        client.invalidations = False
+        cache.store(b'1'*8, b'a'*8, None, b'data')
+        cache.setLastTid(b'a'*8)
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.pop(2, False), self.enc + b'51')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+        self.respond(1, None)
+        self.assertEqual(self.pop(), (2, False, 'lastTransaction', ()))
+        self.respond(2, b'e'*8)
+
+        # Rather than verifying the cache, the client asks the server
+        # not to send invalidations:
+        self.assertEqual(self.pop(), (3, False, 'skip_invalidations', ()))
+        self.respond(3, None)
+        self.assertEqual(self.pop(), (4, False, 'get_info', ()))
+        self.respond(4, dict(length=42))
+        self.assertEqual(client.verify_result,
+                         "not verified, reading a snapshot")
+        self.assertEqual(cache.load(b'1'*8), (b'data', b'a'*8))
+
+        # Invalidations sent anyway are ignored:
+        self.send('invalidateTransaction', b'f'*8, [b'1'*8], called=False)
+        self.assertEqual(cache.load(b'1'*8), (b'data', b'a'*8))
+
+    def test_load_before_many(self):
+        wrapper, cache, loop, client, protocol, transport = self.start()
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.pop(2, False), self.enc + b'51')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+        self.respond(1, None)
+        self.assertEqual(self.pop(), (2, False, 'lastTransaction', ()))
+        self.respond(2, b'a'*8)
+        self.assertEqual(self.pop(), (3, False, 'get_info', ()))
+        self.respond(3, dict(length=42))
+
+        # Only objects that aren't in the cache are requested, in a
+        # single call:
+        cache.store(b'1'*8, b'a'*8, None, b'data1')
+        loaded = self.load_before_many([b'1'*8, b'2'*8, b'3'*8], maxtid)
+        self.assertEqual(
+            self.pop(),
+            (4, False, 'loadBefore_many',
+             (self.seq_type([b'2'*8, b'3'*8]), maxtid)))
+        self.respond(4, [(b'data2', b'a'*8, None), None])
+        self.assertEqual(loaded.result(),
+                         [(b'data1', b'a'*8, None),
+                          (b'data2', b'a'*8, None),
+                          None])
+        self.assertEqual(cache.load(b'2'*8), (b'data2', b'a'*8))
+
+        # If everything is cached, the server isn't called:
+        loaded = self.load_before_many([b'1'*8, b'2'*8], maxtid)
+        self.assertFalse(transport.data)
+        self.assertEqual(loaded.result(),
+                         [(b'data1', b'a'*8, None),
+                          (b'data2', b'a'*8, None)])
+
+        # Large requests are sent in chunks, one at a time:
+        client.load_before_many_chunk_size = 2
+        oids = [b'3'*8, b'4'*8, b'5'*8]
+        loaded = self.load_before_many(oids, maxtid)
+        self.assertEqual(
+            self.pop(),
+            (5, False, 'loadBefore_many', (self.seq_type(oids[:2]), maxtid)))
+        self.assertFalse(transport.data)
+        self.respond(5, [None, None])
+        self.assertEqual(
+            self.pop(),
+            (6, False, 'loadBefore_many', (self.seq_type(oids[2:]), maxtid)))
+        self.respond(6, [(b'data5', b'a'*8, None)])
+        self.assertEqual(loaded.result(),
+                         [None, None, (b'data5', b'a'*8, None)])
+
+    def test_load_before_many_with_older_servers(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+
+        # The loads are sent as separate loadBefore calls:
+        loaded = self.load_before_many([b'1'*8, b'2'*8], maxtid)
+        self.assertEqual(self.pop(),
+                         [((b'1'*8, maxtid), False, 'loadBefore',
+                           (b'1'*8, maxtid)),
+                          ((b'2'*8, maxtid), False, 'loadBefore',
+                           (b'2'*8, maxtid))])
+        self.respond((b'1'*8, maxtid), (b'data1', b'a'*8, None))
+        self.assertFalse(loaded.done())
+        self.respond((b'2'*8, maxtid),
+                     ('ZODB.POSException.POSKeyError', (b'2'*8, )), True)
+        self.assertEqual(loaded.result(), [(b'data1', b'a'*8, None), None])
+
+    def test_sync(self):
+        wrapper, cache, loop, client, protocol, transport = self.start(
+            finish_start=True)
+
+        # Syncing waits for a reply to a request sent after it was
+        # called.  If no request is made, the server is pinged:
+        synced = self.sync()
+        self.assertEqual(self.pop(), (4, False, 'lastTransaction', ()))
+        self.assertFalse(synced.done())
+        self.respond(4, b'a'*8)
+        self.assertEqual(synced.result(), None)
+
+        # Replies to requests sent earlier don't count:
+        loaded = self.load_before(b'1'*8, maxtid)
+        synced = self.sync()
+        self.assertEqual(self.pop(),
+                         [((b'1'*8, maxtid), False, 'loadBefore',
+                           (b'1'*8, maxtid)),
+                          (5, False, 'lastTransaction', ())])
+        self.respond((b'1'*8, maxtid), (b'data1', b'a'*8, None))
+        self.assertFalse(synced.done())
+        self.respond(5, b'a'*8)
+        self.assertEqual(synced.result(), None)
+
+        # A sync made while another's ping is outstanding pings again:
+        synced = self.sync()
+        self.assertEqual(self.pop(), (6, False, 'lastTransaction', ()))
+        synced2 = self.sync()
+        self.assertEqual(self.pop(), (7, False, 'lastTransaction', ()))
+        self.respond(6, b'a'*8)
+        self.assertEqual(synced.result(), None)
+        self.assertFalse(synced2.done())
+        self.respond(7, b'a'*8)
+        self.assertEqual(synced2.result(), None)
+
+        # But the reply to any request sent after will do, so syncs
+        # don't need their own ping:
+        soon = []
+        loop.call_soon = lambda func, *args: soon.append((func, args))
+        synced = self.sync()
+        synced2 = self.sync()
+        loaded = self.load_before(b'2'*8, maxtid)
+        for func, args in soon:
+            func(*args)
+        self.assertEqual(self.pop(),
+                         ((b'2'*8, maxtid), False, 'loadBefore',
+                          (b'2'*8, maxtid)))
+        self.assertFalse(synced.done())
+        self.respond((b'2'*8, maxtid), (b'data2', b'a'*8, None))
+        self.assertEqual(synced.result(), None)
+        self.assertEqual(synced2.result(), None)
+
+        # Syncs fail if we're disconnected before they're done:
+        synced = self.sync()
+        self.pop()
+        protocol.connection_lost(None)
+        self.assertRaises(ClientDisconnected, synced.result)
+
+    def test_transactions_finished_when_voting(self):
+        wrapper, cache, loop, client, protocol, transport = self.start()
+        protocol.data_received(sized(self.enc + b'51'))
+        self.assertEqual(self.pop(2, False), self.enc + b'51')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+        self.respond(1, None)
+        self.assertEqual(self.pop(), (2, False, 'lastTransaction', ()))
+        self.respond(2, b'a'*8)
+        self.assertEqual(self.pop(), (3, False, 'get_info', ()))
+        self.respond(3, dict(length=42))
+
+        voted = self.vote_and_finish(b'1'*8)
+        self.assertEqual(self.pop(), (4, False, 'vote_and_finish', (b'1'*8,)))
+        self.respond(4, (b'b'*8, []))
+        self.assertEqual(voted.result()[0], b'b'*8)
+
+        # Until the client finishes the transaction, invalidations,
+        # and other transactions' finishes, wait:
+        self.send('invalidateTransaction', b'c'*8, self.seq_type([b'1'*8]),
+                  called=False)
+        tids = []
+        committed = self.tpc_finish(
+            b'2'*8, [(b'2'*8, 'committed 2', False)], tids.append)
+        self.assertEqual(self.pop(), (5, False, 'tpc_finish', (b'2'*8,)))
+        self.respond(5, b'd'*8)
+        self.assertFalse(committed.done())
+        self.assertEqual(cache.getLastTid(), b'a'*8)
+
+        # Then they're processed in order:
+        finished = self.tpc_finished(
+            b'b'*8, [(b'1'*8, 'committed 1', False)], tids.append)
+        self.assertEqual(finished.result(), b'b'*8)
+        self.assertEqual(committed.result(), b'd'*8)
+        self.assertEqual(tids, [b'b'*8, b'd'*8])
+        wrapper.invalidateTransaction.assert_called_with(
+            b'c'*8, self.seq_type([b'1'*8]))
+        self.assertEqual(cache.loadBefore(b'1'*8, b'c'*8),
+                         ('committed 1', b'b'*8, b'c'*8))
+        self.assertEqual(cache.load(b'2'*8), ('committed 2', b'd'*8))
+        self.assertEqual(cache.getLastTid(), b'd'*8)
+        self.assertEqual(client.finishing, None)
+
+        # Without a pending transaction, invalidations are processed
+        # as they arrive:
+        self.send('invalidateTransaction', b'e'*8, self.seq_type([b'2'*8]))
+        self.assertEqual(cache.getLastTid(), b'e'*8)
+
 class MsgpackClientTests(ClientTests):
     enc = b'M'
     seq_type = tuple
 
+class AsyncClientTests(Base, setupstack.TestCase, AsyncClientRunner):
+
+    def tearDown(self):
+        self.client.close()
+        super(AsyncClientTests, self).tearDown()
+
+    def start(self):
+        wrapper = mock.Mock()
+        self.target = wrapper
+        cache = MemoryCache()
+        self.set_options((('127.0.0.1', 8200), ), wrapper, cache, 'TEST',
+                         False, timeout=1)
+        loop = Loop((('127.0.0.1', 8200), ))
+        self.setup_delegation(loop)
+        return wrapper, cache, loop, self.client, loop.protocol
+
+    def respond(self, message_id, result):
+        self.loop.protocol.data_received(
+            sized(self.encode(message_id, False, '.reply', result)))
+
+    def test_calls_return_futures_in_the_client_loop(self):
+        wrapper, cache, loop, client, protocol = self.start()
+
+        # Waiting for a connection gives us a future that's resolved
+        # when the client has connected and verified its cache:
+        connected = self.wait()
+        self.assertFalse(connected.done())
+        protocol.data_received(sized(self.enc + b'5'))
+        self.assertEqual(self.pop(2, False), self.enc + b'5')
+        self.respond(1, None)
+        self.respond(2, b'a'*8)
+        self.pop(4)
+        self.assertEqual(self.pop(), (3, False, 'get_info', ()))
+        self.respond(3, dict(length=42))
+        self.assertTrue(connected.done())
+        self.assertEqual(connected.result(), None)
+
+        # Loads go through the shared cache logic:
+        loaded = self.load_before(b'1'*8, maxtid)
+        self.assertFalse(loaded.done())
+        self.assertEqual(self.pop(), ((b'1'*8, maxtid), False, 'loadBefore',
+                                      (b'1'*8, maxtid)))
+        self.respond((b'1'*8, maxtid), (b'data', b'a'*8, None))
+        self.assertEqual(loaded.result(), (b'data', b'a'*8, None))
+
+        # Cache hits are resolved without a server call:
+        loaded = self.load_before(b'1'*8, maxtid)
+        self.assertEqual(loaded.result(), (b'data', b'a'*8, None))
+        self.assertFalse(loop.transport.data)
+
+        # Finishing a transaction updates the cache:
+        committed = self.tpc_finish(
+            b'd'*8, [(b'2'*8, b'committed 2', False)], lambda tid: None)
+        self.assertEqual(self.pop(), (4, False, 'tpc_finish', (b'd'*8,)))
+        self.assertFalse(committed.done())
+        self.respond(4, b'e'*8)
+        self.assertEqual(committed.result(), b'e'*8)
+        self.assertEqual(cache.load(b'2'*8), (b'committed 2', b'e'*8))
+
+        # Errors are passed along:
+        result = self.call('foo')
+        self.assertEqual(self.pop(), (5, False, 'foo', ()))
+        self.loop.protocol.data_received(
+            sized(self.encode(5, True, '.reply',
+                              ('ZODB.POSException.POSKeyError', (b'x', )))))
+        self.assertEqual(result.exception().__class__.__name__, 'POSKeyError')
+
+    def test_ClientDisconnected_on_timeout(self):
+        wrapper, cache, loop, client, protocol = self.start()
+        client.ready = False
+        result = self.call('foo')
+        self.assertFalse(result.done())
+        delay, timed_out, args, handle = loop.later.pop()
+        self.assertEqual(delay, 1)
+        timed_out(*args)
+        self.assertTrue(isinstance(result.exception(), ClientDisconnected))
+
+    def test_reads_are_sent_again_after_reconnecting(self):
+        wrapper, cache, loop, client, protocol = self.start()
+        connected = self.wait()
+        protocol.data_received(sized(self.enc + b'5'))
+        self.assertEqual(self.pop(2, False), self.enc + b'5')
+        self.respond(1, None)
+        self.respond(2, b'a'*8)
+        self.pop(4)
+        self.assertEqual(self.pop(), (3, False, 'get_info', ()))
+        self.respond(3, dict(length=42))
+        self.assertTrue(connected.done())
+
+        history = self.call('history', b'1'*8)
+        loaded = self.load_before(b'1'*8, maxtid)
+        voted = self.call('vote', 42)
+        self.assertEqual(
+            self.pop(),
+            [(4, False, 'history', (b'1'*8, )),
+             ((b'1'*8, maxtid), False, 'loadBefore', (b'1'*8, maxtid)),
+             (5, False, 'vote', (42, ))])
+
+        # If the connection is lost, read-only requests are sent
+        # again once we've reconnected, but transactional ones fail:
+        protocol.connection_lost(None)
+        self.assertTrue(isinstance(voted.exception(), ClientDisconnected))
+        self.assertFalse(history.done() or loaded.done())
+
+        protocol = loop.protocol
+        protocol.data_received(sized(self.enc + b'5'))
+        self.assertEqual(self.pop(2, False), self.enc + b'5')
+        self.assertEqual(self.pop(), (1, False, 'register', ('TEST', False)))
+        self.respond(1, b'a'*8)
+        self.assertEqual(self.pop(), (2, False, 'get_info', ()))
+        self.respond(2, dict(length=42))
+        self.assertEqual(
+            self.pop(),
+            [(3, False, 'history', (b'1'*8, )),
+             ((b'1'*8, maxtid), False, 'loadBefore', (b'1'*8, maxtid))])
+        self.respond(3, [])
+        self.respond((b'1'*8, maxtid), (b'data', b'a'*8, None))
+        self.assertEqual(history.result(), [])
+        self.assertEqual(loaded.result(), (b'data', b'a'*8, None))
+
+class CallQueueTests(unittest.TestCase):
+
+    def test_calls_submitted_while_waiting_share_a_wakeup(self):
+        wakeups = []
+        loop = mock.Mock()
+        loop.call_soon_threadsafe.side_effect = (
+            lambda f, *args: wakeups.append((f, args)))
+        queue = CallQueue(loop)
+        calls = []
+        for i in range(3):
+            queue.submit(calls.append, i)
+        self.assertEqual(len(wakeups), 1)
+        self.assertEqual(calls, [])
+
+        f, args = wakeups.pop()
+        f(*args)
+        self.assertEqual(calls, [0, 1, 2])
+
+        # Once the queue is drained, the next call needs a new wakeup:
+        queue.submit(calls.append, 3)
+        self.assertEqual(len(wakeups), 1)
+        f, args = wakeups.pop()
+        f(*args)
+        self.assertEqual(calls, [0, 1, 2, 3])
+
+    def test_errors_dont_stop_the_batch(self):
+        queue = CallQueue(Loop())
+        calls = []
+        # Hold the wakeup so both calls are in the same batch:
+        queue.scheduled = True
+        queue.submit(lambda: 1/0)
+        queue.submit(calls.append, 1)
+        with mock.patch('ZEO.asyncio.client.logger') as logger:
+            queue.run()
+        self.assertEqual(calls, [1])
+        self.assertTrue(logger.exception.called)
+
 class MemoryCache(object):
 
     def __init__(self):
@@ -740,6 +1370,31 @@ class MemoryCache(object):
                 if end is None:
                     revisions[-1] = start, tid, data
 
+    def current_oids(self):
+        return [oid for oid, revisions in self.data.items()
+                if revisions and revisions[-1][1] is None]
+
+    unverified = {}
+
+    def start_verification(self):
+        self.unverified = dict(
+            (oid, revisions[-1][0])
+            for oid, revisions in self.data.items()
+            if revisions and revisions[-1][1] is None)
+        return len(self.unverified)
+
+    def unverified_batch(self, size):
+        return list(self.unverified.items())[:size]
+
+    def verified(self, pairs, stale):
+        for oid in stale:
+            if self.unverified.pop(oid, None):
+                self.invalidate(oid, None)
+        for oid, tid in pairs:
+            if self.unverified.get(oid) == tid:
+                del self.unverified[oid]
+        return len(self.unverified)
+
     def getLastTid(self):
         return self.last_tid
 
@@ -829,6 +1484,103 @@ class ServerTests(Base, setupstack.TestCase):
         self.call('foo', target=None)
         self.assertTrue(protocol.loop.transport.closed)
 
+    def test_compression(self):
+        protocol = self.connect()
+        self.assertEqual(self.pop(parse=False),
+                         self.enc + best_protocol_version)
+        protocol.data_received(sized(self.enc + b'51'))
+        protocol.methods = set(('loadBefore', ))
+
+        # Compressed requests are accepted, and large replies are
+        # compressed:
+        self.target.loadBefore.return_value = b'x' * 10000
+        message = self.encode(1, False, 'loadBefore', (b'1'*8, b'2'*8))
+        data = zlib.compress(message)
+        protocol.data_received(
+            struct.pack(">I", len(data) | COMPRESSED) + data)
+        self.target.loadBefore.assert_called_once_with(b'1'*8, b'2'*8)
+
+        size, data = self.loop.transport.pop()
+        size = struct.unpack(">I", size)[0]
+        self.assertTrue(size & COMPRESSED)
+        self.assertEqual(self.decode(zlib.decompress(data)),
+                         (1, False, '.reply', b'x' * 10000))
+        self.assertTrue(protocol.bytes_saved_sending > 9000)
+        self.assertEqual(protocol.bytes_saved_receiving,
+                         len(message) - len(zlib.compress(message)))
+
+    def test_multiplexing(self):
+        # With protocol 52, a connection carries channels for several
+        # client storages, each with its own zeo storage:
+        protocol = self.connect()
+        handlers = []
+        def create_client_handler():
+            handler = mock.Mock()
+            handler.register.return_value = None
+            handlers.append(handler)
+            return handler
+        server = protocol.zeo_storage.server
+        server.create_client_handler.side_effect = create_client_handler
+        self.assertEqual(self.pop(parse=False),
+                         self.enc + best_protocol_version)
+        protocol.data_received(sized(self.enc + b'52'))
+        self.assertFalse(protocol.zeo_storage.notify_connected.called)
+        self.assertEqual(handlers, [])
+
+        def send(channel_id, *message):
+            protocol.data_received(
+                sized(struct.pack(">I", channel_id) + self.encode(*message)))
+
+        def pop():
+            [size, data] = self.loop.transport.pop()
+            self.assertEqual(struct.unpack(">I", size)[0], len(data))
+            return struct.unpack(">I", data[:4])[0], self.decode(data[4:])
+
+        # Channels are opened by sending messages on them:
+        send(1, 1, False, 'register', ('1', False))
+        [first] = handlers
+        channel = first.notify_connected.call_args[0][0]
+        self.assertEqual(channel.protocol_version, self.enc + b'52')
+        first.register.assert_called_once_with('1', False)
+        self.assertEqual(pop(), (1, (1, False, '.reply', None)))
+
+        send(2, 1, False, 'register', ('2', True))
+        [_, second] = handlers
+        second.register.assert_called_once_with('2', True)
+        self.assertEqual(pop(), (2, (1, False, '.reply', None)))
+
+        # Replies and async calls go out on the channel:
+        channel.methods = set(('loadBefore', ))
+        first.loadBefore.return_value = b'data'
+        send(1, 2, False, 'loadBefore', (b'1'*8, b'2'*8))
+        self.assertEqual(pop(), (1, (2, False, '.reply', b'data')))
+        channel.async_('info', 42)
+        self.assertEqual(pop(), (1, (0, True, 'info', (42, ))))
+
+        # Heartbeats are sent on channel 0 and ignored:
+        send(0, -1, 0, '.reply', None)
+        self.assertEqual(self.loop.transport.pop(), [])
+
+        # A channel is closed by sending just its id.  Clients do it:
+        protocol.data_received(sized(struct.pack(">I", 1)))
+        first.notify_disconnected.assert_called_once_with()
+        self.assertFalse(second.notify_disconnected.called)
+
+        # And so do servers:
+        second.notify_connected.call_args[0][0].close()
+        self.assertEqual(self.loop.transport.pop(),
+                         [struct.pack(">I", 4), struct.pack(">I", 2)])
+        second.notify_disconnected.assert_called_once_with()
+        self.assertFalse(self.loop.transport.closed)
+
+        # Losing the connection closes the remaining channels:
+        send(3, 1, False, 'register', ('3', False))
+        third = handlers[2]
+        pop()
+        protocol.connection_lost(None)
+        third.notify_disconnected.assert_called_once_with()
+        self.assertFalse(protocol.zeo_storage.notify_disconnected.called)
+
 class MsgpackServerTests(ServerTests):
     enc = b'M'
     seq_type = tuple
@@ -873,5 +1625,7 @@ def test_suite():
     suite.addTest(unittest.makeSuite(ClientTests))
     suite.addTest(unittest.makeSuite(ServerTests))
     suite.addTest(unittest.makeSuite(MsgpackClientTests))
+    suite.addTest(unittest.makeSuite(AsyncClientTests))
+    suite.addTest(unittest.makeSuite(CallQueueTests))
     suite.addTest(unittest.makeSuite(MsgpackServerTests))
     return suite
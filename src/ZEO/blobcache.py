@@ -0,0 +1,143 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Index of the files in a client blob cache
+
+Checking the size of a blob cache used to require listing every
+directory and stat-ing every file in it.  Instead, clients record the
+sizes of blob files as they add them to the cache, and the times they
+access them, in an index.  The index is an SQLite database in the
+blob directory, so it's shared by all of the processes using the
+cache.
+
+The index is only used to decide what to remove from the cache, so
+it isn't critical.  If it's missing, it's rebuilt from the files in
+the cache.
+"""
+import os
+import re
+import sqlite3
+import threading
+
+import ZODB.blob
+
+cache_file_name = re.compile(r'\d+$').match
+
+class BlobCacheIndex(object):
+
+    filename = 'blob_cache_index.db'
+
+    def __init__(self, blob_dir):
+        self.blob_dir = blob_dir
+        self.path = os.path.join(blob_dir, self.filename)
+        self._local = threading.local()
+
+    def _connection(self):
+        # SQLite connections can't be shared by threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("pragma synchronous = off")
+            with conn:
+                conn.execute("create table if not exists blobs ("
+                             " name text primary key,"
+                             " size integer,"
+                             " atime real)")
+                conn.execute("create index if not exists blobs_atime"
+                             " on blobs (atime)")
+                conn.execute("create table if not exists meta ("
+                             " name text primary key, value text)")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def name(self, path):
+        """Return the name used in the index for a blob file path
+        """
+        return os.path.relpath(path, self.blob_dir)
+
+    def added(self, name, size, atime):
+        conn = self._connection()
+        with conn:
+            conn.execute("insert or replace into blobs values (?, ?, ?)",
+                         (name, size, atime))
+
+    def accessed(self, atimes):
+        """Record access times, given a dictionary from names to times
+        """
+        conn = self._connection()
+        with conn:
+            conn.executemany("update blobs set atime = ? where name = ?",
+                             [(t, name) for (name, t) in list(atimes.items())])
+
+    def removed(self, name):
+        conn = self._connection()
+        with conn:
+            conn.execute("delete from blobs where name = ?", (name, ))
+
+    def size(self):
+        return self._connection().execute(
+            "select coalesce(sum(size), 0) from blobs").fetchone()[0]
+
+    def oldest(self, n, skip=0):
+        """Return (name, size) for the n least-recently used blobs
+
+        after skipping the first skip of them.
+        """
+        return self._connection().execute(
+            "select name, size from blobs order by atime limit ? offset ?",
+            (n, skip)).fetchall()
+
+    def complete(self):
+        """Return whether the index includes the files that were in
+        the cache when it was created
+        """
+        return self._connection().execute(
+            "select value from meta where name = 'complete'"
+            ).fetchone() is not None
+
+    def rebuild(self):
+        """Rebuild the index from the files in the cache
+        """
+        blob_dir = self.blob_dir
+        blob_suffix = ZODB.blob.BLOB_SUFFIX
+        rows = []
+        for dirname in os.listdir(blob_dir):
+            if not cache_file_name(dirname):
+                continue
+            base = os.path.join(blob_dir, dirname)
+            if not os.path.isdir(base):
+                continue
+            for file_name in os.listdir(base):
+                if not file_name.endswith(blob_suffix):
+                    continue
+                file_path = os.path.join(base, file_name)
+                if not os.path.isfile(file_path):
+                    continue
+                stat = os.stat(file_path)
+                rows.append((os.path.join(dirname, file_name),
+                             stat.st_size, stat.st_atime))
+
+        conn = self._connection()
+        with conn:
+            # Files may have been added while we were looking, so
+            # keep existing entries.
+            conn.executemany("insert or ignore into blobs values (?, ?, ?)",
+                             rows)
+            conn.execute(
+                "insert or replace into meta values ('complete', '1')")
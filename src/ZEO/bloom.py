@@ -0,0 +1,84 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Bloom filters of object ids
+
+Clients send these to servers to summarize the objects in their
+caches.  A filter never fails to include an oid that was added to it,
+but may include some oids that weren't.  For cache verification, that
+just means that a few extra invalidations are sent.
+
+Filters are sent as (number of hashes, bits) tuples, and must be
+computed identically on clients and servers, regardless of Python
+version, so we hash oids ourselves.
+"""
+from struct import unpack
+
+# Multiplier for Fibonacci hashing of 64-bit oids:
+MULTIPLIER = 0x9E3779B97F4A7C15
+MASK = (1 << 64) - 1
+
+# Bits per oid and hashes give a false positive rate of about 1%:
+BITS_PER_OID = 10
+HASHES = 7
+
+class BloomFilter(object):
+
+    def __init__(self, size, hashes=HASHES, bits=None):
+        """Create a filter with the given number of bits (rounded up
+        to a multiple of 8)
+        """
+        if bits is None:
+            bits = bytearray((max(size, 1) + 7) // 8)
+        else:
+            bits = bytearray(bits)
+        self.bits = bits
+        self.size = len(bits) * 8
+        self.hashes = hashes
+
+    @classmethod
+    def from_oids(class_, oids):
+        oids = list(oids)
+        result = class_(len(oids) * BITS_PER_OID)
+        add = result.add
+        for oid in oids:
+            add(oid)
+        return result
+
+    @classmethod
+    def from_state(class_, state):
+        hashes, bits = state
+        return class_(0, hashes, bits)
+
+    def state(self):
+        return self.hashes, bytes(self.bits)
+
+    def _positions(self, oid):
+        h = (unpack(">Q", oid)[0] * MULTIPLIER) & MASK
+        h1 = h >> 32
+        h2 = (h & 0xffffffff) | 1
+        size = self.size
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % size
+
+    def add(self, oid):
+        bits = self.bits
+        for position in self._positions(oid):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, oid):
+        bits = self.bits
+        for position in self._positions(oid):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
@@ -26,6 +26,7 @@ from struct import pack, unpack
 
 import BTrees.LLBTree
 import BTrees.LOBTree
+import itertools
 import logging
 import os
 import tempfile
@@ -246,6 +247,23 @@ class ClientCache(object):
             self.f.truncate()
             self._initfile(ZEC_HEADER_SIZE)
 
+    ##
+    # Forget all non-current data, which may have been removed from
+    # the database by packing.
+    def clearNoncurrent(self):
+        with self._lock:
+            seek = self.f.seek
+            for noncurrent_for_oid in self.noncurrent.values():
+                for ofs in noncurrent_for_oid.values():
+                    seek(ofs)
+                    status = self.f.read(1)
+                    assert status == b'a', (ofs, self.f.tell())
+                    size = unpack(">I", self.f.read(4))[0]
+                    seek(ofs)
+                    self.f.write(b'f'+pack(">I", size))
+                    self._len -= 1
+            self.noncurrent = _noncurrent_index_type()
+
     ##
     # Scan the current contents of the cache file, calling `install`
     # for each object found in the cache.  This method should only
@@ -271,6 +289,7 @@ class ClientCache(object):
 
         self.current = _current_index_type()
         self.noncurrent = _noncurrent_index_type()
+        self.unverified = {}
         l = 0
         last = ofs = ZEC_HEADER_SIZE
         first_free_offset = 0
@@ -465,9 +484,16 @@ class ClientCache(object):
                                  % (u64(tid), u64(self.tid)))
             assert isinstance(tid, bytes) and len(tid) == 8, tid
             self.tid = tid
-            self.f.seek(len(magic))
-            self.f.write(tid)
-            self.f.flush()
+            self._write_tid()
+
+    def _write_tid(self):
+        # While some current records are unverified, the file isn't
+        # consistent with any tid, so we leave the tid out of it.  If
+        # we're restarted before verification finishes, the cache
+        # will be cleared.
+        self.f.seek(len(magic))
+        self.f.write(z64 if self.unverified else self.tid)
+        self.f.flush()
 
     ##
     # Return the last transaction seen by the cache.
@@ -485,6 +511,9 @@ class ClientCache(object):
     # @defreturn 3-tuple: (string, string, string)
     def load(self, oid, before_tid=None):
         with self._lock:
+            if oid in self.unverified:
+                # The record may be stale, so don't use it.
+                self.invalidate(oid, None)
             ofs = self.current.get(oid)
             if ofs is None:
                 self._trace(0x20, oid)
@@ -591,6 +620,53 @@ class ClientCache(object):
             self._trace(0x26, oid, "", saved_tid)
             return data, saved_tid, end_tid
 
+    ##
+    # Return the non-current revision of oid written by a transaction.
+    # @param oid object id
+    # @param tid id of transaction that wrote the revision
+    # @return data record, or None if the revision isn't in the cache
+    #         as non-current data
+    # @defreturn string
+    def loadSerial(self, oid, tid):
+        with self._lock:
+            noncurrent_for_oid = self.noncurrent.get(u64(oid))
+            ofs = None
+            if noncurrent_for_oid is not None:
+                ofs = noncurrent_for_oid.get(u64(tid))
+            if ofs is None:
+                self._trace(0x24, oid, "", tid)
+                return None
+
+            self.f.seek(ofs)
+            read = self.f.read
+            status = read(1)
+            assert status == b'a', (ofs, self.f.tell(), oid, tid)
+            size, saved_oid, saved_tid, end_tid, lver, ldata = unpack(
+                ">I8s8s8sHI", read(34))
+            assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
+            assert saved_tid == tid, (ofs, self.f.tell(), oid, saved_tid, tid)
+            assert lver == 0, "Versions aren't supported"
+            data = read(ldata)
+            assert len(data) == ldata, (ofs, self.f.tell())
+
+            self._n_accesses += 1
+            self._trace(0x26, oid, "", saved_tid)
+            return data
+
+    ##
+    # Return the latest non-current revision of oid in the cache.
+    # @param oid object id
+    # @return data record and the id of the transaction that wrote it,
+    #         or None if there are no non-current revisions of oid
+    # @defreturn 2-tuple: (string, string)
+    def loadNoncurrent(self, oid):
+        with self._lock:
+            noncurrent_for_oid = self.noncurrent.get(u64(oid))
+            if not noncurrent_for_oid:
+                return None
+            tid = p64(noncurrent_for_oid.maxKey())
+            return self.loadSerial(oid, tid), tid
+
     ##
     # Store a new data record in the cache.
     # @param oid object id
@@ -617,6 +693,8 @@ class ClientCache(object):
                     if saved_tid == start_tid:
                         return
                     raise ValueError("already have current data for oid")
+                # An unverified record for oid may have been evicted:
+                self.unverified.pop(oid, None)
             else:
                 noncurrent_for_oid = self.noncurrent.get(u64(oid))
                 if noncurrent_for_oid and (
@@ -709,6 +787,9 @@ class ClientCache(object):
     #        or None to forget all cached info about oid.
     def invalidate(self, oid, tid):
         with self._lock:
+            if tid is not None and oid in self.unverified:
+                # We don't know if the record was current before tid.
+                tid = None
             ofs = self.current.get(oid)
             if ofs is None:
                 # 0x10 == invalidate (miss)
@@ -723,6 +804,7 @@ class ClientCache(object):
             assert saved_oid == oid, (ofs, self.f.tell(), oid, saved_oid)
             assert end_tid == z64, (ofs, self.f.tell(), oid)
             del self.current[oid]
+            self.unverified.pop(oid, None)
             if tid is None:
                 self.f.seek(ofs)
                 self.f.write(b'f'+pack(">I", size))
@@ -757,6 +839,55 @@ class ClientCache(object):
             assert end_tid == z64, (ofs, self.f.tell(), oid)
             yield oid, tid
 
+    def current_oids(self):
+        """Return a list of the oids of current records.
+        """
+        with self._lock:
+            return list(self.current)
+
+    ##
+    # Full verification
+    #
+    # When a server can't tell us what changed since our last tid, we
+    # mark all current records as unverified and check them with the
+    # server in batches, while the cache is in use.  Unverified
+    # records are never loaded.  They're dropped when they're loaded
+    # or invalidated, or when the server says they're stale.
+
+    def start_verification(self):
+        """Mark all current records as unverified
+
+        Return the number of unverified records.
+        """
+        with self._lock:
+            self.unverified = dict(self.contents())
+            self._write_tid()
+            return len(self.unverified)
+
+    def unverified_batch(self, size):
+        """Return up to size (oid, tid) pairs for unverified records
+        """
+        with self._lock:
+            return list(itertools.islice(six.iteritems(self.unverified), size))
+
+    def verified(self, pairs, stale):
+        """Record the results of verifying (oid, tid) pairs
+
+        Records for oids in stale are dropped.  Return the number of
+        records still unverified.
+        """
+        with self._lock:
+            unverified = self.unverified
+            for oid in stale:
+                if oid in unverified:
+                    self.invalidate(oid, None)
+            for oid, tid in pairs:
+                if unverified.get(oid) == tid:
+                    del unverified[oid]
+            if not unverified:
+                self._write_tid()
+            return len(unverified)
+
     def dump(self):
         from ZODB.utils import oid_repr
         print("cache size", len(self))
@@ -0,0 +1,55 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Delta encoding of object records
+
+When a large object changes slightly, most of its new record is the
+same as a revision the other side of a connection already has.  A
+delta gives the lengths of the prefix and suffix the new record
+shares with that base revision, followed by the bytes in between.
+"""
+import struct
+
+header = struct.Struct(">II")
+
+def _common_prefix(a, b, size):
+    # Binary search, so the comparisons are done in C.
+    low, high = 0, size
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[low:mid] == b[low:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+def encode(base, data):
+    """Return a delta that changes base to data
+
+    None is returned if the delta wouldn't be smaller than data.
+    """
+    size = min(len(base), len(data))
+    prefix = _common_prefix(base, data, size)
+    size -= prefix
+    # Compare reversed copies to find the suffix, which mustn't
+    # overlap the prefix:
+    suffix = _common_prefix(base[prefix:][::-1], data[prefix:][::-1], size)
+    if prefix + suffix <= header.size:
+        return None
+    return header.pack(prefix, suffix) + data[prefix:len(data) - suffix]
+
+def decode(base, delta):
+    """Return the data a delta encodes, given its base
+    """
+    prefix, suffix = header.unpack(delta[:header.size])
+    return base[:prefix] + delta[header.size:] + base[len(base) - suffix:]
@@ -21,6 +21,16 @@ class StaleCache(object):
     def __init__(self, storage):
         self.storage = storage
 
+class ServingStaleData(object):
+    """A ZEO client lost its connection and serves reads from its cache
+
+    The data read are current as of the last transaction the cache
+    saw, which is the storage's ``lastTransaction()``.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
 class IClientCache(zope.interface.Interface):
     """Client cache interface.
 
@@ -56,6 +66,19 @@ class IClientCache(zope.interface.Interface):
         Returns the data, and start and end tids.
         """
 
+    def loadSerial(oid, tid):
+        """Load the non-current data for the object written by tid
+
+        Returns None if the revision isn't in the cache, or is current.
+        """
+
+    def loadNoncurrent(oid):
+        """Load the latest non-current data for the object
+
+        Returns the data and the tid that wrote it, or None if there
+        is no non-current data for the object in the cache.
+        """
+
     def invalidate(oid, tid):
         """Invalidate data for the object
 
@@ -69,6 +92,13 @@ class IClientCache(zope.interface.Interface):
         nothing.
         """
 
+    def clearNoncurrent():
+        """Forget all non-current data
+
+        This is called after packing, which may remove non-current
+        revisions from the database.
+        """
+
     def getLastTid():
         """Get the last tid seen by the cache
 
@@ -0,0 +1,187 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Client metrics
+
+Each ClientStorage has a ClientMetrics object, available as its
+``metrics`` attribute, that records how long server calls take, cache
+hits and misses, connections and cache verifications, blob data
+transferred and bytes saved by sending object records as deltas.
+Call ``snapshot`` to get the current values.
+"""
+from bisect import bisect_left
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class Histogram(object):
+    """Counts of durations, in seconds
+
+    Durations are counted in buckets whose upper bounds are given by
+    ``bounds``, plus a bucket for longer durations.
+    """
+
+    bounds = (.0001, .0002, .0005,
+              .001, .002, .005,
+              .01, .02, .05,
+              .1, .2, .5,
+              1, 2, 5, 10)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def snapshot(self):
+        """Return a dictionary of the recorded values
+
+        The buckets are given as a list of (upper bound, count) pairs
+        for non-empty buckets.  The upper bound of the last bucket is
+        None.
+        """
+        return dict(
+            count=self.count,
+            seconds=self.seconds,
+            max=self.max,
+            buckets=[(bound, count)
+                     for (bound, count)
+                     in zip(self.bounds + (None, ), self.buckets)
+                     if count],
+            )
+
+class ClientMetrics(object):
+
+    def __init__(self, log_interval=None):
+        """Create client metrics
+
+        If log_interval is given, the client logs a summary of the
+        metrics every log_interval seconds.
+        """
+        self.log_interval = log_interval
+        self._lock = threading.Lock()
+        self.calls = {} # {method -> Histogram}
+        self.cache_hits = self.cache_misses = 0
+        self.connections = self.disconnections = 0
+        self.verifications = Histogram()
+        self.verification_results = {} # {result -> count}
+        self.blob_bytes_received = self.blob_bytes_sent = 0
+        self.delta_bytes_saved_received = self.delta_bytes_saved_sent = 0
+
+    def requests_in_flight(self):
+        # Replaced by the network client
+        return 0
+
+    def called(self, method, seconds):
+        with self._lock:
+            histogram = self.calls.get(method)
+            if histogram is None:
+                histogram = self.calls[method] = Histogram()
+            histogram.record(seconds)
+
+    def cache_accessed(self, hit):
+        with self._lock:
+            if hit:
+                self.cache_hits += 1
+            else:
+                self.cache_misses += 1
+
+    def connected(self):
+        with self._lock:
+            self.connections += 1
+
+    def disconnected(self):
+        with self._lock:
+            self.disconnections += 1
+
+    def verified(self, result, seconds):
+        with self._lock:
+            self.verifications.record(seconds)
+            self.verification_results[result] = (
+                self.verification_results.get(result, 0) + 1)
+
+    def blob_received(self, nbytes):
+        with self._lock:
+            self.blob_bytes_received += nbytes
+
+    def blob_sent(self, nbytes):
+        with self._lock:
+            self.blob_bytes_sent += nbytes
+
+    def delta_received(self, nbytes):
+        with self._lock:
+            self.delta_bytes_saved_received += nbytes
+
+    def delta_sent(self, nbytes):
+        with self._lock:
+            self.delta_bytes_saved_sent += nbytes
+
+    def snapshot(self):
+        """Return a dictionary of the current values
+        """
+        with self._lock:
+            accesses = self.cache_hits + self.cache_misses
+            verifications = self.verifications.snapshot()
+            verifications['results'] = self.verification_results.copy()
+            return dict(
+                calls=dict((method, histogram.snapshot())
+                           for (method, histogram) in self.calls.items()),
+                requests_in_flight=self.requests_in_flight(),
+                cache=dict(
+                    hits=self.cache_hits,
+                    misses=self.cache_misses,
+                    hit_rate=(float(self.cache_hits) / accesses
+                              if accesses else None),
+                    ),
+                connections=self.connections,
+                disconnections=self.disconnections,
+                verifications=verifications,
+                blob_bytes=dict(received=self.blob_bytes_received,
+                                sent=self.blob_bytes_sent),
+                delta_bytes_saved=dict(
+                    received=self.delta_bytes_saved_received,
+                    sent=self.delta_bytes_saved_sent),
+                )
+
+    def log(self, name=''):
+        """Log a one-line summary of the metrics
+        """
+        snapshot = self.snapshot()
+        cache = snapshot['cache']
+        calls = ' '.join(
+            "%s=%d/%.1fms/%.1fms" % (
+                method, data['count'],
+                data['seconds'] * 1000 / data['count'],
+                data['max'] * 1000)
+            for (method, data) in sorted(snapshot['calls'].items()))
+        logger.info(
+            "%s calls (count/mean/max): %s; in flight: %s;"
+            " cache hits: %s misses: %s; connections: %s;"
+            " verifications: %s; blob bytes received: %s sent: %s;"
+            " delta bytes saved received: %s sent: %s",
+            name, calls or '-', snapshot['requests_in_flight'],
+            cache['hits'], cache['misses'], snapshot['connections'],
+            snapshot['verifications']['count'],
+            snapshot['blob_bytes']['received'],
+            snapshot['blob_bytes']['sent'],
+            snapshot['delta_bytes_saved']['received'],
+            snapshot['delta_bytes_saved']['sent'],
+            )
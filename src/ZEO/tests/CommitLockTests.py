@@ -64,6 +64,8 @@ class WorkerThread(TestThread):
         # event saying vote was called, then waits for the vote
         # response.
 
+        # Send any batched stores first, as tpc_vote would.
+        self.storage._send_stores(self.trans.data(self.storage), self.trans)
         future = self.storage._server.call_future('vote', id(self.trans))
         self.ready.set()
         future.result(9)
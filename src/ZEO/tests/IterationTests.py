@@ -72,6 +72,21 @@ class IterationTests(object):
         server.iterator_gc([iid])
         self.assertRaises(KeyError, server.iterator_next, iid)
 
+    def checkIteratorBatches(self):
+        # Transactions are fetched, with their records, in batches,
+        # and the next batch is requested while one is consumed.
+        storage = getattr(self._storage, 'base', self._storage) # unwrap
+        storage._iterator_batch_size = 1
+        tids = [self._dostore() for i in range(3)]
+        iterator = self._storage.iterator()
+        txn_info = six.advance_iterator(iterator)
+        self.assertEqual(txn_info.tid, tids[0])
+        [client_iterator] = storage._iterators.values()
+        self.assertTrue(client_iterator._next_batch is not None)
+        self.assertEqual([r.tid for r in txn_info], [tids[0]])
+        self.assertEqual([t.tid for t in iterator], tids[1:])
+        self.assertEqual(0, len(self._storage._iterator_ids))
+
     def checkIteratorExhaustionStorage(self):
         # Test the storage's garbage collection mechanism.
         self._dostore()
@@ -61,14 +61,16 @@ class GetsThroughVoteThread(BasicThread):
 
 class GetsThroughBeginThread(BasicThread):
     # This class is like the above except that it is intended to be run when
-    # another thread is already in a tpc_begin().  Thus, this thread will
-    # block in the tpc_begin until another thread closes the storage.  When
-    # that happens, this one will get disconnected too.
+    # another thread is already in a tpc_begin().  Servers that support
+    # concurrent transactions let this thread begin its transaction without
+    # waiting for the other one to finish.
     def run(self):
         try:
             self.storage.tpc_begin(self.trans)
         except ZEO.Exceptions.ClientStorageError:
             self.gotValueError = 1
+        else:
+            self.storage.tpc_abort(self.trans)
 
 
 class ThreadTests(object):
@@ -89,10 +91,10 @@ class ThreadTests(object):
 
     # Thread 1 should start a transaction, but not get all the way through
     # it.  While thread 1 is in the middle of the transaction, a second thread
-    # should start a transaction, and it will block in the tcp_begin() --
-    # because thread 1 has acquired the lock in its tpc_begin().  Now the main
-    # thread closes the storage and both sub-threads should get disconnected.
-    def checkSecondBeginFails(self):
+    # starts a transaction.  It doesn't block in tpc_begin(), because
+    # the server supports concurrent transactions.  Then the main thread
+    # closes the storage and thread 1 should get disconnected.
+    def checkSecondBeginDoesntBlock(self):
         doNextEvent = threading.Event()
         threadStartedEvent = threading.Event()
         thread1 = GetsThroughVoteThread(self._storage,
@@ -102,12 +104,12 @@ class ThreadTests(object):
         thread1.start()
         threadStartedEvent.wait(1)
         thread2.start()
+        thread2.join()
         self._storage.close()
         doNextEvent.set()
         thread1.join()
-        thread2.join()
         self.assertEqual(thread1.gotValueError, 1)
-        self.assertEqual(thread2.gotValueError, 1)
+        self.assertEqual(thread2.gotValueError, 0)
 
     # Run a bunch of threads doing small and large stores in parallel
     def checkMTStores(self):
@@ -0,0 +1,104 @@
+##############################################################################
+#
+# Copyright (c) 2018 Zope Foundation and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the Zope Public License,
+# Version 2.1 (ZPL).  A copy of the ZPL should accompany this distribution.
+# THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL EXPRESS OR IMPLIED
+# WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND FITNESS
+# FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""Measure the per-call overhead of cache-miss loads
+
+Usage: python -m ZEO.tests.bridge_speed [-t threads] [-n loads]
+
+Application threads hand calls to the client's event-loop thread.
+This script compares the batched call queue used by ClientThread with
+a bridge that wakes up the event loop for every call.  Each thread
+makes loadBefore calls that bypass the client cache, so each load is
+a server round trip.
+"""
+from __future__ import print_function
+
+import getopt
+import sys
+import threading
+import time
+
+import ZEO
+import ZEO.asyncio.client
+from ZODB.utils import maxtid, z64
+
+class DirectClientThread(ZEO.asyncio.client.ClientThread):
+    """Client thread that wakes the event loop for every call
+    """
+
+    def make_call(self, loop):
+        from concurrent.futures import Future
+        call_soon_threadsafe = loop.call_soon_threadsafe
+
+        def call(meth, *args, **kw):
+            timeout = kw.pop('timeout', None)
+            kw.pop('idempotent', None)
+            assert not kw
+            result = Future()
+            call_soon_threadsafe(meth, result, True, *args)
+            return self.wait_for_result(
+                result, self.timeout if timeout is None else timeout)
+
+        return call
+
+def run(addr, factory, nthreads, nloads):
+    client = ZEO.client(addr, _client_factory=factory)
+    runner = client._server
+    try:
+        def load():
+            for i in range(nloads):
+                runner.call('loadBefore', z64, maxtid)
+
+        threads = [threading.Thread(target=load) for i in range(nthreads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        client.close()
+
+    return elapsed * 1000000 / (nthreads * nloads)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    nthreads = 10
+    nloads = 1000
+    opts, args = getopt.getopt(args, 't:n:')
+    for name, value in opts:
+        if name == '-t':
+            nthreads = int(value)
+        elif name == '-n':
+            nloads = int(value)
+
+    addr, stop = ZEO.server()
+    try:
+        db = ZEO.DB(addr)
+        with db.transaction() as conn:
+            conn.root.x = 1
+        db.close()
+
+        for name, factory in (
+            ('direct', DirectClientThread),
+            ('batched', ZEO.asyncio.client.ClientThread),
+            ):
+            usec = run(addr, factory, nthreads, nloads)
+            print("%-8s %8.1f usec/load" % (name, usec))
+    finally:
+        stop()
+
+if __name__ == '__main__':
+    main()
@@ -64,6 +64,14 @@ class ZEOConfigTestBase(setupstack.TestCase):
         read_only=False,
         read_only_fallback=False,
         server_sync=False,
+        new_oid_batch_size_max=1000,
+        transaction_buffer_memory_size=1<<20,
+        drop_cache_rather_verify=True,
+        vote_and_finish=False,
+        delta_encoding=False,
+        serve_stale_reads=False,
+        shared_thread=False,
+        metrics_log_interval=None,
         wait_timeout=30,
         client_label=None,
         storage='1',
@@ -82,6 +90,19 @@ class ZEOConfigTestBase(setupstack.TestCase):
                              blob_cache_size * blob_cache_size_check // 100)
         self.assertEqual(client._is_read_only, read_only)
         self.assertEqual(client._read_only_fallback, read_only_fallback)
+        self.assertEqual(client._oids_batch_size_max, new_oid_batch_size_max)
+        self.assertEqual(client._transaction_buffer_memory_size,
+                         transaction_buffer_memory_size)
+        self.assertEqual(client._server.client.drop_cache_rather_verify,
+                         drop_cache_rather_verify)
+        self.assertEqual(client._vote_and_finish, vote_and_finish)
+        self.assertEqual(client._delta_encoding, delta_encoding)
+        self.assertEqual(client._serve_stale_reads, serve_stale_reads)
+        self.assertEqual(client._server.wait_for_connection,
+                         not serve_stale_reads)
+        self.assertEqual(client._server.shared_thread is not None,
+                         shared_thread)
+        self.assertEqual(client.metrics.log_interval, metrics_log_interval)
         self.assertEqual(client._server.timeout, wait_timeout)
         self.assertEqual(client._client_label, client_label)
         self.assertEqual(client._storage, storage)
@@ -109,6 +130,14 @@ class ZEOConfigTest(ZEOConfigTestBase):
             read_only=True,
             read_only_fallback=True,
             server_sync=True,
+            new_oid_batch_size_max=5000,
+            transaction_buffer_memory_size=4242,
+            drop_cache_rather_verify=False,
+            vote_and_finish=True,
+            delta_encoding=True,
+            serve_stale_reads=True,
+            shared_thread=True,
+            metrics_log_interval=60,
             wait_timeout=33,
             client_label='test_client',
             name='Test'
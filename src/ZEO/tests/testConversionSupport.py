@@ -85,10 +85,19 @@ underlying storage.
     3
     4
 
+Several records can be returned at once:
+
+    >>> [r[0] for r in zeo.record_iternext_many(None, 3)]
+    ['1', '2', '3']
+    >>> [r[0] for r in zeo.record_iternext_many('3', 3)]
+    ['4']
+
 The storage info also reflects the fact that record_iternext is supported.
 
     >>> zeo.get_info()['supports_record_iternext']
     True
+    >>> zeo.get_info()['supports_record_iternext_many']
+    True
 
     >>> zeo = ZEO.StorageServer.ZEOStorage(FakeServer(), False)
     >>> zeo.notify_connected(FakeConnection())
@@ -141,6 +150,37 @@ Now we'll have our way with it's private _server attr:
     4
     >>> client.close()
 
+If the server supports it, records are read ahead in batches:
+
+    >>> class Client(Client):
+    ...
+    ...    def record_iternext_many(self, next, count):
+    ...        print('record_iternext_many', next, count)
+    ...        results = []
+    ...        while next != None or not results:
+    ...            results.append(self.record_iternext(next))
+    ...            next = results[-1][3]
+    ...        return results[:count]
+
+    >>> client = ZEO.client(
+    ...     '', wait=False, _client_factory=Client)
+    >>> client._record_iternext_many = True
+    >>> client._record_iternext_batch_size = 3
+
+    >>> next = None
+    >>> while 1:
+    ...     oid, serial, data, next = client.record_iternext(next)
+    ...     print(oid)
+    ...     if next is None:
+    ...         break
+    record_iternext_many None 3
+    1
+    2
+    3
+    record_iternext_many 3 3
+    4
+    >>> client.close()
+
 """
 
 def test_suite():
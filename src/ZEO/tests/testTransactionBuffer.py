@@ -18,8 +18,7 @@ from ZEO.TransactionBuffer import TransactionBuffer
 
 def random_string(size):
     """Return a random string of size size."""
-    l = [chr(random.randrange(256)) for i in range(size)]
-    return "".join(l)
+    return bytes(bytearray(random.randrange(256) for i in range(size)))
 
 def new_store_data():
     """Return arbitrary data to use as argument to store() method."""
@@ -54,5 +53,29 @@ class TransBufTests(unittest.TestCase):
             self.assertEqual(resolved, data[i][1])
         tbuf.close()
 
+    def checkSpillToFile(self):
+        tbuf = TransactionBuffer(0, 3000)
+        data = []
+        while tbuf.file is None:
+            data.append((store(tbuf), False))
+        data.append(((b'd'*8, None), False))
+        tbuf.store(b'd'*8, None)
+        data.append((store(tbuf, True), True))
+
+        self.assertEqual(len(data), tbuf.count)
+        for i, (oid, d, resolved) in enumerate(tbuf):
+            self.assertEqual((oid, d), data[i][0])
+            self.assertEqual(resolved, data[i][1])
+        tbuf.close()
+
+    def checkClientResolved(self):
+        tbuf = TransactionBuffer(0, 0)
+        tbuf.store(b'1'*8, b'a')
+        tbuf.store(b'2'*8, b'b')
+        tbuf.resolve(b'1'*8, b'c')
+        self.assertEqual(list(tbuf),
+                         [(b'2'*8, b'b', False), (b'1'*8, b'c', False)])
+        tbuf.close()
+
 def test_suite():
     return unittest.makeSuite(TransBufTests, 'check')
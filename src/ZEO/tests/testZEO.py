@@ -892,6 +892,27 @@ def multiple_storages_invalidation_queue_is_not_insane():
     >>> sorted([int(u64(oid)) for oid in oids])
     [10, 11, 12, 13, 14]
 
+Clients can pass a Bloom filter of the objects they have cached, to
+leave out invalidations for objects they don't have:
+
+    >>> from ZEO.bloom import BloomFilter
+    >>> from ZODB.utils import p64
+    >>> cached = BloomFilter.from_oids([p64(i) for i in (1, 2, 11, 13)])
+    >>> trans2, oids = s1.getInvalidations(last, cached.state())
+    >>> trans2 == trans
+    True
+    >>> sorted([int(u64(oid)) for oid in oids])
+    [11, 13]
+
+If they're too far behind for that, they can ask which of their
+cached records are stale.  Records for objects that have changed or
+don't exist are:
+
+    >>> pairs = [(p64(1), fs1.load(p64(1))[1]), (p64(11), last),
+    ...          (p64(99), last)]
+    >>> [int(u64(oid)) for oid in s1.getStaleOids(pairs)]
+    [11, 99]
+
     >>> fs1.close(); fs2.close()
     """
 
@@ -1133,6 +1154,45 @@ def client_has_newer_data_than_server():
 
     """
 
+def connections_see_changes_made_while_disconnected():
+    """
+    When a client reconnects, it asks the server what changed while it
+    was disconnected, leaving out objects it doesn't have cached.  ZODB
+    connections can still have those objects, so they're updated too:
+
+    >>> from persistent.mapping import PersistentMapping
+    >>> addr, admin = start_server(keep=1)
+    >>> db = ZEO.DB(addr, max_disconnect_poll=.01)
+    >>> conn = db.open()
+    >>> conn.root.x = PersistentMapping(a=1)
+    >>> transaction.commit()
+    >>> _ = db.storage._cache.invalidate(conn.root.x._p_oid, None)
+    >>> db.storage._cache.load(conn.root.x._p_oid)
+
+    >>> stop_server(admin)
+    >>> wait_until("disconnected", lambda: not db.storage.is_connected())
+
+    The object is changed by another client while we're disconnected:
+
+    >>> addr2, admin = start_server(keep=1)
+    >>> db2 = ZEO.DB(addr2)
+    >>> with db2.transaction() as conn2:
+    ...     conn2.root.x['a'] = 2
+    >>> db2.close()
+    >>> stop_server(admin)
+
+    >>> _, admin = start_server(addr=addr, keep=1)
+    >>> wait_connected(db.storage)
+    >>> db.storage._server.client.verify_result
+    'quick verification'
+    >>> transaction.begin() and None
+    >>> conn.root.x['a']
+    2
+
+    >>> db.close()
+    >>> stop_server(admin)
+    """
+
 def history_over_zeo():
     """
     >>> addr, _ = start_server()
@@ -1262,6 +1322,786 @@ def convenient_to_pass_port_to_client_and_ZEO_dot_client():
     >>> client.close()
     """
 
+@forker.skip_if_testing_client_against_zeo4
+def large_messages_are_compressed():
+    """
+    Clients and servers that both support compression compress large
+    messages, including blob data:
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs')
+    >>> sorted(client.bytes_saved().items())
+    [('receiving', 0), ('sending', 0)]
+
+    >>> conn = ZODB.connection(client)
+    >>> conn.root.x = b'x' * 100000
+    >>> conn.root.b = ZODB.blob.Blob(b'z' * 100000)
+    >>> conn.transaction_manager.commit()
+    >>> client.bytes_saved()['sending'] > 190000
+    True
+
+    >>> client2 = ZEO.client(addr, blob_dir='cblobs2')
+    >>> conn2 = ZODB.connection(client2)
+    >>> len(conn2.root.x)
+    100000
+    >>> with conn2.root.b.open() as f:
+    ...     len(f.read())
+    100000
+    >>> client2.bytes_saved()['receiving'] > 190000
+    True
+
+    >>> conn.close()
+    >>> conn2.close()
+    """
+
+def blobs_can_be_streamed():
+    """
+    openBlobStream returns a file that fetches ranges of a blob from
+    the server as they're read, rather than downloading the whole
+    blob first:
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs')
+    >>> conn = ZODB.connection(client)
+    >>> data = bytes(bytearray(i % 256 for i in range(10000)))
+    >>> conn.root.b = ZODB.blob.Blob(data)
+    >>> conn.transaction_manager.commit()
+    >>> oid = conn.root.b._p_oid
+    >>> conn.close()
+
+    >>> client2 = ZEO.client(addr, blob_dir='cblobs2')
+    >>> serial = client2.load(oid)[1]
+    >>> import ZEO.ClientStorage
+    >>> old_block_size = ZEO.ClientStorage.BlobStream.block_size
+    >>> ZEO.ClientStorage.BlobStream.block_size = 1000
+    >>> f = client2.openBlobStream(oid, serial)
+    >>> f.read(10) == data[:10]
+    True
+    >>> _ = f.seek(5995)
+    >>> f.read(10) == data[5995:6005]
+    True
+    >>> f.tell()
+    6005
+    >>> sorted(f._fetched)
+    [0, 5, 6]
+
+    The blob isn't in the blob cache until all of it has been read:
+
+    >>> blob_filename = client2.fshelper.getBlobFilename(oid, serial)
+    >>> os.path.exists(blob_filename)
+    False
+    >>> _ = f.seek(0)
+    >>> f.read() == data
+    True
+    >>> os.path.exists(blob_filename)
+    True
+    >>> f.close()
+
+    Now that it's cached, the cached file is opened:
+
+    >>> with client2.openBlobStream(oid, serial) as f:
+    ...     f.name == blob_filename, f.read() == data
+    (True, True)
+
+    >>> ZEO.ClientStorage.BlobStream.block_size = old_block_size
+    >>> client.close()
+    >>> client2.close()
+    """
+
+def blobs_already_on_the_server_arent_sent_again():
+    """
+    When storing a blob, clients first send the server a hash of its
+    data.  If the server already has a committed blob with the same
+    data, it uses its own copy and the data aren't sent:
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs')
+    >>> conn = ZODB.connection(client)
+    >>> data = bytes(bytearray(i % 256 for i in range(100000)))
+    >>> conn.root.a = ZODB.blob.Blob(data)
+    >>> conn.transaction_manager.commit()
+
+    >>> sent = []
+    >>> async_iter = client._async_iter
+    >>> client._async_iter = lambda it: (sent.append(1), async_iter(it))
+
+    >>> conn.root.b = ZODB.blob.Blob(data)
+    >>> conn.transaction_manager.commit()
+    >>> sent
+    []
+
+    Other data are sent as usual:
+
+    >>> conn.root.c = ZODB.blob.Blob(data[1:])
+    >>> conn.transaction_manager.commit()
+    >>> sent
+    [1]
+
+    >>> client2 = ZEO.client(addr, blob_dir='cblobs2')
+    >>> conn2 = ZODB.connection(client2)
+    >>> with conn2.root.b.open() as f:
+    ...     f.read() == data
+    True
+    >>> with conn2.root.c.open() as f:
+    ...     f.read() == data[1:]
+    True
+
+    >>> conn.close()
+    >>> conn2.close()
+    """
+
+def blobs_can_be_prefetched():
+    """
+    prefetch_blobs downloads blobs to the blob cache in the
+    background, so they can be opened without waiting for the server:
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs')
+    >>> conn = ZODB.connection(client)
+    >>> for i in range(5):
+    ...     conn.root()[i] = ZODB.blob.Blob(str(i).encode('ascii') * 1000)
+    >>> conn.transaction_manager.commit()
+    >>> oids = [conn.root()[i]._p_oid for i in range(5)]
+    >>> conn.close()
+
+    >>> client2 = ZEO.client(addr, blob_dir='cblobs2')
+    >>> pairs = [(oid, client2.load(oid)[1]) for oid in oids]
+    >>> client2.prefetch_blobs(pairs, max_downloads=2).result(9)
+    5
+    >>> [os.path.exists(client2.fshelper.getBlobFilename(*pair))
+    ...  for pair in pairs]
+    [True, True, True, True, True]
+    >>> with client2.openCommittedBlobFile(*pairs[3]) as f:
+    ...     f.read() == b'3' * 1000
+    True
+
+    Blobs that are already cached aren't downloaded again:
+
+    >>> client2.prefetch_blobs(pairs).result(9)
+    0
+
+    Downloads stop once a given number of bytes have been downloaded:
+
+    >>> client3 = ZEO.client(addr, blob_dir='cblobs3')
+    >>> client3.prefetch_blobs(pairs, max_downloads=1, max_bytes=1500
+    ...                        ).result(9)
+    2
+
+    >>> client.close()
+    >>> client2.close()
+    >>> client3.close()
+    """
+
+def blob_loads_wait_for_downloads_in_progress():
+    """
+    If another thread or process is downloading a blob, loading it
+    waits for the download to finish:
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs')
+    >>> conn = ZODB.connection(client)
+    >>> conn.root.b = ZODB.blob.Blob(b'some data')
+    >>> conn.transaction_manager.commit()
+    >>> oid = conn.root.b._p_oid
+    >>> conn.close()
+
+    >>> client2 = ZEO.client(addr, blob_dir='cblobs2')
+    >>> serial = client2.load(oid)[1]
+    >>> blob_filename = client2.fshelper.getBlobFilename(oid, serial)
+    >>> _ = client2.fshelper.createPathForOID(oid)
+    >>> import ZEO.ClientStorage, zc.lockfile
+    >>> lock = ZEO.ClientStorage._lock_blob(blob_filename)
+
+    >>> loaded = []
+    >>> thread = threading.Thread(
+    ...     target=lambda: loaded.append(client2.loadBlob(oid, serial)))
+    >>> thread.start()
+    >>> time.sleep(.2)
+    >>> loaded
+    []
+    >>> lock.close()
+    >>> thread.join(9)
+    >>> loaded == [blob_filename]
+    True
+
+    The time spent waiting is recorded:
+
+    >>> waits = client2.blob_download_waits()
+    >>> waits['count'], waits['seconds'] >= .2, waits['max'] >= .2
+    (1, True, True)
+
+    Waits are bounded, so a hung download doesn't block loads forever:
+
+    >>> lock = ZEO.ClientStorage._lock_blob(blob_filename)
+    >>> old_timeout = ZEO.ClientStorage._blob_lock_timeout
+    >>> ZEO.ClientStorage._blob_lock_timeout = .1
+    >>> waited = []
+    >>> try:
+    ...     ZEO.ClientStorage._lock_blob(blob_filename, waited.append)
+    ... except zc.lockfile.LockError:
+    ...     print('gave up')
+    gave up
+    >>> waited[0] >= .1
+    True
+    >>> ZEO.ClientStorage._blob_lock_timeout = old_timeout
+    >>> lock.close()
+
+    The abandoned wait releases the lock as soon as it gets it:
+
+    >>> ZEO.ClientStorage._lock_blob(blob_filename).close()
+
+    >>> client.close()
+    >>> client2.close()
+    """
+
+def client_metrics():
+    """
+    Client storages record metrics, including the times taken by
+    server calls and the amount of blob data transferred:
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs',
+    ...                     metrics_log_interval=.1)
+    >>> conn = ZODB.connection(client)
+    >>> conn.root.b = ZODB.blob.Blob(b'x' * 1000)
+    >>> conn.transaction_manager.commit()
+
+    Two transactions were committed, including the one that created
+    the root object:
+
+    >>> snapshot = client.metrics.snapshot()
+    >>> snapshot['calls']['vote']['count'], snapshot['connections']
+    (2, 1)
+    >>> snapshot['blob_bytes']
+    {'received': 0, 'sent': 1000}
+
+    Loads served from the cache are counted as cache hits, and loads
+    that go to the server as misses:
+
+    >>> hits = snapshot['cache']['hits']
+    >>> for i in range(20):
+    ...     _ = client.load(z64)
+    >>> client.metrics.snapshot()['cache']['hits'] - hits
+    20
+    >>> client._cache.invalidate(z64, None)
+    >>> misses = client.metrics.snapshot()['cache']['misses']
+    >>> _ = client.load(z64)
+    >>> client.metrics.snapshot()['cache']['misses'] - misses
+    1
+
+    A summary is logged periodically:
+
+    >>> import zope.testing.loggingsupport
+    >>> handler = zope.testing.loggingsupport.InstalledHandler(
+    ...     'ZEO.metrics')
+    >>> wait_until("metrics logged", lambda: handler.records)
+    >>> 'vote=2/' in handler.records[0].getMessage()
+    True
+    >>> handler.uninstall()
+
+    >>> conn.close()
+    """
+
+def snapshot_clients():
+    """
+    A client storage can be pinned to a transaction, to read a
+    consistent view of the database while it changes:
+
+    >>> addr, _ = start_server()
+    >>> db = ZEO.DB(addr)
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 1
+    ...     conn.root.y = MinPO(1)
+    >>> with db.transaction() as conn:
+    ...     oid = conn.root.y._p_oid
+    >>> snapshot = db.storage.lastTransaction()
+
+    >>> client = ZEO.client(addr, snapshot=snapshot)
+    >>> client.lastTransaction() == snapshot
+    True
+    >>> client.isReadOnly()
+    True
+    >>> client._cache.path is None
+    True
+
+    Later changes aren't seen:
+
+    >>> with db.transaction() as conn:
+    ...     conn.root.x = 2
+    ...     conn.root.y.value = 2
+    >>> snapshot_db = ZODB.DB(client)
+    >>> with snapshot_db.transaction() as conn:
+    ...     conn.root.x, conn.root.y.value
+    (1, 1)
+    >>> client.lastTransaction() == snapshot
+    True
+
+    Several objects can be loaded at once, with None for objects that
+    didn't exist:
+
+    >>> [(r[1] == snapshot) for r in client.loadBefore_many(
+    ...     [z64, oid], maxtid)]
+    [True, True]
+    >>> client.loadBefore_many([p64(42)], maxtid)
+    [None]
+
+    Snapshot clients are read-only:
+
+    >>> try:
+    ...     with snapshot_db.transaction() as conn:
+    ...         conn.root.x = 3
+    ... except ZODB.POSException.ReadOnlyError:
+    ...     print('read only')
+    read only
+
+    >>> snapshot_db.close()
+    >>> db.close()
+    """
+
+def copying_transactions_in_bulk():
+    """
+    When copying transactions to a ZEO server, batches of whole
+    transactions, with their blobs, are sent to the server to be
+    committed back to back:
+
+    >>> source = ZODB.FileStorage.FileStorage('source.fs',
+    ...                                       blob_dir='source-blobs')
+    >>> db = ZODB.DB(source)
+    >>> with db.transaction() as conn:
+    ...     conn.root.b = ZODB.blob.Blob(b'blob data')
+    >>> for i in range(5):
+    ...     with db.transaction() as conn:
+    ...         conn.root.x = i
+
+    >>> addr, _ = start_server(blob_dir='blobs')
+    >>> client = ZEO.client(addr, blob_dir='cblobs')
+    >>> client._restore_batch_size = 1
+    >>> sent = []
+    >>> call_future = client._server.call_future
+    >>> def call_future_(method, *args):
+    ...     sent.append(method)
+    ...     return call_future(method, *args)
+    >>> client._server.call_future = call_future_
+
+    >>> client.copyTransactionsFrom(source)
+    >>> sent.count('restore_transactions')
+    7
+    >>> ([t.tid for t in client.iterator()] ==
+    ...  [t.tid for t in source.iterator()])
+    True
+    >>> client.lastTransaction() == source.lastTransaction()
+    True
+
+    While connected, batches are waited for as long as they take to
+    commit, like other synchronous calls, rather than for the client's
+    connection timeout:
+
+    >>> import concurrent.futures
+    >>> future = concurrent.futures.Future()
+    >>> timeout = client._server.timeout
+    >>> client._server.timeout = .1
+    >>> threading.Timer(.3, future.set_result, ('committed', )).start()
+    >>> client._wait_for_result(future)
+    'committed'
+    >>> client._server.timeout = timeout
+
+    >>> db.close()
+    >>> db = ZODB.DB(client)
+    >>> with db.transaction() as conn:
+    ...     print(conn.root.x)
+    ...     with conn.root.b.open() as f:
+    ...         print(f.read().decode())
+    4
+    blob data
+    >>> db.close()
+    """
+
+def historical_revisions_are_cached():
+    """
+    Non-current revisions of objects never change, so those loaded
+    with loadSerial are cached and later loads are served from the
+    cache:
+
+    >>> addr, _ = start_server()
+    >>> db = ZEO.DB(addr)
+    >>> for i in range(3):
+    ...     with db.transaction() as conn:
+    ...         conn.root.x = i
+    >>> serials = [h['tid'] for h in db.storage.history(z64, 3)]
+    >>> data = [db.storage.loadSerial(z64, serial) for serial in serials]
+
+    >>> client = ZEO.client(addr)
+    >>> calls = []
+    >>> call = client._call
+    >>> def call_(method, *args):
+    ...     calls.append(method)
+    ...     return call(method, *args)
+    >>> client._call = call_
+    >>> load_before = client._server.load_before
+    >>> def load_before_(oid, tid):
+    ...     calls.append('load_before')
+    ...     return load_before(oid, tid)
+    >>> client._server.load_before = load_before_
+
+    >>> [client.loadSerial(z64, serial) for serial in serials] == data
+    True
+    >>> calls
+    ['loadBefore', 'loadBefore', 'loadBefore']
+    >>> [client.loadSerial(z64, serial) for serial in serials[1:]] == data[1:]
+    True
+    >>> len(calls)
+    3
+
+    As are loads of revisions before past transactions:
+
+    >>> client.loadBefore(z64, serials[0]) == (data[1], serials[1], serials[0])
+    True
+    >>> len(calls)
+    3
+
+    >>> client.close()
+    >>> db.close()
+    """
+
+def transactions_can_be_finished_when_voting():
+    """
+    With the vote_and_finish option, the server finishes transactions
+    when they're voted, saving a round trip:
+
+    >>> addr, _ = start_server(
+    ...     zeo_conf=dict(client_conflict_resolution=True))
+    >>> db = ZEO.DB(addr, vote_and_finish=True)
+    >>> storage = db.storage
+    >>> calls = []
+    >>> call = storage._call
+    >>> def call_(method, *args, **kw):
+    ...     calls.append(method)
+    ...     return call(method, *args, **kw)
+    >>> storage._call = call_
+    >>> def record(func):
+    ...     def record_(*args):
+    ...         calls.append(func.__name__)
+    ...         return func(*args)
+    ...     return record_
+    >>> for name in 'vote_and_finish', 'tpc_finish', 'tpc_finished':
+    ...     setattr(storage._server, name,
+    ...             record(getattr(storage._server, name)))
+
+    >>> from BTrees.Length import Length
+    >>> with db.transaction() as conn:
+    ...     conn.root.length = Length(0)
+    >>> calls
+    ['vote_and_finish', 'tpc_finished']
+
+    The data committed is cached:
+
+    >>> tid = storage.lastTransaction()
+    >>> storage._cache.load(z64)[1] == tid
+    True
+
+    Other clients see the changes, and we see theirs:
+
+    >>> db2 = ZEO.DB(addr)
+    >>> with db2.transaction() as conn:
+    ...     conn.root.length.change(1)
+    >>> wait_until(lambda : storage.lastTransaction() > tid)
+    >>> with db.transaction() as conn:
+    ...     conn.root.length.value
+    1
+
+    When there are conflicts to be resolved by the client, they're
+    resolved and the client votes again:
+
+    >>> conn = db.open()
+    >>> conn.root.length.change(1)
+    >>> with db2.transaction() as conn2:
+    ...     conn2.root.length.change(1)
+    >>> del calls[:]
+    >>> conn.transaction_manager.commit()
+    >>> calls
+    ['vote_and_finish', 'loadBefore', 'vote_and_finish', 'tpc_finished']
+    >>> conn.root.length.value
+    3
+    >>> conn.close()
+
+    >>> wait_until(lambda : (db2.storage.lastTransaction() ==
+    ...                      storage.lastTransaction()))
+    >>> with db2.transaction() as conn2:
+    ...     conn2.root.length.value
+    3
+
+    >>> db.close()
+    >>> db2.close()
+    """
+
+def transactions_can_be_committed_concurrently():
+    """
+    A client storage can have several transactions in progress at
+    once, so threads sharing it don't have to wait for each other's
+    commits:
+
+    >>> addr, _ = start_server()
+    >>> client = ZEO.client(addr)
+    >>> txn1 = TransactionMetaData()
+    >>> client.tpc_begin(txn1)
+    >>> client.store(p64(1), z64, b'x', '', txn1)
+    >>> txn2 = TransactionMetaData()
+    >>> client.tpc_begin(txn2)
+    >>> client.store(p64(2), z64, b'y', '', txn2)
+    >>> client.tpc_vote(txn2)
+    >>> tid2 = client.tpc_finish(txn2)
+    >>> client.tpc_vote(txn1)
+    >>> tid1 = client.tpc_finish(txn1)
+
+    >>> tid1 > tid2
+    True
+    >>> client.load(p64(1)) == (b'x', tid1)
+    True
+    >>> client.load(p64(2)) == (b'y', tid2)
+    True
+
+    Aborting one transaction doesn't affect the others:
+
+    >>> client.tpc_begin(txn1)
+    >>> client.store(p64(1), tid1, b'xx', '', txn1)
+    >>> client.tpc_begin(txn2)
+    >>> client.store(p64(2), tid2, b'yy', '', txn2)
+    >>> client.tpc_abort(txn1)
+    >>> client.tpc_vote(txn2)
+    >>> tid = client.tpc_finish(txn2)
+    >>> client.load(p64(1)) == (b'x', tid1)
+    True
+    >>> client.load(p64(2)) == (b'yy', tid)
+    True
+
+    >>> client.close()
+    """
+
+def object_records_can_be_sent_as_deltas():
+    """
+    With the delta_encoding option, records of changed objects are
+    sent as deltas against revisions in the client cache, saving
+    bandwidth when large objects change slightly:
+
+    >>> addr, _ = start_server()
+    >>> client = ZEO.client(addr, delta_encoding=True)
+    >>> client2 = ZEO.client(addr, delta_encoding=True)
+    >>> oid = p64(1)
+    >>> data = b'x' * 10000
+    >>> txn = TransactionMetaData()
+    >>> client.tpc_begin(txn)
+    >>> client.store(oid, z64, data, '', txn)
+    >>> client.tpc_vote(txn)
+    >>> tid1 = client.tpc_finish(txn)
+    >>> client2.load(oid) == (data, tid1)
+    True
+
+    The first client has the revision it's replacing in its cache, so
+    it sends a delta:
+
+    >>> data2 = data[:5000] + b'y' + data[5001:]
+    >>> txn = TransactionMetaData()
+    >>> client.tpc_begin(txn)
+    >>> client.store(oid, tid1, data2, '', txn)
+    >>> client.tpc_vote(txn)
+    >>> tid2 = client.tpc_finish(txn)
+    >>> client.metrics.snapshot()['delta_bytes_saved']
+    {'received': 0, 'sent': 9991}
+
+    The second client has the old revision as non-current data after
+    the invalidation, so the new revision is sent to it as a delta:
+
+    >>> wait_until("invalidated", lambda: client2.lastTransaction() == tid2)
+    >>> client2.load(oid) == (data2, tid2)
+    True
+    >>> client2.metrics.snapshot()['delta_bytes_saved']
+    {'received': 9991, 'sent': 0}
+
+    Records are sent in full if there's no base revision, or a delta
+    wouldn't be smaller:
+
+    >>> client._cache.clear()
+    >>> data3 = b'z' * 10000
+    >>> txn = TransactionMetaData()
+    >>> client.tpc_begin(txn)
+    >>> client.store(oid, tid2, data3, '', txn)
+    >>> client.tpc_vote(txn)
+    >>> tid3 = client.tpc_finish(txn)
+    >>> wait_until("invalidated", lambda: client2.lastTransaction() == tid3)
+    >>> client2.load(oid) == (data3, tid3)
+    True
+    >>> client.metrics.snapshot()['delta_bytes_saved']
+    {'received': 0, 'sent': 9991}
+    >>> client2.metrics.snapshot()['delta_bytes_saved']
+    {'received': 9991, 'sent': 0}
+
+    >>> client.close()
+    >>> client2.close()
+    """
+
+def stale_reads_can_be_served_while_disconnected():
+    """
+    With the serve_stale_reads option, a client keeps serving reads
+    from its cache while it's disconnected, rather than waiting for
+    the server:
+
+    >>> addr, admin = start_server()
+    >>> client = ZEO.client(addr, serve_stale_reads=True, server_sync=True)
+    >>> txn = TransactionMetaData()
+    >>> client.tpc_begin(txn)
+    >>> client.store(p64(1), z64, b'x', '', txn)
+    >>> client.tpc_vote(txn)
+    >>> tid = client.tpc_finish(txn)
+
+    When the connection is lost, readers are told that the data may be
+    out of date:
+
+    >>> import ZODB.event
+    >>> events = []
+    >>> old_notify = ZODB.event.notify
+    >>> ZODB.event.notify = events.append
+    >>> stop_server(admin)
+    >>> wait_disconnected(client)
+    >>> wait_until("notified", lambda: events)
+    >>> ZODB.event.notify = old_notify
+    >>> [e.__class__.__name__ for e in events], events[0].storage is client
+    (['ServingStaleData'], True)
+
+    Reads that hit the cache see the database as of the last
+    transaction the client saw:
+
+    >>> client.sync()
+    >>> client.lastTransaction() == tid
+    True
+    >>> client.load(p64(1)) == (b'x', tid)
+    True
+
+    Anything that needs the server fails right away:
+
+    >>> start = time.time()
+    >>> client.load(p64(2))
+    Traceback (most recent call last):
+    ...
+    ClientDisconnected
+    >>> client.tpc_begin(TransactionMetaData())
+    Traceback (most recent call last):
+    ...
+    ClientDisconnected
+    >>> time.time() - start < 5
+    True
+
+    >>> client.close()
+    """
+
+def client_storages_can_share_a_networking_thread():
+    """
+    With the shared_thread option, client storages do their networking
+    in one thread and event loop, rather than a thread each:
+
+    >>> import ZEO.asyncio.client
+    >>> shared = ZEO.asyncio.client.default_shared_thread
+    >>> addr, _ = start_server()
+    >>> client = ZEO.client(addr, shared_thread=True)
+    >>> client2 = ZEO.client(addr, shared_thread=True)
+    >>> client._server.loop is client2._server.loop is shared.loop
+    True
+    >>> len([t for t in threading.enumerate()
+    ...      if t.name == 'zeo client shared networking thread'])
+    1
+
+    They share a connection to the server, with a channel each:
+
+    >>> [connection] = shared.multiplexer.connections.values()
+    >>> sorted(connection.channels) == [1, 2]
+    True
+    >>> client._server.client.protocol.mux is connection
+    True
+
+    Each sees the other's changes:
+
+    >>> txn = TransactionMetaData()
+    >>> client.tpc_begin(txn)
+    >>> client.store(p64(1), z64, b'x', '', txn)
+    >>> client.tpc_vote(txn)
+    >>> tid = client.tpc_finish(txn)
+    >>> wait_until("invalidated", lambda: client2.lastTransaction() == tid)
+    >>> client2.load(p64(1)) == (b'x', tid)
+    True
+
+    The thread keeps running until the last client using it is closed:
+
+    >>> client.close()
+    >>> client2.load(p64(1)) == (b'x', tid)
+    True
+    >>> thread = shared.thread
+    >>> client2.close()
+    >>> thread.is_alive(), shared.thread
+    (False, None)
+
+    Servers that don't support shared connections are connected to
+    separately:
+
+    >>> addr, _ = start_server(path='old.fs', protocol=b'51')
+    >>> client = ZEO.client(addr, shared_thread=True)
+    >>> client2 = ZEO.client(addr, shared_thread=True)
+    >>> shared.multiplexer.connections
+    {}
+    >>> client._server.client.protocol.protocol_version[1:] == b'51'
+    True
+    >>> client.close()
+    >>> client2.close()
+    """
+
+def new_oids_are_requested_in_the_background():
+    """
+    Clients keep a pool of new object ids.  When it runs low, more are
+    requested in the background, so allocating objects rarely has to
+    wait for the server.  The number requested is adjusted to the rate
+    at which oids are allocated.  We'll control the clock, so oids are
+    allocated at a known rate, and note the requests made:
+
+    >>> import mock
+    >>> def allocate(client, n):
+    ...     sizes = []
+    ...     call_future = client._server.call_future
+    ...     def call_future_(method, *args):
+    ...         if method == 'new_oids':
+    ...             sizes.append(args[0])
+    ...         return call_future(method, *args)
+    ...     client._server.call_future = call_future_
+    ...     clock = [0]
+    ...     def time_():
+    ...         clock[0] += .1
+    ...         return clock[0]
+    ...     with mock.patch('ZEO.ClientStorage.time') as time:
+    ...         time.time.side_effect = time_
+    ...         oids = [client.new_oid() for i in range(n)]
+    ...     print(len(set(oids)), sorted(oids) == oids)
+    ...     return sizes
+
+    >>> addr, _ = start_server()
+    >>> client = ZEO.client(addr)
+    >>> sizes = allocate(client, 5000)
+    5000 True
+
+    When oids are allocated quickly, larger batches are requested, up
+    to 1000 by default:
+
+    >>> sizes[0], sizes[-1], max(sizes)
+    (100, 1000, 1000)
+    >>> client.close()
+
+    The batch size is limited by the ``new_oid_batch_size_max``
+    option:
+
+    >>> client = ZEO.client(addr, new_oid_batch_size_max=200)
+    >>> sizes = allocate(client, 5000)
+    5000 True
+    >>> sizes[0], sizes[-1], max(sizes)
+    (100, 200, 200)
+    >>> client.close()
+    """
+
 @forker.skip_if_testing_client_against_zeo4
 def test_server_status():
     """
@@ -1566,7 +2406,7 @@ if not os.environ.get('ZEO4_SERVER'):
             >>> a, s = ZEO.server(threaded=False)
             >>> conn = ZEO.connection(a)
             >>> str(conn.db().storage.protocol_version.decode('ascii'))
-            'M5'
+            'M51'
             >>> conn.close(); s()
             """
     else:
@@ -1577,13 +2417,13 @@ if not os.environ.get('ZEO4_SERVER'):
             >>> a, s = ZEO.server(threaded=False)
             >>> conn = ZEO.connection(a)
             >>> str(conn.db().storage.protocol_version.decode('ascii'))
-            'Z5'
+            'Z51'
             >>> conn.close(); s()
 
             >>> a, s = ZEO.server(zeo_conf=dict(msgpack=True), threaded=False)
             >>> conn = ZEO.connection(a)
             >>> str(conn.db().storage.protocol_version.decode('ascii'))
-            'M5'
+            'M51'
             >>> conn.close(); s()
             """
 
@@ -1741,6 +2581,7 @@ def test_suite():
         (re.compile("ZODB.POSException.ConflictError"), "ConflictError"),
         (re.compile("ZODB.POSException.POSKeyError"), "POSKeyError"),
         (re.compile("ZEO.Exceptions.ClientStorageError"), "ClientStorageError"),
+        (re.compile("ZEO.Exceptions.ClientDisconnected"), "ClientDisconnected"),
         (re.compile(r"\[Errno \d+\]"), '[Errno N]'),
         (re.compile(r"loads=\d+\.\d+"), 'loads=42.42'),
         # Python 3 drops the u prefix
@@ -21,9 +21,11 @@ import sys
 import transaction
 import unittest
 import ZEO.StorageServer
+import ZEO.delta
 import ZEO.tests.servertesting
 import ZODB.blob
 import ZODB.FileStorage
+import ZODB.POSException
 import ZODB.tests.util
 import ZODB.utils
 
@@ -495,6 +497,233 @@ ZEOStorage as closed and see if trying to get a lock cleans it up:
     >>> server.close()
     """
 
+def batched_stores():
+    r"""
+Clients can send store, delete and read-check messages in batches
+using storea_many.  Each message in a batch is a method name and its
+arguments, without the transaction id:
+
+    >>> fs = ZODB.FileStorage.FileStorage('t.fs')
+    >>> server = ZEO.tests.servertesting.StorageServer('x', {'1': fs})
+    >>> zs = ZEO.tests.servertesting.client(server, 1)
+    >>> zs.get_info()['supports_storea_many']
+    True
+
+    >>> zs.tpc_begin('0', '', '', {})
+    >>> zs.storea_many([
+    ...     ('storea', (ZODB.utils.p64(1), ZODB.utils.z64, b'x')),
+    ...     ('checkCurrentSerialInTransaction',
+    ...      (ZODB.utils.z64, ZODB.utils.z64)),
+    ...     ('deleteObject', (ZODB.utils.p64(2), ZODB.utils.z64)),
+    ...     ], '0')
+    >>> [op for op, args in zs.txnlog]
+    ['_store', '_checkread', '_delete']
+
+Only those messages can be batched:
+
+    >>> zs.storea_many([('undoa', (ZODB.utils.z64, ))], '0')
+    Traceback (most recent call last):
+    ...
+    ValueError: ('Invalid batched method', 'undoa')
+
+    >>> zs.tpc_abort('0')
+
+Batched stores are committed like individual ones:
+
+    >>> zs.tpc_begin('1', '', '', {})
+    >>> zs.storea_many([
+    ...     ('storea', (ZODB.utils.p64(1), ZODB.utils.z64, b'x')),
+    ...     ('storea', (ZODB.utils.p64(2), ZODB.utils.z64, b'y')),
+    ...     ], '1')
+    >>> _ = zs.vote('1')
+    >>> tid, clear = zs.tpc_finish('1').args
+    >>> clear()
+    >>> fs.load(ZODB.utils.p64(2)) == (b'y', tid)
+    True
+
+Batches are checked against the current transaction like individual
+stores:
+
+    >>> zs.storea_many([], '1') # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    StorageTransactionError: ...
+
+    >>> server.close()
+    """
+
+def batched_iteration():
+    r"""
+Clients can fetch transactions, with their data records, in batches
+using iterator_next_many.  Whole transactions are returned until the
+data returned reach the requested size:
+
+    >>> fs = ZODB.FileStorage.FileStorage('t.fs')
+    >>> server = ZEO.tests.servertesting.StorageServer('x', {'1': fs})
+    >>> zs = ZEO.tests.servertesting.client(server, 1)
+    >>> zs.get_info()['supports_iterator_batches']
+    True
+
+    >>> tids = []
+    >>> for i in range(3):
+    ...     zs.tpc_begin(str(i), '', '', {})
+    ...     zs.storea(ZODB.utils.p64(i), ZODB.utils.z64, b'x' * 10, str(i))
+    ...     _ = zs.vote(str(i))
+    ...     tid, clear = zs.tpc_finish(str(i)).args
+    ...     clear()
+    ...     tids.append(tid)
+
+    >>> iid = zs.iterator_start(None, None)
+    >>> batch = zs.iterator_next_many(iid, 20)
+    >>> [t[0] for t in batch] == tids[:2]
+    True
+    >>> batch[0][5] == [(ZODB.utils.p64(0), tids[0], b'x' * 10, None)]
+    True
+
+When the iterator is exhausted, the batch ends with None and the
+iterator is discarded:
+
+    >>> batch = zs.iterator_next_many(iid, 20)
+    >>> [t[0] for t in batch[:-1]] == tids[2:], batch[-1]
+    (True, None)
+    >>> zs.iterator_next_many(iid, 20)
+    Traceback (most recent call last):
+    ...
+    KeyError: 0
+
+Iterators that aren't used for iterator_timeout seconds are discarded
+when other iterators are started:
+
+    >>> iid = zs.iterator_start(None, None)
+    >>> zs.iterator_next(iid)[0] == tids[0]
+    True
+    >>> zs.iterator_timeout = 0
+    >>> _ = zs.iterator_start(None, None)
+    >>> zs.iterator_next(iid)
+    Traceback (most recent call last):
+    ...
+    KeyError: 1
+
+    >>> server.close()
+    """
+
+def concurrent_transactions():
+    r"""
+A client can have several transactions in progress at once.  They're
+kept apart by transaction id and only serialized by the storage lock
+when they vote:
+
+    >>> fs = ZODB.FileStorage.FileStorage('t.fs')
+    >>> server = ZEO.tests.servertesting.StorageServer('x', {'1': fs})
+    >>> zs = ZEO.tests.servertesting.client(server, 1)
+    >>> zs.get_info()['supports_concurrent_transactions']
+    True
+
+    >>> zs.tpc_begin('0', '', '', {})
+    >>> zs.storea(ZODB.utils.p64(1), ZODB.utils.z64, b'x', '0')
+    >>> zs.tpc_begin('1', '', '', {})
+    >>> zs.storea(ZODB.utils.p64(2), ZODB.utils.z64, b'y', '1')
+    >>> list(zs.transactions)
+    ['1']
+
+    >>> zs.vote('1')
+    []
+
+While one transaction holds the lock, the other waits for it:
+
+    >>> delay = zs.vote('0')
+    >>> class Sender(object):
+    ...     def send_reply(self, id, reply):
+    ...         print('reply', id, reply)
+    >>> delay.set_sender(1, Sender())
+
+    >>> tid1, clear = zs.tpc_finish('1').args
+    >>> clear()
+    reply 1 []
+    >>> tid0, clear = zs.tpc_finish('0').args
+    >>> clear()
+    >>> tid0 > tid1
+    True
+    >>> fs.load(ZODB.utils.p64(1)) == (b'x', tid0)
+    True
+    >>> fs.load(ZODB.utils.p64(2)) == (b'y', tid1)
+    True
+    >>> zs.transactions
+    {}
+
+If the client disconnects, all of its transactions are aborted:
+
+    >>> zs.tpc_begin('2', '', '', {})
+    >>> zs.tpc_begin('3', '', '', {})
+    >>> zs.storea(ZODB.utils.p64(3), ZODB.utils.z64, b'z', '3')
+    >>> zs.vote('3')
+    []
+    >>> zs.notify_disconnected()
+    >>> zs.transaction, zs.transactions
+    (None, {})
+    >>> zs.lock_manager.locked is None
+    True
+
+    >>> server.close()
+    """
+
+def delta_encoded_records():
+    r"""
+Object records can be stored and loaded as deltas against revisions
+the client has:
+
+    >>> fs = ZODB.FileStorage.FileStorage('t.fs')
+    >>> server = ZEO.tests.servertesting.StorageServer('x', {'1': fs})
+    >>> zs = ZEO.tests.servertesting.client(server, 1)
+    >>> zs.get_info()['supports_delta_encoding']
+    True
+
+    >>> oid = ZODB.utils.p64(1)
+    >>> data1 = b'x' * 100
+    >>> zs.tpc_begin('0', '', '', {})
+    >>> zs.storea(oid, ZODB.utils.z64, data1, '0')
+    >>> zs.vote('0')
+    []
+    >>> tid1, clear = zs.tpc_finish('0').args
+    >>> clear()
+
+    >>> data2 = b'x' * 50 + b'y' + b'x' * 49
+    >>> delta = ZEO.delta.encode(data1, data2)
+    >>> len(delta)
+    9
+    >>> zs.tpc_begin('1', '', '', {})
+    >>> zs.storea_delta(oid, tid1, delta, '1')
+    >>> zs.vote('1')
+    []
+    >>> tid2, clear = zs.tpc_finish('1').args
+    >>> clear()
+    >>> fs.load(oid) == (data2, tid2)
+    True
+
+    >>> zs.loadBefore_delta(oid, ZODB.utils.maxtid, tid1) == (
+    ...     None, delta, tid2, None)
+    True
+
+If the base revision can't be loaded, the full record is sent:
+
+    >>> missing = ZODB.utils.p64(42)
+    >>> zs.loadBefore_delta(oid, ZODB.utils.maxtid, missing) == (
+    ...     data2, None, tid2, None)
+    True
+
+and stores conflict, as the base revision can't be current:
+
+    >>> zs.tpc_begin('2', '', '', {})
+    >>> zs.storea_delta(oid, missing, delta, '2')
+    >>> try:
+    ...     zs.vote('2')
+    ... except ZODB.POSException.ConflictError as err:
+    ...     print(err)
+    Delta base revision is no longer available (oid 0x01)
+
+    >>> server.close()
+    """
+
 def test_suite():
     return unittest.TestSuite((
         doctest.DocTestSuite(
@@ -124,6 +124,40 @@ class CacheTests(ZODB.tests.util.TestCase):
         self.assertEqual(self.cache.loadBefore(n1, n5), (data1, n4, n5))
         self.assertEqual(self.cache.loadBefore(n2, n4), None)
 
+    def testLoadSerial(self):
+        data1 = b"data for n1"
+        data2 = b"data for n2"
+        self.assertEqual(self.cache.loadSerial(n1, n4), None)
+        self.cache.store(n1, n4, None, data1)
+        self.cache.store(n1, n2, n3, data2)
+        self.assertEqual(self.cache.loadSerial(n1, n2), data2)
+        self.assertEqual(self.cache.loadSerial(n1, n3), None)
+        # Current data aren't returned, as they may be packed away
+        # without the cache being told:
+        self.assertEqual(self.cache.loadSerial(n1, n4), None)
+        # Revisions are still found after they become non-current:
+        self.cache.invalidate(n1, n5)
+        self.assertEqual(self.cache.loadSerial(n1, n4), data1)
+
+    def testLoadNoncurrent(self):
+        self.assertEqual(self.cache.loadNoncurrent(n1), None)
+        self.cache.store(n1, n4, None, b"data for n4")
+        self.assertEqual(self.cache.loadNoncurrent(n1), None)
+        self.cache.store(n1, n2, n3, b"data for n2")
+        self.assertEqual(self.cache.loadNoncurrent(n1), (b"data for n2", n2))
+        self.cache.invalidate(n1, n5)
+        self.assertEqual(self.cache.loadNoncurrent(n1), (b"data for n4", n4))
+
+    def testClearNoncurrent(self):
+        self.cache.store(n1, n4, None, b"data for n1")
+        self.cache.store(n1, n2, n3, b"data for n2")
+        self.cache.store(n2, n2, n3, b"data for n3")
+        self.cache.clearNoncurrent()
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.loadBefore(n1, n3), None)
+        self.assertEqual(self.cache.loadSerial(n2, n2), None)
+        self.assertEqual(self.cache.load(n1), (b"data for n1", n4))
+
     def testException(self):
         self.cache.store(n1, n2, None, b"data")
         self.cache.store(n1, n2, None, b"data")
@@ -356,6 +390,45 @@ class CacheTests(ZODB.tests.util.TestCase):
         self.assertEqual(cache.loadBefore(oid, n2), (b'first', n1, n2))
         self.assertEqual(cache.loadBefore(oid, n3), (b'second', n2, None))
 
+    def test_full_verification(self):
+        cache = self.cache
+        cache.store(n1, n1, None, b'n1')
+        cache.store(n2, n1, None, b'n2')
+        cache.store(n3, n1, None, b'n3')
+        cache.store(n4, n1, n2, b'old n4')
+        cache.store(n4, n2, None, b'n4')
+        cache.setLastTid(n3)
+
+        # Only current records need verifying:
+        self.assertEqual(cache.start_verification(), 4)
+        self.assertEqual(sorted(cache.unverified_batch(10)),
+                         [(n1, n1), (n2, n1), (n3, n1), (n4, n2)])
+
+        # The tid isn't recorded in the file while we're verifying:
+        cache.setLastTid(n4)
+        self.assertEqual(cache.getLastTid(), n4)
+        cache.f.seek(len(ZEO.cache.magic))
+        self.assertEqual(cache.f.read(8), z64)
+
+        # Unverified records aren't loaded, and are forgotten when
+        # they're invalidated:
+        self.assertEqual(cache.load(n1), None)
+        cache.invalidate(n2, n4)
+        self.assertEqual(cache.loadBefore(n2, n4), None)
+        self.assertEqual(cache.loadBefore(n4, n2), (b'old n4', n1, n2))
+        self.assertEqual(sorted(cache.unverified_batch(10)),
+                         [(n3, n1), (n4, n2)])
+
+        # Stale records are dropped when the server says so:
+        self.assertEqual(cache.verified([(n3, n1)], [n3]), 1)
+        self.assertEqual(cache.load(n3), None)
+        self.assertEqual(cache.verified([(n4, n2)], []), 0)
+        self.assertEqual(cache.load(n4), (b'n4', n2))
+
+        # and the tid is saved when we're done:
+        cache.f.seek(len(ZEO.cache.magic))
+        self.assertEqual(cache.f.read(8), n4)
+
 def kill_does_not_cause_cache_corruption():
     r"""
 
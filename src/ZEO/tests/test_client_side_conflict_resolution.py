@@ -109,6 +109,56 @@ class ClientSideConflictResolutionTests(zope.testing.setupstack.TestCase):
         self.assertEqual(reader.getClassName(p), 'BTrees.Length.Length')
         self.assertEqual(reader.getState(p), 3)
 
+    def test_vote_and_finish(self):
+        server = StorageServer(
+            self, DemoStorage(), client_conflict_resolution=True)
+        zs = server.zs
+
+        writer = serialize.ObjectWriter()
+        ob = Length(0)
+        ob._p_oid = z64
+
+        # Without conflicts, the transaction is finished when voting:
+        zs.tpc_begin(1, '', '', {})
+        zs.storea(ob._p_oid, z64, writer.serialize(ob), 1)
+        tid1, serials = server.unpack_result(zs.vote_and_finish(1))
+        self.assertEqual(serials, [])
+        self.assertEqual(zs.lastTransaction(), tid1)
+        server.assert_calls(self, ('info', {'size': Var(), 'length': 1}))
+
+        ob.change(1)
+        zs.tpc_begin(2, '', '', {})
+        zs.storea(ob._p_oid, tid1, writer.serialize(ob), 2)
+        tid2, serials = server.unpack_result(zs.vote_and_finish(2))
+        server.assert_calls(self, ('info', {'size': Var(), 'length': 1}))
+
+        # With conflicts, they're returned and the transaction isn't
+        # finished:
+        zs.tpc_begin(3, '', '', {})
+        zs.storea(ob._p_oid, tid1, writer.serialize(ob), 3)
+        self.assertEqual(
+            zs.vote_and_finish(3),
+            (None,
+             [dict(oid=ob._p_oid,
+                   serials=(tid2, tid1),
+                   data=writer.serialize(ob),
+                   )]),
+            )
+        self.assertEqual(zs.lastTransaction(), tid2)
+
+        # After the client resolves them, it votes again:
+        ob.change(1)
+        zs.storea(ob._p_oid, tid2, writer.serialize(ob), 3)
+        tid3, serials = server.unpack_result(zs.vote_and_finish(3))
+        self.assertEqual(serials, [])
+        server.assert_calls(self, ('info', {'size': Var(), 'length': 1}))
+
+        p, serial, next_serial = zs.loadBefore(ob._p_oid, maxtid)
+        self.assertEqual((serial, next_serial), (tid3, None))
+        reader = serialize.ObjectReader(
+            factory=lambda conn, *args: find_global(*args))
+        self.assertEqual(reader.getState(p), 2)
+
     def test_client_side(self):
         # First, traditional:
         addr, stop = ZEO.server('data.fs', threaded=False)
@@ -0,0 +1,44 @@
+import os
+import unittest
+
+from ZEO.delta import encode, decode
+
+
+class DeltaTests(unittest.TestCase):
+
+    def check(self, base, data):
+        delta = encode(base, data)
+        self.assertTrue(delta is not None)
+        self.assertTrue(len(delta) < len(data))
+        self.assertEqual(decode(base, delta), data)
+        return delta
+
+    def testChangedMiddle(self):
+        base = b'x' * 1000
+        delta = self.check(base, base[:400] + b'yy' + base[401:])
+        self.assertEqual(len(delta), 10)
+
+    def testInsertedAndRemoved(self):
+        base = b''.join(b'%05d' % i for i in range(200))
+        self.check(base, base[:500] + b'inserted' + base[500:])
+        self.check(base, base[:500] + base[600:])
+        self.check(base, base + b'appended')
+        self.check(base, b'prepended' + base)
+        self.check(base, base[:-10])
+
+    def testRepeatedData(self):
+        # The prefix and suffix mustn't overlap:
+        self.check(b'ab' * 30, b'ab' * 10 + b'zz' + b'ab' * 20)
+        self.check(b'a' * 20, b'a' * 40)
+        self.check(b'a' * 40, b'a' * 20)
+
+    def testNotSmaller(self):
+        self.assertEqual(encode(b'', b''), None)
+        self.assertEqual(encode(b'abc', b'abc'), None)
+        self.assertEqual(encode(os.urandom(100), os.urandom(100)), None)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DeltaTests))
+    return suite
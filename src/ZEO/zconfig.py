@@ -69,6 +69,8 @@ class ClientStorageConfig(object):
             options['blob_cache_size_check'] = config.blob_cache_size_check
         if config.client_label is not None:
             options['client_label'] = config.client_label
+        if config.metrics_log_interval is not None:
+            options['metrics_log_interval'] = config.metrics_log_interval
 
         ssl = config.ssl
         if ssl:
@@ -86,5 +88,13 @@ class ClientStorageConfig(object):
             read_only=config.read_only,
             read_only_fallback=config.read_only_fallback,
             server_sync = config.server_sync,
+            new_oid_batch_size_max=config.new_oid_batch_size_max,
+            transaction_buffer_memory_size=(
+                config.transaction_buffer_memory_size),
+            drop_cache_rather_verify=config.drop_cache_rather_verify,
+            vote_and_finish=config.vote_and_finish,
+            delta_encoding=config.delta_encoding,
+            serve_stale_reads=config.serve_stale_reads,
+            shared_thread=config.shared_thread,
             wait_timeout=config.wait_timeout,
             **options)